@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+
+import metrics
+from outbound import PRIORITY_FRAME, PRIORITY_RESULT
+from persistence import FlushWorker
+
+# ゲームの演出
+#
+# 勝負の結果は先に決めて精算まで済ませ、演出は「フレーム（本文, 次までの秒数）」の列として
+# 事前に組み立てておく。Animator は精算後にそれを後ろのタスクで流すだけなので、演出を
+# 間引いても・落としても結果は変わらない。最後のフレームが結果の本文で、どのモードでも必ず送る。
+#
+#   full    … すべてのフレームを流す
+#   reduced … 最初と最後のフレームだけ、短い間隔で流す
+#   instant … 結果だけを送る
+#
+# モードはチャンネル → サーバー → 既定の順に設定を引き、送信キューが詰まっていたり
+# 演出中のゲームが多いときは自動で reduced / instant に落とす。
+
+MODE_FULL = "full"
+MODE_REDUCED = "reduced"
+MODE_INSTANT = "instant"
+MODES = [MODE_FULL, MODE_REDUCED, MODE_INSTANT]
+MODE_LABELS = {
+    MODE_FULL: "すべて",
+    MODE_REDUCED: "短縮",
+    MODE_INSTANT: "なし（結果のみ）",
+}
+
+# reduced で最初のフレームから結果までに置く間隔
+REDUCED_DELAY = 0.5
+
+log = logging.getLogger("velt.animation")
+
+
+# --- 本文のテンプレート（同じ出目の文字列は使い回す） ---
+@lru_cache(maxsize=512)
+def reels_text(reels):
+    return " ".join(reels)
+
+
+@lru_cache(maxsize=256)
+def dice_text(dice):
+    return f"[{', '.join(map(str, dice))}]"
+
+
+def slot_frames(mention, spins, result, result_text):
+    frames = [(f"{mention} 🎰 スロットを回しています...", 0)]
+    frames += [(f"{mention} 🎰 {reels_text(tuple(spin))}", 0.5) for spin in spins]
+    frames.append((f"{mention} 🎰 {reels_text(tuple(result))}\n{result_text}", 0.5))
+    return frames
+
+
+# rolls は [(dice, hand), ...]（役が出るまでの出目）
+def chinchiro_frames(name, rolls):
+    frames = []
+    for i, (dice, hand) in enumerate(rolls, 1):
+        frames.append((f"{name} サイコロを振ります...（{i}回目）", 0.5 if frames else 0))
+        frames.append((f"{name} 🎲 {dice_text(tuple(dice))} → {hand.yaku}", 1))
+    return frames
+
+
+# BOTが引いたカードを1枚ずつ見せる。cards は引き終わった手札、start は最初の枚数
+def blackjack_dealer_frames(cards, start=2):
+    frames = []
+    for n in range(start + 1, len(cards) + 1):
+        frames.append(("BOT カードを引きます...", 1 if frames else 0))
+        frames.append((f"BOTの手札: {cards[:n]}（合計: {sum(cards[:n])}）", 1))
+    return frames
+
+
+# モードに合わせてフレームを間引く（最後のフレームは必ず残す）
+def reduce_frames(frames, mode):
+    if not frames:
+        return []
+    if mode == MODE_INSTANT or len(frames) == 1:
+        return [(frames[-1][0], 0)]
+    if mode == MODE_REDUCED:
+        return [(frames[0][0], 0), (frames[-1][0], REDUCED_DELAY)]
+    return frames
+
+
+class AnimationSettings:
+    def __init__(self, path, default=MODE_FULL):
+        self.path = path
+        self.default = default if default in MODES else MODE_FULL
+        self._modes = {}  # "guild:<id>" / "channel:<id>" -> モード
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, name="velt-animation")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._modes = json.load(f)
+        except FileNotFoundError:
+            self._modes = {}
+        self._worker.start()
+
+    def get(self, channel):
+        mode = self._modes.get(f"channel:{channel.id}")
+        if mode is None and getattr(channel, "guild", None) is not None:
+            mode = self._modes.get(f"guild:{channel.guild.id}")
+        return mode or self.default
+
+    # mode が None なら設定を消して上の階層（サーバー / 既定）に従う
+    def set(self, scope, target_id, mode):
+        key = f"{scope}:{target_id}"
+        with self._lock:
+            if mode is None:
+                self._modes.pop(key, None)
+            else:
+                self._modes[key] = mode
+        self._worker.mark_dirty()
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    def _flush(self):
+        with self._lock:
+            data = json.dumps(self._modes)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self._worker.close()
+
+
+class Animator:
+    def __init__(self, outbound, settings, reduced_at=20, instant_at=100):
+        self.outbound = outbound
+        self.settings = settings
+        # 送信キューの長さか演出中のゲーム数がこれを超えたら演出を落とす
+        self.reduced_at = reduced_at
+        self.instant_at = instant_at
+        self._tasks = set()
+
+    def in_flight(self):
+        return len(self._tasks)
+
+    def mode_for(self, channel):
+        mode = self.settings.get(channel)
+        load = max(self.outbound.queue_depth(), len(self._tasks))
+        if load >= self.instant_at:
+            return MODE_INSTANT
+        if load >= self.reduced_at and mode == MODE_FULL:
+            return MODE_REDUCED
+        return mode
+
+    # フレームを後ろのタスクで流し、そのタスクを返す。
+    # message を渡せばそのメッセージを編集し、なければ最初のフレームを新しく送る。
+    # results は演出のあとに送る追加のメッセージ（テーブルの結果など）
+    def play(self, channel, frames, results=(), message=None, mode=None):
+        mode = mode or self.mode_for(channel)
+        metrics.ANIMATIONS.inc(mode=mode)
+        task = asyncio.create_task(self._run(channel, reduce_frames(frames, mode), results, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, channel, frames, results, message):
+        try:
+            last = len(frames) - 1
+            for i, (content, delay) in enumerate(frames):
+                if delay:
+                    await asyncio.sleep(delay)
+                priority = PRIORITY_RESULT if i == last else PRIORITY_FRAME
+                if message is None:
+                    message = await self.outbound.send(channel, content, priority=priority)
+                elif i == last:
+                    await self.outbound.edit(message, content, priority=priority)
+                else:
+                    # 途中のフレームは待たない（詰まっていれば最新のフレームだけ送られる）
+                    self.outbound.edit(message, content, priority=priority)
+            for content in results:
+                await self.outbound.send(channel, content, priority=PRIORITY_RESULT)
+        except Exception:
+            log.exception("Animation in channel %s failed", getattr(channel, "id", None))
+
+    # 流れている演出が終わるまで待つ（ベンチマーク・終了時用）
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
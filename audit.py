@@ -0,0 +1,281 @@
+import argparse
+import bisect
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+import history
+import snapshot as snapshot_format
+from ledger import iter_log, list_archive
+from snapshot import BalanceSnapshot
+
+# 残高ログの監査ツール（json のストレージ用）
+#
+# 使い方:
+#   python audit.py export [--format csv|jsonl] [--since T] [--until T] [--user ID] [-o FILE]
+#   python audit.py balances [--at T] [-o FILE]
+#   python audit.py verify [--full]
+# T は UNIX 時刻か ISO 8601（例: 2026-01-31T12:00:00+09:00）。
+# --guild ID で既定以外のサーバーのファイル（<名前>_<サーバーID>）を読む。
+#
+# ledger.py がアーカイブに残したセグメントと、今のログ（退避中・追記中）を古い順に1行ずつ読むだけなので、
+# 書き出しのメモリは履歴の長さに依存しない。レコードは追記順に時刻が並んでいるものとして扱う。
+# ある時刻の残高は、その時刻以前の一番新しいアーカイブのスナップショットを mmap し、
+# それ以降のセグメントだけをリプレイして作る（最初からは読まない）。
+# verify は Bot が起動時に読む「今のスナップショット + ログ」と、アーカイブから作り直した残高を突き合わせ、
+# あわせて各レコードが「前の残高 + 増減 = 変更後の残高」になっているかを確かめる。
+
+BALANCE_SNAPSHOT_FILE = "velt_balances.snap"
+BALANCE_LOG_FILE = "velt_balances.log"
+ARCHIVE_DIR = os.getenv("VELT_ARCHIVE_DIR", "velt_archive")
+
+# verify で表示する食い違いの件数
+REPORT_LIMIT = 20
+
+
+class AuditError(Exception):
+    pass
+
+
+class LedgerFiles:
+    def __init__(self, directory=".", guild_id=None):
+        def path(name):
+            if guild_id is not None:
+                base, ext = os.path.splitext(name)
+                name = f"{base}_{guild_id}{ext}"
+            return os.path.join(directory, name)
+
+        self.snapshot = path(BALANCE_SNAPSHOT_FILE)
+        self.log = path(BALANCE_LOG_FILE)
+        self.rotated = self.log + ".1"
+        self.archive = path(ARCHIVE_DIR)
+
+
+def parse_time(text):
+    try:
+        return int(float(text))
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {text}") from None
+
+
+def _first_time(path):
+    for rec in iter_log(path):
+        return rec["t"]
+    return None
+
+
+# アーカイブのセグメント（start_seq より後）と今のログのレコードを古い順に返す
+# since を渡すと、それより前のレコードしかないセグメントは開かない
+def iter_records(files, start_seq=0, since=None):
+    segments = [(seq, path) for seq, path in list_archive(files.archive)[0] if seq > start_seq]
+    if since is not None and segments:
+        # 次のセグメントの先頭が since より前なら、そのセグメントは丸ごと飛ばせる
+        starts = [_first_time(path) for _, path in segments]
+        starts = [since if t is None else t for t in starts]
+        skip = max(bisect.bisect_left(starts, since) - 1, 0)
+        segments = segments[skip:]
+    for _, path in segments:
+        yield from iter_log(path)
+    for path in (files.rotated, files.log):
+        yield from iter_log(path)
+
+
+# at 以前の一番新しいアーカイブのスナップショット (番号, path)。空の状態から始めるなら (0, None)
+def base_snapshot(files, at=None, earliest=False):
+    segments, snapshots = list_archive(files.archive)
+    # アーカイブが最初のセグメントから揃っていれば（まだ何もなければ）空の状態からリプレイできる
+    if segments or snapshots:
+        from_empty = segments and segments[0][0] == 1 and not any(seq == 0 for seq, _, _ in snapshots)
+    else:
+        from_empty = not os.path.exists(files.snapshot)
+    if from_empty and earliest:
+        return 0, None
+    usable = [(seq, path) for seq, taken_at, path in snapshots if at is None or taken_at <= at]
+    if usable:
+        return usable[0] if earliest else usable[-1]
+    if not from_empty:
+        raise AuditError("この時刻より前の残高はアーカイブに残っていません")
+    return 0, None
+
+
+class Replay:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.overlay = {}
+        self.zero_base = False
+        self.records = 0
+        # 前の残高 + 増減 が変更後の残高と合わないレコード
+        self.breaks = []
+
+    def balance(self, user_id):
+        balance = self.overlay.get(user_id)
+        if balance is not None:
+            return balance
+        return 0 if self.zero_base else self.snapshot.get(user_id, 0)
+
+    def apply(self, rec):
+        self.records += 1
+        if rec.get("r"):
+            self.overlay.clear()
+            self.zero_base = True
+            return
+        user_id = int(rec["u"])
+        if self.balance(user_id) + rec["d"] != rec["b"]:
+            self.breaks.append(rec)
+        self.overlay[user_id] = rec["b"]
+
+    def run(self, records, until=None):
+        for rec in records:
+            if until is not None and rec["t"] > until:
+                break
+            self.apply(rec)
+        return self
+
+    # (ユーザーIDの配列, 残高の配列)（ユーザーID順）
+    def result(self):
+        return snapshot_format.merge(self.snapshot, self.overlay, self.zero_base)
+
+
+# at 時点の残高を、一番近いアーカイブのスナップショットから作り直す
+def reconstruct(files, at=None, earliest=False):
+    seq, path = base_snapshot(files, at, earliest)
+    snapshot = BalanceSnapshot.open(path) if path else BalanceSnapshot()
+    return Replay(snapshot).run(iter_records(files, seq), at)
+
+
+# Bot が起動時に読むのと同じ、今のスナップショット + 退避中・追記中のログ
+def live(files):
+    replay = Replay(BalanceSnapshot.open(files.snapshot))
+    for path in (files.rotated, files.log):
+        replay.run(iter_log(path))
+    return replay
+
+
+# ユーザーID順の2つの残高を突き合わせ、(ユーザーID, 左, 右) を返す（ないほうは0）
+def diff_balances(left, right):
+    left_ids, left_balances = left
+    right_ids, right_balances = right
+    i = j = 0
+    while i < len(left_ids) or j < len(right_ids):
+        if j >= len(right_ids) or (i < len(left_ids) and left_ids[i] < right_ids[j]):
+            user_id, a, b = left_ids[i], left_balances[i], 0
+            i += 1
+        elif i >= len(left_ids) or right_ids[j] < left_ids[i]:
+            user_id, a, b = right_ids[j], 0, right_balances[j]
+            j += 1
+        else:
+            user_id, a, b = left_ids[i], left_balances[i], right_balances[j]
+            i += 1
+            j += 1
+        if a != b:
+            yield user_id, a, b
+
+
+def format_time(t):
+    return datetime.fromtimestamp(t).astimezone().isoformat()
+
+
+def export_rows(files, since=None, until=None, user_id=None):
+    for rec in iter_records(files, since=since):
+        t = rec["t"]
+        if since is not None and t < since:
+            continue
+        if until is not None and t > until:
+            return
+        if rec.get("r"):
+            if user_id is None:
+                yield {"time": format_time(t), "unix": t, "user": "", "delta": "", "balance": 0,
+                       "kind": "リセット", "counterparty": ""}
+            continue
+        if user_id is not None and rec["u"] != user_id:
+            continue
+        yield {
+            "time": format_time(t), "unix": t, "user": rec["u"], "delta": rec["d"], "balance": rec["b"],
+            "kind": history.KIND_LABELS.get(rec.get("k", history.KIND_OTHER), history.KIND_LABELS[history.KIND_OTHER]),
+            "counterparty": rec.get("c", ""),
+        }
+
+
+def cmd_export(args, files, out):
+    rows = export_rows(files, args.since, args.until, args.user)
+    count = 0
+    if args.format == "jsonl":
+        for row in rows:
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+    else:
+        writer = csv.DictWriter(out, fieldnames=["time", "unix", "user", "delta", "balance", "kind", "counterparty"])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    print(f"exported {count} records", file=sys.stderr)
+    return 0
+
+
+def cmd_balances(args, files, out):
+    replay = reconstruct(files, args.at)
+    ids, balances = replay.result()
+    writer = csv.writer(out)
+    writer.writerow(["user", "balance"])
+    holders = 0
+    for user_id, balance in zip(ids, balances):
+        # 0 の人は書かない
+        if balance:
+            writer.writerow([user_id, balance])
+            holders += 1
+    print(f"replayed {replay.records} records, {holders} holders", file=sys.stderr)
+    return 0
+
+
+def cmd_verify(args, files, out):
+    rebuilt = reconstruct(files, earliest=args.full)
+    current = live(files)
+    diffs = list(diff_balances(current.result(), rebuilt.result()))
+    out.write(f"replayed {rebuilt.records} records from the archive, {current.records} from the live log\n")
+    for rec in rebuilt.breaks[:REPORT_LIMIT]:
+        out.write(f"chain break at {format_time(rec['t'])}: user {rec['u']} delta {rec['d']} balance {rec['b']}\n")
+    for user_id, balance, expected in diffs[:REPORT_LIMIT]:
+        out.write(f"mismatch: user {user_id} live {balance} replayed {expected}\n")
+    out.write(f"{len(rebuilt.breaks)} chain breaks, {len(diffs)} mismatches\n")
+    return 1 if rebuilt.breaks or diffs else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="velt の残高ログの監査")
+    parser.add_argument("--dir", default=".", help="Bot のデータファイルがあるディレクトリ")
+    parser.add_argument("--guild", type=int, default=None, help="既定以外のサーバーのID")
+    parser.add_argument("-o", "--output", default=None, help="出力先（既定は標準出力）")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="残高の変更を CSV / JSONL に書き出す")
+    export.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export.add_argument("--since", type=parse_time, default=None)
+    export.add_argument("--until", type=parse_time, default=None)
+    export.add_argument("--user", default=None, help="このユーザーIDの変更だけ")
+    balances = commands.add_parser("balances", help="ある時刻の全員の残高を作り直す")
+    balances.add_argument("--at", type=parse_time, default=None, help="既定は最新")
+    verify = commands.add_parser("verify", help="今の残高とアーカイブから作り直した残高を突き合わせる")
+    verify.add_argument("--full", action="store_true", help="一番古いスナップショットからリプレイする")
+    args = parser.parse_args()
+
+    files = LedgerFiles(args.dir, args.guild)
+    handler = {"export": cmd_export, "balances": cmd_balances, "verify": cmd_verify}[args.command]
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        return handler(args, files, out)
+    except AuditError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+# オフラインのベンチマーク
+#
+# Discord に接続せず、Interaction / Member / Role / チャンネルの偽物を使って
+# bot.py の本物のコマンド（送金・ロール発行・ゲーム3種・VC送金検知）を呼び出す。
+# 一時ディレクトリ（--workdir）で bot.py を import するので、実際のデータには触らない。
+# 使い方: python bench.py [--scenario transfer|burst|role|slot|chinchiro|blackjack|deposit|balance|all]
+#                         [--accounts 100000] [--ops 10000] [--concurrency 64] [--storage json|sqlite|shared]
+# 永続化やロックの変更の前後で同じ引数で実行し、ops/sec・p50/p99・書き込みバイト数を比べる。
+
+SCENARIOS = ["transfer", "burst", "role", "slot", "chinchiro", "blackjack", "table", "deposit", "balance"]
+
+GUILD_ID = 1
+ADMIN_ID = 2
+CHANNEL_ID = 3
+LOG_CHANNEL_ID = 4
+FIRST_USER_ID = 10_000_000
+INITIAL_BALANCE = 1_000_000
+DISCORD_EPOCH_MS = 1420070400000
+
+_snowflake_seq = itertools.count()
+
+
+# 現在時刻を含む snowflake（処理済みメッセージの保持期間の判定に使われる）
+def next_snowflake():
+    return ((int(time.time() * 1000) - DISCORD_EPOCH_MS) << 22) | (next(_snowflake_seq) & 0x3FFFFF)
+
+
+# --- Discord の偽物 ---
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = []
+        self.roles = {}
+        self.channels = {}
+        self._members = {}
+
+    def add_member(self, member):
+        self.members.append(member)
+        self._members[member.id] = member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, name=None, bot=False):
+        self.id = member_id
+        self.guild = guild
+        self.name = name or f"user{member_id}"
+        self.display_name = self.name
+        self.global_name = None
+        self.nick = None
+        self.bot = bot
+        self.mention = f"<@{member_id}>"
+
+
+class FakeRole:
+    def __init__(self, role_id, name, members):
+        self.id = role_id
+        self.name = name
+        self.members = members
+        self.mention = f"<@&{role_id}>"
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, author=None, embeds=()):
+        self.id = next_snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content or ""
+        self.author = author
+        self.embeds = list(embeds)
+
+    async def edit(self, **kwargs):
+        if kwargs.get("content") is not None:
+            self.content = kwargs["content"]
+        return self
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+        guild.channels[channel_id] = self
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content)
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+        self.content = None
+
+    def is_done(self):
+        return self.done
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+        self.content = content
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def edit_message(self, **kwargs):
+        self.done = True
+
+
+class FakeInteraction:
+    def __init__(self, user, channel, message=None):
+        self.user = user
+        self.channel = channel
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.message = message
+        self.command = None
+        self.extras = {}
+        self.response = FakeResponse()
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+
+# bot.py の演出の待ち時間をなくす（送信キューの速度制限は別途外す）
+class _InstantAsyncio:
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    @staticmethod
+    async def sleep(delay, result=None):
+        await asyncio.sleep(0)
+        return result
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+# /proc/self/io の wchar（このプロセスが write したバイト数、ワーカースレッドを含む）
+def bytes_written():
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def disk_usage(path):
+    total = 0
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if os.path.isfile(full):
+            total += os.path.getsize(full)
+    return total
+
+
+class Harness:
+    def __init__(self, velt, accounts, role_members, rng, table_players=100):
+        self.velt = velt
+        self.table_players = table_players
+        self.rng = rng
+        self.guild = FakeGuild(velt.GUILD_ID)
+        self.channel = FakeChannel(CHANNEL_ID, self.guild)
+        self.log_channel = FakeChannel(velt.VELT_LOG_CHANNEL_ID, self.guild)
+        self.vc_channel = FakeChannel(velt.VIRTUAL_CRYPTO_CHANNEL_ID, self.guild)
+        self.vc_bot = FakeMember(FIRST_USER_ID - 1, self.guild, "VirtualCrypto", bot=True)
+        self.admin = FakeMember(ADMIN_ID, self.guild, "admin")
+        self.guild.add_member(self.admin)
+        self.users = []
+        for i in range(accounts):
+            member = FakeMember(FIRST_USER_ID + i, self.guild)
+            self.guild.add_member(member)
+            self.users.append(member)
+        self.role = FakeRole(5, "bench", self.users[:role_members])
+        self.guild.roles[self.role.id] = self.role
+        if ADMIN_ID not in velt.VELT_ADMIN_IDS:
+            velt.VELT_ADMIN_IDS.append(ADMIN_ID)
+        velt.bot.get_channel = self.guild.get_channel
+        velt.asyncio = _InstantAsyncio()
+        velt.animation.asyncio = _InstantAsyncio()
+        velt.outbound.rate = 1e9
+        velt.outbound.burst = 1e9
+        # 同じユーザーが続けて賭けるので流量制限は外す
+        velt.command_throttle = velt.CommandThrottle({})
+        velt.member_index.build(self.guild)
+
+    async def seed(self):
+        velt = self.velt
+        self.economy = velt.economy_for(velt.GUILD_ID)
+        await self.economy.engine.credit_many(
+            [(member.id, INITIAL_BALANCE - velt.get_balance(velt.GUILD_ID, member.id)) for member in self.users],
+            velt.history.KIND_ISSUE,
+        )
+        await self.durable()
+
+    async def durable(self):
+        velt = self.velt
+        await velt.animator.drain()
+        await self.economy.store.wait_durable()
+        await self.economy.history.wait_durable()
+        await velt.processed_messages.wait_durable()
+        await velt.game_sessions.wait_durable()
+
+    def interaction(self, user, message=None):
+        return FakeInteraction(user, self.channel, message)
+
+    def pick(self, count=2, pool=None):
+        return self.rng.sample(pool or self.users, count)
+
+    # --- 1回分の操作 ---
+    async def transfer(self, pool=None):
+        sender, receiver = self.pick(2, pool)
+        await self.velt.送金.callback(self.interaction(sender), receiver, self.rng.randint(1, 100))
+
+    async def role_issue(self):
+        await self.velt.ロール発行.callback(self.interaction(self.admin), self.role)
+
+    async def slot(self):
+        user = self.rng.choice(self.users)
+        await self.velt.SlotView(user.id).handle_bet(self.interaction(user), 1000)
+
+    async def chinchiro(self):
+        user = self.rng.choice(self.users)
+        await self.velt.ChinchiroView(user.id).handle_bet(self.interaction(user), 1000)
+
+    async def blackjack(self):
+        velt = self.velt
+        user = self.rng.choice(self.users)
+        await velt.BlackjackGameView(user.id).start_game(self.interaction(user), 1000)
+        # 直前に作られたこのユーザーのセッションのメッセージでスタンドする
+        session = next(s for s in velt.game_sessions.in_state(velt.STATE_PLAYER) if s.user_id == user.id)
+        message = self.channel.get_partial_message(session.message_id)
+        await velt.blackjack_table_view.stand_btn.callback(self.interaction(user, message))
+
+    # テーブル1回分（table_players 人が参加ボタンを押し、1回の勝負でまとめて精算する）
+    async def table(self):
+        velt = self.velt
+        panel = await self.channel.send()
+        session = velt.TableSession(panel.id, self.channel.id, self.guild.id, "chinchiro")
+        velt.game_sessions.put(session)
+        for user in self.pick(min(self.table_players, len(self.users))):
+            await velt.table_join_view.join(self.interaction(user, panel), 1000)
+        session.state = velt.STATE_DEALER
+        await velt.play_chinchiro_table(self.channel, session)
+
+    async def deposit(self):
+        velt = self.velt
+        user = self.rng.choice(self.users)
+        content = f"<@{user.id}>から<@{velt.TARGET_USER_ID}>へ**{self.rng.randint(1, 1000)}** `velt`送金されました。"
+        await velt.on_message(FakeMessage(self.vc_channel, content, author=self.vc_bot))
+
+    async def balance(self):
+        user = self.rng.choice(self.users)
+        await self.velt.残高確認.callback(self.interaction(user))
+
+
+# ops 個の操作を最大 concurrency 個ずつ同時に実行し、1件ごとの処理時間を返す
+async def run_ops(make_op, ops, concurrency):
+    latencies = []
+    remaining = iter(range(ops))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            await make_op()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, ops))))
+    return latencies
+
+
+# 少数の人に集中した送金を burst 件ずつ一斉に投げる
+async def run_bursts(harness, ops, burst, hot_users):
+    pool = harness.users[:hot_users]
+    latencies = []
+
+    async def timed():
+        start = time.perf_counter()
+        await harness.transfer(pool)
+        latencies.append(time.perf_counter() - start)
+
+    done = 0
+    while done < ops:
+        n = min(burst, ops - done)
+        await asyncio.gather(*(timed() for _ in range(n)))
+        done += n
+    return latencies
+
+
+async def run_scenario(harness, name, args):
+    if name == "transfer":
+        return await run_ops(harness.transfer, args.ops, args.concurrency)
+    if name == "burst":
+        return await run_bursts(harness, args.ops, args.burst, args.hot_users)
+    if name == "table":
+        return await run_ops(harness.table, args.table_rounds, 1)
+    if name == "role":
+        settings = harness.velt.load_role_settings(harness.guild.id)
+        settings[str(harness.role.id)] = {"name": harness.role.name, "amount": 100}
+        await harness.velt.save_role_settings(harness.guild.id, settings)
+        return await run_ops(harness.role_issue, args.role_rounds, 1)
+    op = getattr(harness, name)
+    return await run_ops(op, args.ops, args.concurrency)
+
+
+def report(name, latencies, elapsed, written, grown):
+    latencies.sort()
+    ops = len(latencies)
+    line = (
+        f"{name:<10} ops={ops:<7,} {ops / elapsed:>10,.0f} ops/sec  "
+        f"p50={_percentile(latencies, 0.5) * 1000:8.3f}ms  p99={_percentile(latencies, 0.99) * 1000:8.3f}ms"
+    )
+    if written is not None:
+        line += f"  written={written / 1024:,.0f}KiB"
+    line += f"  disk={grown / 1024:+,.0f}KiB"
+    print(line)
+
+
+async def run(velt, args):
+    rng = random.Random(args.seed)
+    harness = Harness(velt, args.accounts, min(args.role_members, args.accounts), rng, args.table_players)
+    start = time.perf_counter()
+    await harness.seed()
+    print(f"seeded {args.accounts:,} accounts in {time.perf_counter() - start:.2f}s (storage={velt.STORAGE_BACKEND})")
+
+    for name in SCENARIOS if args.scenario == "all" else [args.scenario]:
+        before_written = bytes_written()
+        before_disk = disk_usage(".")
+        start = time.perf_counter()
+        latencies = await run_scenario(harness, name, args)
+        # 書き込みが終わるまでを含めて計る
+        await harness.durable()
+        elapsed = time.perf_counter() - start
+        after_written = bytes_written()
+        written = after_written - before_written if before_written is not None else None
+        report(name, latencies, elapsed, written, disk_usage(".") - before_disk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="velt Bot のオフラインベンチマーク")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--accounts", type=int, default=100_000)
+    parser.add_argument("--ops", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--burst", type=int, default=500, help="burst で一斉に投げる送金の数")
+    parser.add_argument("--hot-users", type=int, default=16, help="burst で送金が集中する人数")
+    parser.add_argument("--role-members", type=int, default=10_000)
+    parser.add_argument("--role-rounds", type=int, default=5)
+    parser.add_argument("--table-players", type=int, default=100, help="table で1回の勝負に参加する人数")
+    parser.add_argument("--table-rounds", type=int, default=20)
+    parser.add_argument("--storage", choices=["json", "sqlite", "shared"], default="json")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workdir", default=None, help="データを置くディレクトリ（既定は一時ディレクトリ）")
+    args = parser.parse_args()
+
+    # bot.py は import 時に環境変数とカレントディレクトリのデータファイルを読むので、先に整えておく
+    workdir = args.workdir or tempfile.mkdtemp(prefix="velt-bench-")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    os.environ["GUILD_ID"] = str(GUILD_ID)
+    os.environ["VELT_LOG_CHANNEL_ID"] = str(LOG_CHANNEL_ID)
+    os.environ["VELT_STORAGE"] = args.storage
+    os.environ.setdefault("VELT_LOG_LEVEL", "WARNING")
+    print(f"workdir: {workdir}")
+    velt = importlib.import_module("bot")
+    asyncio.run(run(velt, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,101 +3,392 @@ from discord.ext import commands
 from discord import app_commands
 import os
 from dotenv import load_dotenv
-import random
 import asyncio
-import json
 import re
+import atexit
+import logging
+import time
+from storage import open_store
+from engine import BalanceEngine, Escrow
+from guilds import GuildConfig, GuildConfigStore, GuildEconomy, command_hash
+from member_index import MemberIndex
+from leaderboard import Leaderboard
+import history
+from history import TransactionHistory
+from deposits import ProcessedMessages
+from economy import EconomyStats
+from sessions import SessionStore, BlackjackSession, TableSession, STATE_BETTING, STATE_PLAYER, STATE_DEALER, STATE_SETTLING
+import games
+import animation
+from animation import Animator, AnimationSettings
+from role_schedule import RoleSchedule, INTERVALS, INTERVAL_LABELS, periods_due, next_due
+from outbound import OutboundScheduler, join_lines
+import metrics
+from throttle import CommandThrottle, parse_budget
+from outcomes import OutcomeService
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
-GUILD_ID = int(os.getenv("GUILD_ID"))
+# 最初から使っているサーバー。このサーバーのデータは従来どおりのファイル名のまま使う
+GUILD_ID = int(os.getenv("GUILD_ID", "0"))
+# すべてのサーバーで管理者として扱うユーザー（サーバーごとの管理者は /サーバー設定 で追加する）
 VELT_ADMIN_IDS = [int(x) for x in os.getenv("VELT_ADMIN_IDS", "").split(",") if x]
-VELT_LOG_CHANNEL_ID = int(os.getenv("VELT_LOG_CHANNEL_ID"))
+VELT_LOG_CHANNEL_ID = int(os.getenv("VELT_LOG_CHANNEL_ID", "0"))
+# ログの出力レベル（DEBUG にすると受信メッセージの本文も出る）
+LOG_LEVEL = getattr(logging, os.getenv("VELT_LOG_LEVEL", "INFO").upper(), logging.INFO)
+# /metrics を公開するローカルのポート（未設定なら公開しない）
+METRICS_PORT = int(os.getenv("VELT_METRICS_PORT", "0"))
+log = logging.getLogger("velt")
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True  # ←これを追加
-bot = commands.Bot(command_prefix="!", intents=intents)
+# VELT_SHARDED=1 で AutoShardedBot を使う。VELT_SHARD_IDS（カンマ区切り）と VELT_SHARD_COUNT で
+# このプロセスが受け持つシャードを指定すれば、複数プロセスに分けて動かせる（VELT_STORAGE=shared と併用）
+SHARD_IDS = [int(x) for x in os.getenv("VELT_SHARD_IDS", "").split(",") if x]
+SHARD_COUNT = int(os.getenv("VELT_SHARD_COUNT", "0")) or None
+if os.getenv("VELT_SHARDED") == "1" or SHARD_IDS:
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=intents, shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 tree = bot.tree
+# チャンネルへの送信・編集はすべてこのキューを通す（レート制限対策）
+outbound = OutboundScheduler()
+# Discord API の呼び出し回数・時間と 429 を数える
+metrics.instrument_http(bot.http)
+metrics.instrument_discord_logging()
 
+# 旧形式の残高スナップショット（残高は velt_balances.snap に移し、これは初回起動時の変換にだけ使う）
 BALANCE_FILE = "velt_balances.json"
+# 残高の変更を1件ずつ追記するログ（起動時にスナップショットの上へリプレイ）
+BALANCE_LOG_FILE = "velt_balances.log"
+# スナップショット済みのログと一部のスナップショットを残すディレクトリ（audit.py で監査する）。空なら残さない
+ARCHIVE_DIR = os.getenv("VELT_ARCHIVE_DIR", "velt_archive")
 # ロール設定を保存するファイル
 ROLE_SETTINGS_FILE = "role_settings.json"
-
-# メモリ上の簡易DB（本番はDB推奨）
-velt_balances = {}
-
-# 残高をファイルから読み込む
+# 保存先: json（既定）、sqlite、または shared（複数プロセスで1つの SQLite を共有）
+STORAGE_BACKEND = os.getenv("VELT_STORAGE", "json")
+DB_FILE = os.getenv("VELT_DB_FILE", "velt.db")
+# 複数プロセスで動かすときのプロセス名。プロセスごとに持つファイル（履歴・処理済みメッセージ）の名前に付ける
+WORKER_ID = os.getenv("VELT_WORKER_ID", "")
+
+def local_file(name):
+    if not WORKER_ID:
+        return name
+    base, ext = os.path.splitext(name)
+    return f"{base}.{WORKER_ID}{ext}"
+
+# サーバーごとのファイル名（既定のサーバーは従来のまま、それ以外は _<サーバーID> を付ける）
+def guild_file(guild_id, name):
+    if guild_id == GUILD_ID:
+        return name
+    base, ext = os.path.splitext(name)
+    return f"{base}_{guild_id}{ext}"
+
+# ユーザーごとの取引履歴（固定長レコードの追記ファイル）
+HISTORY_FILE = "velt_history.bin"
+# 経済全体の集計（総供給量・種類ごとの流入/流出・分布）。残高の変更ごとに差分で更新する
+ECONOMY_FILE = "velt_economy.json"
+
+# ロールの定期発行のスケジュール。全サーバーのロールを1つの heap に (サーバーID, ロールID) で積む
+# サーバーの経済を読み込んだときに保存済みのロールを積む（後から使われたサーバーも含む）
+role_schedule = RoleSchedule()
+role_schedule_changed = asyncio.Event()
+
+def reschedule_role(guild_id, role_id, data):
+    key = (guild_id, role_id)
+    if data is None:
+        role_schedule.remove(key)
+    else:
+        role_schedule.update(key, data)
+    role_schedule_changed.set()
+
+# サーバーごとの経済（残高・ランキング・履歴・集計）。最初に使われたときに読み込む
+economies = {}
+
+def economy_for(guild_id):
+    economy = economies.get(guild_id)
+    if economy is None:
+        store = open_store(
+            STORAGE_BACKEND, guild_file(guild_id, BALANCE_FILE), guild_file(guild_id, BALANCE_LOG_FILE),
+            guild_file(guild_id, ROLE_SETTINGS_FILE), guild_file(guild_id, DB_FILE),
+            archive_dir=guild_file(guild_id, ARCHIVE_DIR) if ARCHIVE_DIR else None,
+        )
+        economy = GuildEconomy(
+            guild_id, store,
+            # 残高チェックと増減をユーザー単位のロックでまとめて行う（ゲーム・送金用）
+            BalanceEngine(store),
+            # 残高ランキング（残高が変わるたびにストアから差分で更新される）
+            Leaderboard(),
+            TransactionHistory(local_file(guild_file(guild_id, HISTORY_FILE))),
+            EconomyStats(local_file(guild_file(guild_id, ECONOMY_FILE))),
+        )
+        economy.load()
+        atexit.register(economy.close)
+        economies[guild_id] = economy
+        for role_id, data in store.load_role_settings().items():
+            reschedule_role(guild_id, role_id, data)
+    return economy
+
+# サーバーごとの設定（管理者・ログチャンネル・VirtualCrypto のチャンネルと入金先・コマンドの同期状態）
+GUILD_CONFIG_FILE = "guild_configs.json"
+# 既定のサーバーの VirtualCrypto 送金検知（設定ファイルにまだなければこれを使う）
+VIRTUAL_CRYPTO_CHANNEL_ID = 1397899059146264637
+TARGET_USER_ID = 1359906761833713906  # ← ここを小煩悩のユーザーIDに変更
+TARGET_USERNAME = "小煩悩"  # ← ここも小煩悩に変更
+guild_configs = GuildConfigStore(GUILD_CONFIG_FILE, defaults=[
+    GuildConfig(
+        GUILD_ID, log_channel_id=VELT_LOG_CHANNEL_ID, crypto_channel_id=VIRTUAL_CRYPTO_CHANNEL_ID,
+        target_user_id=TARGET_USER_ID, target_username=TARGET_USERNAME,
+    ),
+])
+# 進行中のゲーム（再起動しても続きから遊べる）
+SESSION_FILE = local_file("velt_sessions.db")
+game_sessions = SessionStore(SESSION_FILE)
+# ゲームの乱数（期間ごとのシードのハッシュを先に公開し、期間が終わったらシードを公開する）
+OUTCOMES_FILE = local_file("velt_fairness.json")
+game_outcomes = OutcomeService(OUTCOMES_FILE, epoch_seconds=int(os.getenv("VELT_FAIRNESS_EPOCH", "3600")))
+# ゲームの演出（チャンネル・サーバーごとのモード。負荷が高いときは自動で短くする）
+ANIMATION_SETTINGS_FILE = "animation_settings.json"
+animation_settings = AnimationSettings(ANIMATION_SETTINGS_FILE, os.getenv("VELT_ANIMATION_MODE", animation.MODE_FULL))
+animator = Animator(
+    outbound, animation_settings,
+    reduced_at=int(os.getenv("VELT_ANIMATION_REDUCED_AT", "20")),
+    instant_at=int(os.getenv("VELT_ANIMATION_INSTANT_AT", "100")),
+)
+
+# 設定と既定のサーバーの残高を読み込む（他のサーバーは使われたときに読む）
 def load_balances():
-    global velt_balances
-    try:
-        with open(BALANCE_FILE, "r", encoding="utf-8") as f:
-            velt_balances.update(json.load(f))
-    except FileNotFoundError:
-        pass
-
-# 残高をファイルに保存する
-def save_balances():
-    with open(BALANCE_FILE, "w", encoding="utf-8") as f:
-        json.dump(velt_balances, f, ensure_ascii=False)
-
-# 残高操作関数を修正
-def set_balance(user_id, amount):
-    velt_balances[str(user_id)] = amount
-    save_balances()
+    guild_configs.load()
+    atexit.register(guild_configs.close)
+    economy_for(GUILD_ID)
+    game_sessions.load()
+    atexit.register(game_sessions.close)
+    game_outcomes.load()
+    atexit.register(game_outcomes.close)
+    animation_settings.load()
+    atexit.register(animation_settings.close)
+
+# 共有ストアでは他のプロセスの変更が observer に届かないので、ランキングと経済統計を定期的に作り直す
+LEADERBOARD_REFRESH_INTERVAL = 60
+leaderboard_refresh_task = None
+
+async def refresh_leaderboard():
+    while True:
+        await asyncio.sleep(LEADERBOARD_REFRESH_INTERVAL)
+        for economy in list(economies.values()):
+            try:
+                economy.refresh()
+            except Exception:
+                log.exception("Failed to refresh leaderboard of guild %s", economy.guild_id)
+
+# 残高操作関数（保存はストレージ側で1件ずつ行う。書き込みは store.run を通す）
+# kind は変更の種類（history.KIND_*）、counterparty は相手のユーザーID（履歴用）
+async def set_balance(guild_id, user_id, amount, kind=history.KIND_OTHER):
+    store = economy_for(guild_id).store
+    await store.run(store.set, user_id, amount, kind)
+
+async def add_balance(guild_id, user_id, amount, kind=history.KIND_OTHER, counterparty=None):
+    return await economy_for(guild_id).engine.credit(user_id, amount, kind, counterparty)
+
+def get_balance(guild_id, user_id):
+    return economy_for(guild_id).store.get(user_id)
+
+def is_admin(user: discord.User, guild_id):
+    return user.id in VELT_ADMIN_IDS or user.id in guild_configs.get(guild_id).admin_ids
+
+def log_channel_for(guild_id):
+    channel_id = guild_configs.get(guild_id).log_channel_id
+    return bot.get_channel(channel_id) if channel_id else None
+
+# セッションを始めたサーバーの経済（複数サーバー対応前のセッションは既定のサーバー）
+def session_economy(session):
+    return economy_for(session.guild_id or GUILD_ID)
+
+# --- 計測 ---
+metrics_task = None
+
+metrics.Gauge("velt_outbound_queue_depth", "送信キューに溜まっている送信・編集の数", fn=lambda: outbound.queue_depth())
+metrics.Gauge(
+    "velt_persist_queue_depth", "ディスクへの書き込み待ちの件数", ["store"],
+    fn=lambda: {
+        ("balances",): sum(economy.store.pending() for economy in list(economies.values())),
+        ("history",): sum(economy.history.pending() for economy in list(economies.values())),
+        ("sessions",): game_sessions.pending(),
+    },
+)
+metrics.Gauge("velt_game_sessions", "進行中のゲームセッション数", fn=lambda: len(game_sessions))
+metrics.Gauge("velt_animations_in_flight", "流している途中の演出の数", fn=lambda: animator.in_flight())
+metrics.Gauge("velt_guild_economies", "読み込み済みのサーバーの経済の数", fn=lambda: len(economies))
+
+# --- 流量制限 ---
+# 種類ごとに「ユーザー / サーバー」の上限を "1秒あたりの補充数/最大数" で指定する
+command_throttle = CommandThrottle({
+    "game": (
+        parse_budget(os.getenv("VELT_THROTTLE_GAME", "0.5/5")),
+        parse_budget(os.getenv("VELT_THROTTLE_GUILD_GAME", "20/100")),
+    ),
+    "transfer": (
+        parse_budget(os.getenv("VELT_THROTTLE_TRANSFER", "1/5")),
+        parse_budget(os.getenv("VELT_THROTTLE_GUILD_TRANSFER", "20/100")),
+    ),
+    "admin": (
+        parse_budget(os.getenv("VELT_THROTTLE_ADMIN", "0.2/5")),
+        parse_budget(os.getenv("VELT_THROTTLE_GUILD_ADMIN", "0.5/10")),
+    ),
+    "other": (
+        parse_budget(os.getenv("VELT_THROTTLE_OTHER", "1/10")),
+        None,
+    ),
+})
+# 書いていないコマンドは "other"。スロット・ちんちろ・ブラックジャックはパネルを出すだけなので、
+# 掛け金のボタンのほうで "game" を数える（reject_throttled）
+COMMAND_THROTTLE_CATEGORIES = {
+    "ちんちろテーブル": "game",
+    "ブラックジャックテーブル": "game",
+    "送金": "transfer",
+    "発行": "admin",
+    "減少": "admin",
+    "ロール発行": "admin",
+    "ロール設定": "admin",
+    "ロール設定削除": "admin",
+    "リセット": "admin",
+}
+metrics.Gauge("velt_throttle_buckets", "流量制限のバケット数", fn=lambda: len(command_throttle))
+
+# すべてのコマンドの前に呼ばれる。開始時刻を記録し（完了・エラーで処理時間をヒストグラムに入れる）、
+# 上限を超えていれば残高やファイルに触る前に本人だけに返して止める
+async def check_command(interaction: discord.Interaction):
+    interaction.extras["started"] = time.perf_counter()
+    command = interaction.command
+    if command is None:
+        return True
+    category = COMMAND_THROTTLE_CATEGORIES.get(command.qualified_name, "other")
+    return not await reject_throttled(interaction, category, command)
+
+tree.interaction_check = check_command
+
+# 上限を超えていれば本人だけに返して True。ボタン（掛け金・参加・ヒット）からも呼ぶ
+async def reject_throttled(interaction, category="game", command=None):
+    retry_after, scope = command_throttle.check(category, interaction.user.id, interaction.guild_id)
+    if not retry_after:
+        return False
+    metrics.THROTTLED.inc(category=category, scope=scope)
+    observe_command(interaction, command, "throttled")
+    who = "このサーバー全体で" if scope == "guild" else ""
+    await interaction.response.send_message(
+        f"{who}操作が多すぎます。{int(retry_after) + 1}秒ほど待ってからもう一度お試しください。", ephemeral=True
+    )
+    return True
 
-def add_balance(user_id, amount):
-    uid = str(user_id)
-    velt_balances[uid] = get_balance(user_id) + amount
-    save_balances()
+def observe_command(interaction, command, status):
+    started = interaction.extras.get("started")
+    if started is not None and command is not None:
+        metrics.COMMAND_SECONDS.observe(time.perf_counter() - started, command=command.qualified_name, status=status)
 
-def get_balance(user_id):
-    return velt_balances.get(str(user_id), 0)
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_command(interaction, command, "ok")
 
-def is_admin(user: discord.User):
-    return user.id in VELT_ADMIN_IDS
+@tree.error
+async def on_app_command_error(interaction: discord.Interaction, error):
+    observe_command(interaction, interaction.command, "error")
+    log.error("Ignoring exception in command %r", interaction.command and interaction.command.name, exc_info=error)
 
 # 1. 通貨発行
-@tree.command(name="発行", description="veltを発行（管理者のみ）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="発行", description="veltを発行（管理者のみ）")
 @app_commands.describe(user="発行先", amount="発行額")
 async def 発行(interaction: discord.Interaction, user: discord.Member, amount: int):
-    if not is_admin(interaction.user):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
-    add_balance(user.id, amount)
+    economy = economy_for(interaction.guild_id)
+    await add_balance(interaction.guild_id, user.id, amount, history.KIND_ISSUE, interaction.user.id)
+    await economy.store.wait_durable()
     await interaction.response.send_message(f"{user.mention} に {amount} velt 発行しました。", ephemeral=True)
     # ログ（コマンド実行チャンネルにのみ送信）
-    await interaction.channel.send(f"【発行】{interaction.user.mention} → {user.mention} : {amount} velt")
+    await outbound.send(interaction.channel, f"【発行】{interaction.user.mention} → {user.mention} : {amount} velt")
 
 # 2. 通貨減少
-@tree.command(name="減少", description="veltを減少（管理者のみ）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="減少", description="veltを減少（管理者のみ）")
 @app_commands.describe(user="対象ユーザー", amount="減少額")
 async def 減少(interaction: discord.Interaction, user: discord.Member, amount: int):
-    if not is_admin(interaction.user):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
-    add_balance(user.id, -amount)
+    economy = economy_for(interaction.guild_id)
+    await add_balance(interaction.guild_id, user.id, -amount, history.KIND_REVOKE, interaction.user.id)
+    await economy.store.wait_durable()
     await interaction.response.send_message(f"{user.mention} から {amount} velt 減少しました。", ephemeral=True)
     # ログ（コマンド実行チャンネルにのみ送信）
-    await interaction.channel.send(f"【減少】{interaction.user.mention} → {user.mention} : -{amount} velt")
+    await outbound.send(interaction.channel, f"【減少】{interaction.user.mention} → {user.mention} : -{amount} velt")
 
 # 3. 残高確認（管理者は他人の残高も確認可能）
-@tree.command(name="残高確認", description="velt残高を確認", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="残高確認", description="velt残高を確認")
 @app_commands.describe(user="確認したいユーザー")
 async def 残高確認(interaction: discord.Interaction, user: discord.Member = None):
     # 管理者は他人の残高も確認可能
     if user is None or user.id == interaction.user.id:
-        balance = get_balance(interaction.user.id)
+        balance = get_balance(interaction.guild_id, interaction.user.id)
         await interaction.response.send_message(f"あなたの残高: {balance} velt", ephemeral=True)
     else:
-        if not is_admin(interaction.user):
+        if not is_admin(interaction.user, interaction.guild_id):
             await interaction.response.send_message("他人の残高は確認できません。", ephemeral=True)
             return
-        balance = get_balance(user.id)
+        balance = get_balance(interaction.guild_id, user.id)
         await interaction.response.send_message(f"{user.mention} のvelt残高: {balance}", ephemeral=True)
 
+# ランキングの1ページあたりの件数
+RANKING_PAGE_SIZE = 10
+
+# 残高ランキング
+@tree.command(name="ランキング", description="velt残高のランキングを表示")
+@app_commands.describe(page="ページ番号")
+async def ランキング(interaction: discord.Interaction, page: int = 1):
+    leaderboard = economy_for(interaction.guild_id).leaderboard
+    total = len(leaderboard)
+    if total == 0:
+        await interaction.response.send_message("ランキングに載っているユーザーがいません。", ephemeral=True)
+        return
+    last_page = (total + RANKING_PAGE_SIZE - 1) // RANKING_PAGE_SIZE
+    page = min(max(page, 1), last_page)
+    offset = (page - 1) * RANKING_PAGE_SIZE
+    msg = f"**velt残高ランキング** ({page}/{last_page}ページ)\n"
+    for i, (user_id, balance) in enumerate(leaderboard.page(offset, RANKING_PAGE_SIZE), start=offset + 1):
+        msg += f"{i}. <@{user_id}>: {balance} velt\n"
+    rank = leaderboard.rank(interaction.user.id)
+    if rank is not None:
+        msg += f"\nあなたの順位: {rank}位 / {total}人（{get_balance(interaction.guild_id, interaction.user.id)} velt）"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+# 履歴の1ページあたりの件数
+HISTORY_PAGE_SIZE = 10
+
+# 取引履歴（管理者は他人の履歴も確認可能）
+@tree.command(name="履歴", description="veltの取引履歴を確認")
+@app_commands.describe(user="確認したいユーザー", page="ページ番号")
+async def 履歴(interaction: discord.Interaction, user: discord.Member = None, page: int = 1):
+    target = user or interaction.user
+    if target.id != interaction.user.id and not is_admin(interaction.user, interaction.guild_id):
+        await interaction.response.send_message("他人の履歴は確認できません。", ephemeral=True)
+        return
+    page = max(page, 1)
+    entries = economy_for(interaction.guild_id).history.recent(target.id, (page - 1) * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+    if not entries:
+        await interaction.response.send_message("履歴がありません。", ephemeral=True)
+        return
+    msg = f"**{target.display_name} の取引履歴** ({page}ページ)\n"
+    for entry in entries:
+        line = f"<t:{entry.timestamp}:f> {entry.label} {entry.delta:+} velt（残高 {entry.balance}）"
+        if entry.counterparty:
+            line += f" <@{entry.counterparty}>"
+        msg += line + "\n"
+    await interaction.response.send_message(msg, ephemeral=True)
+
 # 4. 送金
-@tree.command(name="送金", description="veltを送金", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="送金", description="veltを送金")
 @app_commands.describe(user="送金先", amount="送金額")
 async def 送金(interaction: discord.Interaction, user: discord.Member, amount: int):
     if user.id == interaction.user.id:
@@ -106,22 +397,26 @@ async def 送金(interaction: discord.Interaction, user: discord.Member, amount:
     if amount <= 0:
         await interaction.response.send_message("1以上の金額を指定してください。", ephemeral=True)
         return
-    if get_balance(interaction.user.id) < amount:
+    economy = economy_for(interaction.guild_id)
+    if not await economy.engine.transfer(interaction.user.id, user.id, amount, history.KIND_TRANSFER):
         await interaction.response.send_message("残高が足りません。", ephemeral=True)
         return
-    add_balance(interaction.user.id, -amount)
-    add_balance(user.id, amount)
+    # ディスクに書き込まれてから送金完了を返す
+    await economy.store.wait_durable()
     await interaction.response.send_message(f"{user.mention} に {amount} velt 送金しました。", ephemeral=True)
     # 追加: 送金チャンネルにも通知
-    await interaction.channel.send(
+    await outbound.send(
+        interaction.channel,
         f"{interaction.user.mention} から {user.mention} へ {amount} velt 送金されました。"
     )
     # ログ
-    log_channel = interaction.guild.get_channel(VELT_LOG_CHANNEL_ID)
+    log_channel = log_channel_for(interaction.guild_id)
     if log_channel:
-        await log_channel.send(
-            f"【送金】{interaction.user.mention} → {user.mention} : {amount} velt"
-        )
+        outbound.log(log_channel, f"【送金】{interaction.user.mention} → {user.mention} : {amount} velt")
+
+# 結果に添える乱数の位置（期間のシードが公開されたら /公平性 で検証できる）
+def outcome_footer(ref):
+    return f"\n-# 🔐 {ref}"
 
 # --- スロット ---
 class SlotView(discord.ui.View):
@@ -145,39 +440,32 @@ class SlotView(discord.ui.View):
         if interaction.user.id != self.user_id:
             await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
             return
-        if get_balance(self.user_id) < bet:
+        if await reject_throttled(interaction):
+            return
+        # 掛け金は先に預かり、結果が出たら精算する
+        escrow = await economy_for(interaction.guild_id).engine.reserve(self.user_id, bet, history.KIND_SLOT)
+        if escrow is None:
             await interaction.response.send_message("残高が足りません。", ephemeral=True)
             return
 
-        # 絵柄を7種類に変更
-        symbols = ["🍒", "🍋", "🔔", "⭐", "7️⃣", "🍉", "🍇"]
-        # スロット演出
-        msg = await interaction.channel.send(f"{interaction.user.mention} 🎰 スロットを回しています...")
-        result = []
-        for i in range(3):
-            slot_now = [random.choice(symbols) for _ in range(3)]
-            await msg.edit(content=f"{interaction.user.mention} 🎰 {' '.join(slot_now)}")
-            await asyncio.sleep(0.5)
-            result.append(slot_now[i])
-        await asyncio.sleep(0.5)
-
-        # 判定
-        await_msg = f"{interaction.user.mention} 🎰 {' '.join(result)}\n"
-        if result[0] == result[1] == result[2]:
-            payout = bet * 10  # ★ 5倍→10倍に修正
-            add_balance(self.user_id, payout)
-            await_msg += f"🎉 大当たり！{payout} velt獲得！"
-        elif result[0] == result[1] or result[1] == result[2] or result[0] == result[2]:
-            payout = bet * 2
-            add_balance(self.user_id, payout)
-            await_msg += f"当たり！{payout} velt獲得！"
+        started = time.perf_counter()
+        # 結果（3回の回転の i 番目の絵柄）を先に決めて精算し、演出はあとから流す
+        rng, ref = game_outcomes.draw()
+        spins, result = games.slot_round(rng)
+        multiplier = games.slot_multiplier(result)
+        await escrow.settle(bet * multiplier)
+        if multiplier == 10:
+            result_text = f"🎉 大当たり！{bet * multiplier} velt獲得！"
+        elif multiplier > 0:
+            result_text = f"当たり！{bet * multiplier} velt獲得！"
         else:
-            add_balance(self.user_id, -bet)
-            await_msg += f"はずれ… {bet} velt失いました。"
+            result_text = f"はずれ… {bet} velt失いました。"
+        result_text += outcome_footer(ref)
 
-        await msg.edit(content=await_msg)
+        animator.play(interaction.channel, animation.slot_frames(interaction.user.mention, spins, result, result_text))
+        metrics.GAME_SECONDS.observe(time.perf_counter() - started, game="slot")
 
-@tree.command(name="スロット", description="veltでスロットを回す", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="スロット", description="veltでスロットを回す")
 async def スロット(interaction: discord.Interaction):
     view = SlotView(interaction.user.id)
     await interaction.response.send_message("掛け金を選んでください！", view=view, ephemeral=True)
@@ -204,108 +492,51 @@ class ChinchiroView(discord.ui.View):
         if interaction.user.id != self.user_id:
             await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
             return
-        if get_balance(self.user_id) < bet:
+        if await reject_throttled(interaction):
+            return
+        # 掛け金は先に預かり、結果が出たら精算する
+        escrow = await economy_for(interaction.guild_id).engine.reserve(self.user_id, bet, history.KIND_CHINCHIRO)
+        if escrow is None:
             await interaction.response.send_message("残高が足りません。", ephemeral=True)
             return
 
-        async def chinchiro_judge(dice):
-            dice = sorted(dice)
-            # ピンゾロ
-            if dice == [1, 1, 1]:
-                return ("ピンゾロ", 100)
-            # ゾロ目（2ゾロ～6ゾロ）
-            if dice[0] == dice[1] == dice[2]:
-                return (f"{dice[0]}ゾロ", 100 - dice[0])  # 数字が小さいほど強い
-            # シゴロ
-            if dice == [4, 5, 6]:
-                return ("シゴロ", 90)
-            # ヒフミ
-            if dice == [1, 2, 3]:
-                return ("ヒフミ", -10)
-            # 通常の目
-            if dice[0] == dice[1]:
-                return (f"{dice[2]}の目", dice[2])
-            if dice[1] == dice[2]:
-                return (f"{dice[0]}の目", dice[0])
-            # 役なし
-            return ("役なし", 0)
-
-        async def roll_until_yaku(name):
-            for i in range(1, 4):
-                roll_msg = await interaction.channel.send(f"{name} サイコロを振ります...（{i}回目）")
-                await asyncio.sleep(1)
-                dice = [random.randint(1, 6) for _ in range(3)]
-                yaku, score = await chinchiro_judge(dice)
-                await roll_msg.edit(content=f"{name} 🎲 {dice} → {yaku}")
-                await asyncio.sleep(0.5)
-                if yaku != "役なし":
-                    return dice, yaku, score, i
-            return dice, yaku, score, 3
-
-        # ユーザー
-        user_dice, user_yaku, user_score, user_try = await roll_until_yaku(interaction.user.mention)
-        # BOT
-        bot_dice, bot_yaku, bot_score, bot_try = await roll_until_yaku("BOT")
-
-        # 役の強さ比較
-        def yaku_rank(score):
-            if score >= 90: return score  # ピンゾロ・ゾロ目・シゴロ
-            if score > 0: return 10 + score  # 通常の目
-            if score == 0: return 0  # 役なし
-            if score == -10: return -10  # ヒフミ
-            return -100
-
-        user_rank = yaku_rank(user_score)
-        bot_rank = yaku_rank(bot_score)
+        started = time.perf_counter()
+        # 出目は先に全部決めて精算し、演出はあとから流す
+        rng, ref = game_outcomes.draw()
+        user_rolls, bot_rolls = games.chinchiro_round(rng)
+        user_dice, user_hand = user_rolls[-1]
+        bot_dice, bot_hand = bot_rolls[-1]
 
         msg = (
             f"🎲 {interaction.user.mention} のちんちろ！\n"
-            f"あなた: {user_dice} → {user_yaku}\n"
-            f"BOT: {bot_dice} → {bot_yaku}\n"
+            f"あなた: {user_dice} → {user_hand.yaku}\n"
+            f"BOT: {bot_dice} → {bot_hand.yaku}\n"
         )
 
-        # 勝敗判定
-        if user_rank > bot_rank:
-            # 勝ち
-            payout = bet * (user_score if user_score > 0 and user_score < 90 else 2)
-            if user_score >= 90:  # ピンゾロ・ゾロ目・シゴロ
-                if user_score == 100:
-                    payout = bet * 5
-                elif user_score >= 90:
-                    payout = bet * (5 if user_score == 100 else 3 if user_score == 99 else 2)
-            add_balance(interaction.user.id, payout)
+        # 勝敗判定（出目の表を引くだけ）
+        multiplier, result = games.chinchiro_settle(user_hand, bot_hand)
+        if result == "win":
+            payout = await escrow.settle(bet * multiplier)
             msg += f"🎉 勝ち！{payout} velt獲得！"
-        elif user_rank < bot_rank:
-            # 負け
-            if bot_score == -10:  # ヒフミ
-                loss = bet * 2
-                if get_balance(interaction.user.id) < loss:
-                    await interaction.response.send_message("ヒフミで2倍払う必要がありますが、残高が足りません。", ephemeral=True)
-                    return
-                add_balance(interaction.user.id, -loss)
+        elif result == "draw":
+            await escrow.refund()
+            msg += "🤝 引き分け！"
+        else:
+            # 掛け金を超える負け分は残高の範囲でだけ引き落とす
+            loss = -await escrow.settle(bet * multiplier)
+            if result == "hifumi":
                 msg += f"😢 ヒフミで負け… {loss} velt失いました。"
-            elif bot_score >= 90:
-                if bot_score == 100:
-                    loss = bet * 5
-                elif bot_score == 99:
-                    loss = bet * 3
-                else:
-                    loss = bet * 2
-                add_balance(interaction.user.id, -loss)
+            elif result == "zoro":
                 msg += f"😢 ゾロ目/シゴロで負け… {loss} velt失いました。"
-            elif bot_score > 0:
-                loss = bet * bot_score
-                add_balance(interaction.user.id, -loss)
-                msg += f"😢 負け… {loss} velt失いました。"
             else:
-                add_balance(interaction.user.id, -bet)
-                msg += f"😢 負け… {bet} velt失いました。"
-        else:
-            msg += "🤝 引き分け！"
+                msg += f"😢 負け… {loss} velt失いました。"
+        msg += outcome_footer(ref)
 
-        await interaction.channel.send(msg)
+        frames = animation.chinchiro_frames(interaction.user.mention, user_rolls) + animation.chinchiro_frames("BOT", bot_rolls)
+        animator.play(interaction.channel, frames + [(msg, 0.5)])
+        metrics.GAME_SECONDS.observe(time.perf_counter() - started, game="chinchiro")
 
-@tree.command(name="ちんちろ", description="veltでちんちろ勝負（BOT対戦）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="ちんちろ", description="veltでちんちろ勝負（BOT対戦）")
 async def ちんちろ(interaction: discord.Interaction):
     view = ChinchiroView(interaction.user.id)
     await interaction.response.send_message("掛け金を選んでください！", view=view, ephemeral=True)
@@ -332,263 +563,1047 @@ class BlackjackGameView(discord.ui.View):
         if interaction.user.id != self.user_id:
             await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
             return
-        if get_balance(self.user_id) < bet:
+        if await reject_throttled(interaction):
+            return
+        # 掛け金は先に預かり、勝負がついたら精算する
+        escrow = await economy_for(interaction.guild_id).engine.reserve(self.user_id, bet, history.KIND_BLACKJACK)
+        if escrow is None:
             await interaction.response.send_message("残高が足りません。", ephemeral=True)
             return
-        # 新しいViewでゲーム本体を開始
-        view = BlackjackPlayView(self.user_id, bet)
-        await interaction.response.edit_message(content="ゲーム開始！", view=None)
-        await view.show_state(interaction.channel, interaction.user)
+        # ゲームの状態はセッションとして保存し、ボタンは永続Viewで受ける
+        # 席のシードを取り出した位置を結果に添える（カードはその席のシードから引く）
+        rng, ref = game_outcomes.draw()
+        session = BlackjackSession.deal(interaction.channel.id, interaction.guild_id, self.user_id, bet, rng, ref)
+        try:
+            await interaction.response.edit_message(content="ゲーム開始！", view=None)
+            msg = await show_blackjack_state(interaction.channel, interaction.user.mention, session)
+        except Exception:
+            # セッションを保存する前に送れなかったら、預かった掛け金を返す
+            await escrow.refund()
+            raise
+        session.message_id = msg.id
+        game_sessions.put(session)
+
+def hand_str(cards):
+    return f"{cards}（合計: {sum(cards)}）"
+
+async def show_blackjack_state(channel, mention, session):
+    return await outbound.send(
+        channel,
+        f"{mention} の手札: {hand_str(session.player_cards)}\n"
+        f"BOTの手札: [{session.bot_cards[0]}, ?]\n"
+        "「もう一枚引く」か「スタンド」を選んでください。",
+        view=blackjack_table_view
+    )
 
-class BlackjackPlayView(discord.ui.View):
-    def __init__(self, user_id, bet):
-        super().__init__(timeout=60)
-        self.user_id = user_id
-        self.bet = bet
-        self.player_cards = [random.randint(1, 10), random.randint(1, 10)]
-        self.bot_cards = [random.randint(1, 10), random.randint(1, 10)]
-        self.finished = False
-
-    def hand_str(self, cards):
-        return f"{cards}（合計: {sum(cards)}）"
-
-    async def show_state(self, channel, user):
-        await channel.send(
-            f"{user.mention} の手札: {self.hand_str(self.player_cards)}\n"
-            f"BOTの手札: [{self.bot_cards[0]}, ?]\n"
-            "「もう一枚引く」か「スタンド」を選んでください。",
-            view=self
-        )
+# 進行中の全テーブルで共有する永続View（ボタンのメッセージIDからセッションを引く）
+class BlackjackTableView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    async def session_for(self, interaction):
+        session = game_sessions.get(interaction.message.id)
+        if session is None or session.state != STATE_PLAYER:
+            await interaction.response.send_message("このゲームは終了しています。", ephemeral=True)
+            return None
+        if interaction.user.id != session.user_id:
+            await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
+            return None
+        return session
 
-    @discord.ui.button(label="もう一枚引く", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="もう一枚引く", style=discord.ButtonStyle.primary, custom_id="velt:blackjack:hit")
     async def hit(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.user_id or self.finished:
-            await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
+        session = await self.session_for(interaction)
+        if session is None:
             return
-        # 演出
-        draw_msg = await interaction.channel.send(f"{interaction.user.mention} カードを引きます...")
-        await asyncio.sleep(1)
-        self.player_cards.append(random.randint(1, 10))
-        await draw_msg.edit(content=f"{interaction.user.mention} の手札: {self.hand_str(self.player_cards)}")
-        if sum(self.player_cards) > 21:
-            await self.finish(interaction)
+        # 状態は await の前に進めておく（連打や時間切れと混ざって二重に精算しない）
+        busted = session.hit(session.player_card())
+        game_sessions.put(session)
+        await interaction.response.defer()
+        # 引く演出は full のときだけ、次の手番を出す前に見せる（手札は次のメッセージにも出る）
+        if not busted and animator.mode_for(interaction.channel) == animation.MODE_FULL:
+            await animator.play(interaction.channel, [
+                (f"{interaction.user.mention} カードを引きます...", 0),
+                (f"{interaction.user.mention} の手札: {hand_str(session.player_cards)}", 1),
+            ], mode=animation.MODE_FULL)
+        if busted:
+            await finish_blackjack(interaction.channel, interaction.user.mention, session)
         else:
-            await self.show_state(interaction.channel, interaction.user)
-            await interaction.response.defer()
+            msg = await show_blackjack_state(interaction.channel, interaction.user.mention, session)
+            # 送っている間に時間切れで片付いたセッションは戻さない
+            if game_sessions.get(session.message_id) is session:
+                game_sessions.move(session, msg.id)
 
-    @discord.ui.button(label="スタンド", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="スタンド", style=discord.ButtonStyle.success, custom_id="velt:blackjack:stand")
     async def stand_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.user_id or self.finished:
-            await interaction.response.send_message("自分のパネルのみ操作できます。", ephemeral=True)
+        session = await self.session_for(interaction)
+        if session is None:
             return
-        self.finished = True
-        await self.finish(interaction)
-
-    async def finish(self, interaction):
-        self.finished = True
-        # BOTは17以上になるまで引く
-        while sum(self.bot_cards) < 17:
-            draw_msg = await interaction.channel.send("BOT カードを引きます...")
-            await asyncio.sleep(1)
-            self.bot_cards.append(random.randint(1, 10))
-            await draw_msg.edit(content=f"BOTの手札: {self.hand_str(self.bot_cards)}")
-        player_total = sum(self.player_cards)
-        bot_total = sum(self.bot_cards)
-        msg = (
-            f"{interaction.user.mention} の手札: {self.hand_str(self.player_cards)}\n"
-            f"BOTの手札: {self.hand_str(self.bot_cards)}\n"
-        )
-        if player_total > 21:
-            add_balance(self.user_id, -self.bet)
-            msg += f"バースト！{self.bet} velt失いました。"
-        elif bot_total > 21 or player_total > bot_total:
-            add_balance(self.user_id, self.bet)
-            msg += f"🎉 勝ち！{self.bet} velt獲得！"
-        elif player_total < bot_total:
-            add_balance(self.user_id, -self.bet)
-            msg += f"😢 負け… {self.bet} velt失いました。"
-        else:
-            msg += "🤝 引き分け！"
-        await interaction.channel.send(msg)
-
-@tree.command(name="ブラックジャック", description="veltでブラックジャック（BOT対戦）", guild=discord.Object(id=GUILD_ID))
+        session.stand()
+        game_sessions.put(session)
+        await interaction.response.defer()
+        await finish_blackjack(interaction.channel, interaction.user.mention, session)
+
+blackjack_table_view = BlackjackTableView()
+
+# 損益をセッションに保存してから残高に反映し、反映が書き込まれてからセッションを消す。
+# 途中で落ちたり精算に失敗したりしても、再起動後に保存した損益で精算し直せる（掛け金が宙に浮かない）。
+# 状態は最初の await の前に STATE_SETTLING にするので、動いている間に同じセッションを2回精算することはない。
+# 残高とセッションは別のファイルなので、反映の書き込みから削除の書き込みまでの間に落ちたときだけは再起動後にもう一度精算される
+async def settle_blackjack(session, net):
+    session.state = STATE_SETTLING
+    session.net = net
+    game_sessions.put(session)
+    await game_sessions.wait_durable()
+    economy = session_economy(session)
+    result = await Escrow(economy.engine, session.user_id, session.bet, history.KIND_BLACKJACK).settle(net)
+    await economy.store.wait_durable()
+    game_sessions.delete(session.message_id)
+    await game_sessions.wait_durable()
+    return result
+
+async def finish_blackjack(channel, mention, session):
+    # 精算するのは BOT の番になったセッションを1回だけ（すでに片付いたセッションは何もしない）
+    if game_sessions.get(session.message_id) is not session or session.state != STATE_DEALER:
+        return
+    started = time.perf_counter()
+    # BOTは17以上になるまで引く（引くカードも先に決めて精算し、演出はあとから流す）
+    start = len(session.bot_cards)
+    while session.bot_should_draw():
+        session.bot_draw(session.bot_card())
+    msg = (
+        f"{mention} の手札: {hand_str(session.player_cards)}\n"
+        f"BOTの手札: {hand_str(session.bot_cards)}\n"
+    )
+    multiplier, result = session.outcome()
+    await settle_blackjack(session, session.bet * multiplier)
+    if result == "bust":
+        msg += f"バースト！{session.bet} velt失いました。"
+    elif result == "win":
+        msg += f"🎉 勝ち！{session.bet} velt獲得！"
+    elif result == "lose":
+        msg += f"😢 負け… {session.bet} velt失いました。"
+    else:
+        msg += "🤝 引き分け！"
+    if session.ref is not None:
+        msg += outcome_footer(session.ref)
+    animator.play(channel, animation.blackjack_dealer_frames(session.bot_cards, start) + [(msg, 1)])
+    metrics.GAME_SECONDS.observe(time.perf_counter() - started, game="blackjack")
+
+# 時間切れのセッションを1つのタスクでまとめて片付ける（掛け金は返す）
+SESSION_SWEEP_INTERVAL = 5
+session_sweep_task = None
+
+async def sweep_game_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        for session in game_sessions.expired():
+            # 前のセッションを片付けている間にスタンドされたものは残す
+            if game_sessions.get(session.message_id) is not session or session.state != STATE_PLAYER:
+                continue
+            try:
+                await settle_blackjack(session, 0)
+                channel = bot.get_channel(session.channel_id)
+                if channel is not None:
+                    outbound.edit(channel.get_partial_message(session.message_id), view=None)
+            except Exception:
+                log.exception("Failed to expire game session %s", session.message_id)
+
+# 再起動前に精算の途中だったセッションを片付ける（損益まで決まっていたものはその損益で精算する）
+async def resume_game_sessions():
+    for session in game_sessions.in_state(STATE_SETTLING):
+        await settle_blackjack(session, session.net)
+    for session in game_sessions.in_state(STATE_DEALER):
+        channel = bot.get_channel(session.channel_id)
+        if channel is None:
+            await settle_blackjack(session, 0)
+            continue
+        await finish_blackjack(channel, f"<@{session.user_id}>", session)
+
+@tree.command(name="ブラックジャック", description="veltでブラックジャック（BOT対戦）")
 async def ブラックジャック(interaction: discord.Interaction):
     view = BlackjackGameView(interaction.user.id)
     await interaction.response.send_message("掛け金を選んでください！", view=view, ephemeral=True)
 
+# --- テーブル（複数人で1つの勝負） ---
+# チャンネルごとに1つのテーブルを開き、受付時間内に参加した全員で1回だけ勝負する。
+# BOTの演出は1セットだけ送り、精算は settle_many でまとめて1回の書き込みにする。
+TABLE_BET_WINDOW = 20
+TABLE_DECISION_WINDOW = 30
+TABLE_GAMES = {
+    "chinchiro": ("🎲 ちんちろテーブル", history.KIND_CHINCHIRO),
+    "blackjack": ("🃏 ブラックジャックテーブル", history.KIND_BLACKJACK),
+}
+# (channel_id, game) -> 進行中のタスク
+active_tables = {}
+# message_id -> 全員の操作が終わったら立てるイベント（ブラックジャック）
+table_decisions = {}
+
+def table_panel_text(session, closed=False):
+    title, _ = TABLE_GAMES[session.game]
+    status = "受付終了" if closed else f"参加受付中（{TABLE_BET_WINDOW}秒）"
+    return f"{title} {status}\n参加者 {len(session.bets)}人 / 合計 {sum(session.bets.values())} velt"
+
+def table_play_text(session):
+    title, _ = TABLE_GAMES[session.game]
+    return (
+        f"{title}\nBOTの手札: [{session.dealer[0]}, ?]\n"
+        f"「もう一枚引く」か「スタンド」を選んでください（{TABLE_DECISION_WINDOW}秒）。"
+        f"完了 {len(session.done)} / {len(session.hands)}人"
+    )
+
+def table_session_for(message_id, state):
+    session = game_sessions.get(message_id)
+    if not isinstance(session, TableSession) or session.state != state:
+        return None
+    return session
+
+# 参加受付の永続View（全テーブルで共有し、メッセージIDからテーブルを引く）
+class TableJoinView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label="1000 velt", style=discord.ButtonStyle.primary, custom_id="velt:table:bet:1000")
+    async def bet_1000(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.join(interaction, 1000)
+
+    @discord.ui.button(label="5000 velt", style=discord.ButtonStyle.success, custom_id="velt:table:bet:5000")
+    async def bet_5000(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.join(interaction, 5000)
+
+    @discord.ui.button(label="10000 velt", style=discord.ButtonStyle.danger, custom_id="velt:table:bet:10000")
+    async def bet_10000(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.join(interaction, 10000)
+
+    async def join(self, interaction, bet):
+        session = table_session_for(interaction.message.id, STATE_BETTING)
+        if session is None:
+            await interaction.response.send_message("このテーブルの受付は終了しています。", ephemeral=True)
+            return
+        user_id = interaction.user.id
+        if user_id in session.bets:
+            await interaction.response.send_message("すでに参加しています。", ephemeral=True)
+            return
+        if await reject_throttled(interaction):
+            return
+        _, kind = TABLE_GAMES[session.game]
+        escrow = await session_economy(session).engine.reserve(user_id, bet, kind)
+        if escrow is None:
+            await interaction.response.send_message("残高が足りません。", ephemeral=True)
+            return
+        # 預かっている間に締め切られたり、連打で二重に参加していたら返す
+        if session.state != STATE_BETTING or not session.join(user_id, bet):
+            await escrow.refund()
+            await interaction.response.send_message("参加できませんでした。", ephemeral=True)
+            return
+        game_sessions.put(session)
+        await interaction.response.send_message(f"{bet} velt で参加しました。", ephemeral=True)
+        # 参加者数の表示は連続した編集がまとめられる
+        outbound.edit(interaction.message, table_panel_text(session))
+
+table_join_view = TableJoinView()
+
+# 手番の永続View（ブラックジャックテーブル）。結果は本人にだけ返し、テーブルの表示は件数だけ更新する
+class TablePlayView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    async def session_for(self, interaction):
+        session = table_session_for(interaction.message.id, STATE_PLAYER)
+        if session is None:
+            await interaction.response.send_message("このゲームは終了しています。", ephemeral=True)
+            return None
+        if interaction.user.id not in session.hands:
+            await interaction.response.send_message("このテーブルに参加していません。", ephemeral=True)
+            return None
+        if interaction.user.id in session.done:
+            await interaction.response.send_message("あなたの手番は終わっています。", ephemeral=True)
+            return None
+        return session
+
+    async def after_action(self, interaction, session, text):
+        game_sessions.put(session)
+        await interaction.response.send_message(text, ephemeral=True)
+        outbound.edit(interaction.message, table_play_text(session))
+        if session.all_done():
+            event = table_decisions.get(session.message_id)
+            if event is not None:
+                event.set()
+
+    @discord.ui.button(label="もう一枚引く", style=discord.ButtonStyle.primary, custom_id="velt:table:hit")
+    async def hit(self, interaction: discord.Interaction, button: discord.ui.Button):
+        session = await self.session_for(interaction)
+        if session is None or await reject_throttled(interaction):
+            return
+        cards = session.hit(interaction.user.id, session.player_card(interaction.user.id))
+        text = f"あなたの手札: {hand_str(cards)}"
+        if interaction.user.id in session.done:
+            text += "\nバースト！"
+        await self.after_action(interaction, session, text)
+
+    @discord.ui.button(label="スタンド", style=discord.ButtonStyle.success, custom_id="velt:table:stand")
+    async def stand_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        session = await self.session_for(interaction)
+        if session is None:
+            return
+        session.stand(interaction.user.id)
+        await self.after_action(interaction, session, f"あなたの手札: {hand_str(session.hands[interaction.user.id])}\nスタンドしました。")
+
+table_play_view = TablePlayView()
+
+async def run_table(channel, game):
+    session = None
+    try:
+        panel = await outbound.send(channel, table_panel_text(TableSession(None, channel.id, channel.guild.id, game)), view=table_join_view)
+        session = TableSession(panel.id, channel.id, channel.guild.id, game)
+        game_sessions.put(session)
+        await asyncio.sleep(TABLE_BET_WINDOW)
+        session.state = STATE_DEALER if game == "chinchiro" else STATE_PLAYER
+        game_sessions.put(session)
+        outbound.edit(panel, table_panel_text(session, closed=True), view=None)
+        if not session.bets:
+            game_sessions.delete(session.message_id)
+            await outbound.send(channel, "参加者がいなかったのでテーブルを閉じました。")
+            return
+        started = time.perf_counter()
+        if game == "chinchiro":
+            await play_chinchiro_table(channel, session)
+        else:
+            await play_blackjack_table(channel, session)
+        metrics.GAME_SECONDS.observe(time.perf_counter() - started, game=f"{game}_table")
+    except Exception:
+        log.exception("Table in channel %s failed", channel.id)
+        # 預かった掛け金は再起動を待たずに返す。精算に進んだテーブルは、保存した損益で再起動後に精算し直す
+        if session is not None and game_sessions.get(session.message_id) is session and session.state != STATE_SETTLING:
+            try:
+                await refund_table(channel, session, "エラーのためテーブルを中止し、掛け金を返しました。")
+            except Exception:
+                log.exception("Failed to refund table in channel %s", channel.id)
+    finally:
+        active_tables.pop((channel.id, game), None)
+
+# 参加者ごとの損益（user_id -> net）をセッションに保存してから残高に反映し、反映が書き込まれてからセッションを消す。
+# 途中で落ちたり精算に失敗したりしても、再起動後に resume_tables が保存した損益で精算し直す（settle_blackjack と同じ）
+async def settle_table(session, nets):
+    _, kind = TABLE_GAMES[session.game]
+    session.state = STATE_SETTLING
+    session.results = nets
+    game_sessions.put(session)
+    await game_sessions.wait_durable()
+    economy = session_economy(session)
+    results = await economy.engine.settle_many(
+        [(Escrow(economy.engine, user_id, session.bets[user_id], kind), net) for user_id, net in nets.items()], kind
+    )
+    await economy.store.wait_durable()
+    game_sessions.delete(session.message_id)
+    await game_sessions.wait_durable()
+    return results
+
+# 勝負を続けられないテーブルを閉じ、参加者全員に掛け金を返す
+async def refund_table(channel, session, notice):
+    await settle_table(session, {user_id: 0 for user_id in session.bets})
+    if channel is not None:
+        outbound.edit(channel.get_partial_message(session.message_id), view=None)
+        outbound.send(channel, notice)
+
+async def play_chinchiro_table(channel, session):
+    # 親（BOT）の出目だけ演出する。出目は全員分を先に決める
+    rng, ref = game_outcomes.draw()
+    bot_rolls = games.chinchiro_rolls(rng)
+    bot_dice, bot_hand = bot_rolls[-1]
+    rolls = []
+    nets = {}
+    for user_id, bet in session.bets.items():
+        dice, hand, _ = games.chinchiro_roll(rng)
+        multiplier, result = games.chinchiro_settle(hand, bot_hand)
+        rolls.append((user_id, dice, hand))
+        nets[user_id] = bet * multiplier
+    await finish_table(channel, session, f"🎲 ちんちろテーブルの結果（BOT: {bot_dice} → {bot_hand.yaku}）{outcome_footer(ref)}", [
+        f"<@{user_id}> {dice} → {hand.yaku}" for user_id, dice, hand in rolls
+    ], nets, animation.chinchiro_frames("BOT", bot_rolls))
+
+async def play_blackjack_table(channel, session):
+    if session.state == STATE_PLAYER and not session.hands:
+        session.deal(*game_outcomes.draw())
+        game_sessions.put(session)
+        event = asyncio.Event()
+        msg = await outbound.send(channel, table_play_text(session), view=table_play_view)
+        table_decisions[msg.id] = event
+        game_sessions.move(session, msg.id)
+        try:
+            await asyncio.wait_for(event.wait(), TABLE_DECISION_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            table_decisions.pop(msg.id, None)
+        # 時間内に操作しなかったプレイヤーはスタンド扱い
+        session.state = STATE_DEALER
+        game_sessions.put(session)
+        outbound.edit(msg, table_play_text(session), view=None)
+    # BOTは17以上になるまで引く（1回だけ演出する）
+    start = len(session.dealer)
+    while games.blackjack_bot_should_draw(session.dealer):
+        session.dealer.append(session.dealer_card())
+    frames = [(f"BOTの手札: {hand_str(session.dealer[:start])}", 0)] + animation.blackjack_dealer_frames(session.dealer, start)
+    nets = {}
+    lines = []
+    for user_id, cards in session.hands.items():
+        multiplier, _ = games.blackjack_outcome(sum(cards), sum(session.dealer))
+        nets[user_id] = session.bets[user_id] * multiplier
+        lines.append(f"<@{user_id}> {hand_str(cards)}")
+    footer = outcome_footer(session.ref) if session.ref is not None else ""
+    await finish_table(channel, session, f"🃏 ブラックジャックテーブルの結果（BOT: {hand_str(session.dealer)}）{footer}",
+                       lines, nets, frames)
+
+def format_net(net):
+    if net > 0:
+        return f"🎉 +{net} velt"
+    if net < 0:
+        return f"😢 {net} velt"
+    return "🤝 ±0"
+
+# 精算してから、BOTの演出と結果の一覧を流す（lines は nets と同じ順）
+async def finish_table(channel, session, header, lines, nets, frames):
+    results = await settle_table(session, nets)
+    lines = [f"{line}: {format_net(net)}" for line, net in zip(lines, results)]
+    animator.play(channel, frames, results=join_lines([header] + lines))
+
+async def open_table(interaction, game):
+    key = (interaction.channel.id, game)
+    if key in active_tables:
+        await interaction.response.send_message("このチャンネルではすでにテーブルが開いています。", ephemeral=True)
+        return
+    active_tables[key] = asyncio.create_task(run_table(interaction.channel, game))
+    await interaction.response.send_message("テーブルを開きました。", ephemeral=True)
+
+@tree.command(name="ちんちろテーブル", description="みんなで1回勝負するちんちろテーブルを開く")
+async def ちんちろテーブル(interaction: discord.Interaction):
+    await open_table(interaction, "chinchiro")
+
+@tree.command(name="ブラックジャックテーブル", description="みんなで1回勝負するブラックジャックテーブルを開く")
+async def ブラックジャックテーブル(interaction: discord.Interaction):
+    await open_table(interaction, "blackjack")
+
+# 再起動前に受付中・手番待ちだったテーブルは掛け金を返して閉じ、精算中だったものは続きから精算する
+async def resume_tables():
+    for session in game_sessions.of_type(TableSession):
+        channel = bot.get_channel(session.channel_id)
+        if session.state == STATE_SETTLING:
+            await settle_table(session, session.results)
+            if channel is not None:
+                outbound.send(channel, "再起動前に決まっていたテーブルの結果を精算しました。")
+            continue
+        if session.state == STATE_DEALER and session.game == "blackjack" and session.hands and channel is not None:
+            await play_blackjack_table(channel, session)
+            continue
+        await refund_table(channel, session, "再起動のためテーブルを中止し、掛け金を返しました。")
+
+# コマンドをサーバーに登録する。内容が前回の同期から変わっていなければ API を呼ばない
+async def sync_guild_commands(guild):
+    tree.copy_global_to(guild=guild)
+    digest = command_hash([command.to_dict(tree) for command in tree.get_commands(guild=guild)])
+    if guild_configs.get(guild.id).sync_hash == digest:
+        return
+    try:
+        synced = await tree.sync(guild=guild)
+    except Exception:
+        log.exception("Failed to sync commands to guild %s", guild.id)
+        return
+    guild_configs.update(guild.id, sync_hash=digest)
+    log.info("Slash commands synced to guild %s: %d", guild.id, len(synced))
+
+@bot.event
+async def on_guild_join(guild):
+    await sync_guild_commands(guild)
+    member_index.build(guild)
+    economy_for(guild.id)
+
 @bot.event
 async def on_ready():
+    global leaderboard_refresh_task, session_sweep_task, metrics_task, role_income_task, outcome_rotation_task
+    if metrics_task is None:
+        metrics_task = asyncio.create_task(metrics.monitor_loop_lag())
+        if METRICS_PORT:
+            try:
+                await metrics.start_http_server(METRICS_PORT)
+            except Exception:
+                log.exception("Failed to start metrics server")
+    if STORAGE_BACKEND == "shared" and leaderboard_refresh_task is None:
+        leaderboard_refresh_task = asyncio.create_task(refresh_leaderboard())
+    if session_sweep_task is None:
+        bot.add_view(blackjack_table_view)
+        bot.add_view(table_join_view)
+        bot.add_view(table_play_view)
+        session_sweep_task = asyncio.create_task(sweep_game_sessions())
+        try:
+            await resume_game_sessions()
+            await resume_tables()
+        except Exception:
+            log.exception("Failed to resume game sessions")
+    for guild in bot.guilds:
+        await sync_guild_commands(guild)
+        member_index.build(guild)
+        economy_for(guild.id)
+    if outcome_rotation_task is None:
+        outcome_rotation_task = asyncio.create_task(rotate_outcome_epochs())
+    # メンバーのキャッシュができてから定期発行を始める（止まっていた間の分もここで払う）
+    if role_income_task is None:
+        role_income_task = asyncio.create_task(run_role_income())
     try:
-        synced = await tree.sync(guild=discord.Object(id=GUILD_ID))
-        print(f"Slash commands synced: {len(synced)}")
-    except Exception as e:
-        print(f"Failed to sync commands: {e}")
-    print(f"Bot is ready. Logged in as {bot.user}")
+        await backfill_vc_transfers()
+    except Exception:
+        log.exception("Failed to backfill VirtualCrypto transfers")
+    log.info("Bot is ready. Logged in as %s", bot.user)
 
 # Bot起動時に残高を読み込む
 load_balances()
 
+# /演出設定コマンド（管理者のみ：チャンネル・サーバーごとの演出モード）
+@tree.command(name="演出設定", description="ゲームの演出を設定（管理者のみ）")
+@app_commands.describe(mode="演出", scope="設定する範囲")
+@app_commands.choices(
+    mode=[app_commands.Choice(name=label, value=mode) for mode, label in animation.MODE_LABELS.items()]
+    + [app_commands.Choice(name="設定を消す", value="default")],
+    scope=[app_commands.Choice(name="このチャンネル", value="channel"), app_commands.Choice(name="サーバー全体", value="guild")],
+)
+async def 演出設定(interaction: discord.Interaction, mode: app_commands.Choice[str], scope: app_commands.Choice[str] = None):
+    if not is_admin(interaction.user, interaction.guild_id):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    scope_value = scope.value if scope else "channel"
+    target_id = interaction.channel.id if scope_value == "channel" else interaction.guild.id
+    animation_settings.set(scope_value, target_id, None if mode.value == "default" else mode.value)
+    await animation_settings.wait_durable()
+    target = "このチャンネル" if scope_value == "channel" else "サーバー全体"
+    await interaction.response.send_message(f"{target}の演出を「{mode.name}」にしました。", ephemeral=True)
+
+# /公平性コマンド（今の期間のハッシュと、公開済みのシード）
+FAIRNESS_REVEALED_SHOWN = 5
+
+# ゲームが遊ばれていなくても、期間が終わったらシードを公開して次の期間に進める
+outcome_rotation_task = None
+
+async def rotate_outcome_epochs():
+    while True:
+        await asyncio.sleep(max(game_outcomes.reveal_at() - time.time(), 1))
+        try:
+            game_outcomes.rotate_if_due()
+        except Exception:
+            log.exception("Failed to rotate the outcome epoch")
+
+@tree.command(name="公平性", description="ゲームの乱数のハッシュと公開済みのシードを表示")
+@app_commands.describe(epoch="シードを確認する期間の番号（結果の 🔐 の : より前）")
+async def 公平性(interaction: discord.Interaction, epoch: int = None):
+    if epoch is not None:
+        revealed = game_outcomes.find(epoch)
+        if revealed is None:
+            text = "この期間はまだ終わっていないか、記録が残っていません。"
+        else:
+            text = (
+                f"**期間 {revealed.epoch_id}**（<t:{int(revealed.started)}:f> 〜 <t:{int(revealed.ended)}:f>）\n"
+                f"ハッシュ: `{revealed.commitment}`\nシード: `{revealed.seed.hex()}`"
+            )
+        await interaction.response.send_message(text, ephemeral=True)
+        return
+    game_outcomes.rotate_if_due()
+    current = game_outcomes.epoch
+    lines = [
+        f"**今の期間 {current.epoch_id}**: ハッシュ `{current.commitment}`",
+        f"シードは <t:{int(game_outcomes.reveal_at())}:R> に公開されます。",
+        "結果の 🔐 は「期間:位置」です。SHA-256(シード) がハッシュと一致し、"
+        "SHAKE-256(シード || ブロック番号) の位置から出目を作り直せることを確かめられます。"
+        "ブラックジャックは、その位置から取り出した席ごとのシードと手札の枚数からカードを作り直せます。",
+    ]
+    if game_outcomes.revealed:
+        lines.append("**公開済み**")
+        for revealed in game_outcomes.revealed[:FAIRNESS_REVEALED_SHOWN]:
+            lines.append(f"期間 {revealed.epoch_id}: `{revealed.seed.hex()}`")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
 # /リセットコマンド（管理者のみ：全員の残高を0にする）
-@tree.command(name="リセット", description="全員のvelt残高を0にリセット（管理者のみ）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="リセット", description="全員のvelt残高を0にリセット（管理者のみ）")
 async def リセット(interaction: discord.Interaction):
-    if interaction.user.id not in VELT_ADMIN_IDS:
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
-    for uid in list(velt_balances.keys()):
-        velt_balances[uid] = 0
-    save_balances()
+    economy = economy_for(interaction.guild_id)
+    await economy.engine.reset_all()
+    await economy.store.wait_durable()
     await interaction.response.send_message("全員のvelt残高を0にリセットしました。", ephemeral=True)
     # ログチャンネルにも通知
-    log_channel = bot.get_channel(VELT_LOG_CHANNEL_ID)
+    log_channel = log_channel_for(interaction.guild_id)
     if log_channel:
-        await log_channel.send(f"{interaction.user.mention} が全員のvelt残高をリセットしました。")
+        outbound.log(log_channel, f"{interaction.user.mention} が全員のvelt残高をリセットしました。")
+
+# /サーバー設定コマンド（管理者のみ：このサーバーのログチャンネル・送金検知・管理者）
+@tree.command(name="サーバー設定", description="このサーバーのBot設定を変更・確認（管理者のみ）")
+@app_commands.describe(
+    log_channel="ログを送るチャンネル", crypto_channel="VirtualCrypto の送金通知が届くチャンネル",
+    target="VirtualCrypto の送金先（入金として扱う相手）", add_admin="管理者に追加", remove_admin="管理者から外す",
+)
+async def サーバー設定(
+    interaction: discord.Interaction,
+    log_channel: discord.TextChannel = None,
+    crypto_channel: discord.TextChannel = None,
+    target: discord.Member = None,
+    add_admin: discord.Member = None,
+    remove_admin: discord.Member = None,
+):
+    if not is_admin(interaction.user, interaction.guild_id):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    config = guild_configs.get(interaction.guild_id)
+    changes = {}
+    if log_channel is not None:
+        changes["log_channel_id"] = log_channel.id
+    if crypto_channel is not None:
+        changes["crypto_channel_id"] = crypto_channel.id
+    if target is not None:
+        changes["target_user_id"] = target.id
+        changes["target_username"] = target.display_name
+    admin_ids = list(config.admin_ids)
+    if add_admin is not None and add_admin.id not in admin_ids:
+        admin_ids.append(add_admin.id)
+    if remove_admin is not None and remove_admin.id in admin_ids:
+        admin_ids.remove(remove_admin.id)
+    if admin_ids != config.admin_ids:
+        changes["admin_ids"] = admin_ids
+    if changes:
+        config = guild_configs.update(interaction.guild_id, **changes)
+        await guild_configs.wait_durable()
+    admins = " ".join(f"<@{user_id}>" for user_id in config.admin_ids) or "なし"
+    msg = (
+        f"**サーバー設定**{'を更新しました' if changes else ''}\n"
+        f"ログチャンネル: {f'<#{config.log_channel_id}>' if config.log_channel_id else 'なし'}\n"
+        f"送金通知チャンネル: {f'<#{config.crypto_channel_id}>' if config.crypto_channel_id else 'なし'}\n"
+        f"送金先: {f'<@{config.target_user_id}>' if config.target_user_id else 'なし'}\n"
+        f"管理者: {admins}"
+    )
+    await interaction.response.send_message(msg, ephemeral=True)
+    if changes:
+        log_channel = log_channel_for(interaction.guild_id)
+        if log_channel:
+            outbound.log(log_channel, f"【サーバー設定】{interaction.user.mention} がサーバー設定を変更しました")
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+# /統計コマンド（管理者のみ：処理時間・書き込み・API呼び出しの概要）
+@tree.command(name="統計", description="Botの処理時間などの統計を表示（管理者のみ）")
+async def 統計(interaction: discord.Interaction):
+    if not is_admin(interaction.user, interaction.guild_id):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    lines = ["**コマンド**（回数 / p50 / p99）"]
+    for command, status in sorted(metrics.COMMAND_SECONDS.keys()):
+        count, _, _ = metrics.COMMAND_SECONDS.summary(command=command, status=status)
+        p50 = metrics.COMMAND_SECONDS.quantile(0.5, command=command, status=status)
+        p99 = metrics.COMMAND_SECONDS.quantile(0.99, command=command, status=status)
+        suffix = "" if status == "ok" else f"（{status}）"
+        lines.append(f"/{command}{suffix}: {count}回 / {format_seconds(p50)} / {format_seconds(p99)}")
+    lines.append("**ゲーム**（回数 / p50 / p99）")
+    for (game,) in sorted(metrics.GAME_SECONDS.keys()):
+        count, _, _ = metrics.GAME_SECONDS.summary(game=game)
+        p50 = metrics.GAME_SECONDS.quantile(0.5, game=game)
+        p99 = metrics.GAME_SECONDS.quantile(0.99, game=game)
+        lines.append(f"{game}: {count}回 / {format_seconds(p50)} / {format_seconds(p99)}")
+    lines.append("**書き込み**（回数 / p99 / 失敗）")
+    for (worker,) in sorted(metrics.FLUSH_SECONDS.keys()):
+        count, _, _ = metrics.FLUSH_SECONDS.summary(worker=worker)
+        p99 = metrics.FLUSH_SECONDS.quantile(0.99, worker=worker)
+        lines.append(f"{worker}: {count}回 / {format_seconds(p99)} / {metrics.FLUSH_ERRORS.get(worker=worker)}")
+    lines.append(
+        f"書き込み待ち: 残高 {sum(economy.store.pending() for economy in economies.values())} / "
+        f"履歴 {sum(economy.history.pending() for economy in economies.values())} / "
+        f"セッション {game_sessions.pending()}　送信キュー: {outbound.queue_depth()}"
+    )
+    throttled = " / ".join(f"{category} {count}回（{scope}）" for (category, scope), count in sorted(metrics.THROTTLED.samples()))
+    lines.append(f"**流量制限**: {throttled or 'なし'}　バケット {len(command_throttle)}")
+    modes = " / ".join(f"{animation.MODE_LABELS[mode]} {metrics.ANIMATIONS.get(mode=mode)}回" for mode in animation.MODES)
+    lines.append(f"**演出**: 進行中 {animator.in_flight()}　{modes}")
+    lines.append(
+        f"**Discord API**: {metrics.DISCORD_API_CALLS.total()}回　"
+        f"429: {metrics.DISCORD_RATELIMITS.total()}回（待ち {metrics.DISCORD_RATELIMIT_WAIT.total():.1f}秒）　"
+        f"送信キュー待ち: {metrics.OUTBOUND_WAIT.total():.1f}秒"
+    )
+    lag = metrics.LOOP_LAG.summary()
+    lines.append(
+        f"**イベントループの遅れ**: p99 {format_seconds(metrics.LOOP_LAG.quantile(0.99))}"
+        f" / 最大 {format_seconds(lag[2] if lag else None)}"
+    )
+    await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+# /経済統計コマンド（管理者のみ：総供給量・発行元ごとの発行量・ゲームの収支・残高の分布）
+ECONOMY_SOURCE_KINDS = [history.KIND_ISSUE, history.KIND_ROLE_ISSUE, history.KIND_DEPOSIT, history.KIND_REVOKE]
+ECONOMY_GAME_KINDS = [history.KIND_SLOT, history.KIND_CHINCHIRO, history.KIND_BLACKJACK]
+
+def format_velt(value):
+    return "-" if value is None else f"{value:,.0f} velt"
+
+@tree.command(name="経済統計", description="veltの総供給量や分布を表示（管理者のみ）")
+async def 経済統計(interaction: discord.Interaction):
+    if not is_admin(interaction.user, interaction.guild_id):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    economy_stats = economy_for(interaction.guild_id).stats
+    summary = economy_stats.summary()
+    quantiles = " / ".join(
+        f"p{int(q * 100)} {format_velt(value)}" for q, value in summary["quantiles"].items()
+    )
+    gini = summary["gini"]
+    lines = [
+        f"**総供給量**: {format_velt(summary['supply'])}（保有者 {summary['holders']:,}人 / 平均 {format_velt(summary['mean'])}）",
+        f"**分布**: {quantiles}",
+        f"**ジニ係数**: {'-' if gini is None else f'{gini:.3f}'}",
+        f"**発行・減少**（<t:{int(economy_stats.since)}:d> から）",
+    ]
+    for kind in ECONOMY_SOURCE_KINDS:
+        _, _, net = economy_stats.flow(kind)
+        lines.append(f"{history.KIND_LABELS[kind]}: {net:+,} velt")
+    lines.append("**ゲーム**（払い出し / 賭け金 / プレイヤーの差し引き）")
+    for kind in ECONOMY_GAME_KINDS:
+        inflow, outflow, net = economy_stats.flow(kind)
+        lines.append(f"{history.KIND_LABELS[kind]}: {inflow:,} / {outflow:,} / {net:+,} velt")
+    _, transferred, _ = economy_stats.flow(history.KIND_TRANSFER)
+    lines.append(f"**送金**: 合計 {transferred:,} velt")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+# VirtualCrypto の送金通知（起動時に1回だけコンパイル）
+VC_TRANSFER_PATTERN = re.compile(r"<@!?([^\s>]+)>から<@!?([^\s>]+)>へ\*\*(\d+)\*\* `velt`送金されました。")
+
+# 入金済みの送金通知メッセージID
+PROCESSED_MESSAGES_FILE = local_file("vc_processed.json")
+processed_messages = ProcessedMessages(PROCESSED_MESSAGES_FILE)
+processed_messages.load()
+atexit.register(processed_messages.close)
+
+# 名前 → メンバーの索引（送金検知でメンバー一覧を線形探索しないため）
+member_index = MemberIndex()
 
 @bot.event
-async def on_message(message):
-    VIRTUAL_CRYPTO_CHANNEL_ID = 1397899059146264637
-    TARGET_USER_ID = 1359906761833713906  # ← ここを小煩悩のユーザーIDに変更
-    TARGET_USERNAME = "小煩悩"  # ← ここも小煩悩に変更
+async def on_member_join(member):
+    member_index.add(member)
+
+@bot.event
+async def on_member_update(before, after):
+    member_index.update(after)
 
+@bot.event
+async def on_member_remove(member):
+    member_index.remove(member)
+
+@bot.event
+async def on_user_update(before, after):
+    # グローバルな表示名の変更は on_member_update に来ないので各サーバーで更新する
+    for guild in bot.guilds:
+        member = guild.get_member(after.id)
+        if member:
+            member_index.update(member)
+
+# メッセージから VirtualCrypto の送金（サーバーの設定の入金先宛て）を検出し、(送金者ID, 金額) を返す
+def parse_vc_transfer(message, config):
     # メッセージ本文またはEmbedのdescriptionを取得
     content = message.content
     if not content and message.embeds:
         content = message.embeds[0].description or ""
 
-    print(f"on_message: {content}")
+    log.debug("on_message: %s", content)
+
+    m = VC_TRANSFER_PATTERN.search(content)
+    if not m:
+        return None
+    sender = m.group(1)
+    receiver = m.group(2)
+    amount = int(m.group(3))
+    is_target = False
+    if receiver.isdigit() and int(receiver) == config.target_user_id:
+        is_target = True
+    elif config.target_username and receiver in (config.target_username, f"@{config.target_username}"):
+        is_target = True
+    elif config.target_user_id in member_index.find_all(message.guild.id, receiver):
+        is_target = True
+    if not is_target:
+        return None
 
-    if message.channel.id == VIRTUAL_CRYPTO_CHANNEL_ID:
-        import re
-        m = re.search(
-            r"<@!?([^\s>]+)>から<@!?([^\s>]+)>へ\*\*(\d+)\*\* `velt`送金されました。",
-            content
-        )
-        if m:
-            sender = m.group(1)
-            receiver = m.group(2)
-            amount = int(m.group(3))
-            # --- ここから下は今まで通り ---
-            is_target = False
-            if receiver.isdigit() and int(receiver) == TARGET_USER_ID:
-                is_target = True
-            elif receiver == TARGET_USERNAME or receiver == f"@{TARGET_USERNAME}":
-                is_target = True
-            else:
-                member = discord.utils.find(
-                    lambda m: (
-                        str(m.id) == receiver or
-                        m.name == receiver or
-                        (m.nick and m.nick == receiver) or
-                        m.display_name == receiver
-                    ),
-                    message.guild.members
-                )
-                if member and member.id == TARGET_USER_ID:
-                    is_target = True
-
-            if is_target:
-                try:
-                    sender_id = int(sender)
-                except ValueError:
-                    member = discord.utils.find(
-                        lambda m: (
-                            m.name == sender or
-                            (m.nick and m.nick == sender) or
-                            m.display_name == sender
-                        ),
-                        message.guild.members
-                    )
-                    sender_id = member.id if member else None
-                if sender_id:
-                    add_balance(sender_id, amount)
-                    await message.channel.send(f"<@{sender_id}> に {amount} velt を移行しました。")
-                    log_channel = bot.get_channel(VELT_LOG_CHANNEL_ID)
-                    if log_channel:
-                        await log_channel.send(f"【発行ログ】<@{sender_id}> に {amount} velt を発行（バーチャルクリプト送金検知）")
+    try:
+        sender_id = int(sender)
+    except ValueError:
+        sender_id = member_index.find(message.guild.id, sender)
+    if not sender_id:
+        return None
+    return sender_id, amount
+
+@bot.event
+async def on_message(message):
+    # どこかのサーバーの VirtualCrypto のチャンネル以外は本文を見ない
+    config = guild_configs.for_crypto_channel(message.channel.id)
+    if config is None:
+        await bot.process_commands(message)
+        return
+
+    transfer = parse_vc_transfer(message, config)
+    # 同じ通知は一度だけ入金する（再接続・再起動後の再処理でも二重にならない）
+    if transfer and processed_messages.claim(message.id):
+        sender_id, amount = transfer
+        try:
+            await add_balance(config.guild_id, sender_id, amount, history.KIND_DEPOSIT)
+        except Exception:
+            processed_messages.release(message.id)
+            raise
+        # 入金が書き込まれてから処理済みを保存する（書き込みの待ちに失敗しても入金は済んでいるので処理済みにする）
+        try:
+            await economy_for(config.guild_id).store.wait_durable()
+        finally:
+            processed_messages.confirm([message.id])
+        await processed_messages.wait_durable()
+        await outbound.send(message.channel, f"<@{sender_id}> に {amount} velt を移行しました。")
+        log_channel = log_channel_for(config.guild_id)
+        if log_channel:
+            outbound.log(log_channel, f"【発行ログ】<@{sender_id}> に {amount} velt を発行（バーチャルクリプト送金検知）")
     await bot.process_commands(message)
 
-# ロール設定を読み書きする関数
-def load_role_settings():
+# 停止中に届いた送金通知を、最後に処理したメッセージ以降の履歴からまとめて取り込む
+async def backfill_vc_transfers():
+    if processed_messages.last_id is None:
+        return
+    for config in guild_configs.all():
+        channel = bot.get_channel(config.crypto_channel_id) if config.crypto_channel_id else None
+        if channel is not None:
+            await backfill_vc_channel(channel, config)
+
+async def backfill_vc_channel(channel, config):
+    deltas = []
+    message_ids = []
+    async for message in channel.history(limit=None, after=discord.Object(id=processed_messages.last_id), oldest_first=True):
+        transfer = parse_vc_transfer(message, config)
+        if transfer and processed_messages.claim(message.id):
+            deltas.append(transfer)
+            message_ids.append(message.id)
+    if not deltas:
+        return
+    economy = economy_for(config.guild_id)
+    try:
+        await economy.engine.credit_many(deltas, history.KIND_DEPOSIT)
+    except Exception:
+        for message_id in message_ids:
+            processed_messages.release(message_id)
+        raise
+    try:
+        await economy.store.wait_durable()
+    finally:
+        processed_messages.confirm(message_ids)
+    await processed_messages.wait_durable()
+    log.info("Backfilled %d VirtualCrypto transfers in guild %s", len(deltas), config.guild_id)
+    log_channel = log_channel_for(config.guild_id)
+    if log_channel:
+        outbound.log(log_channel, f"【発行ログ】停止中のバーチャルクリプト送金 {len(deltas)} 件を取り込みました")
+        for sender_id, amount in deltas:
+            outbound.log(log_channel, f"<@{sender_id}> に {amount} velt")
+
+# ロール設定を読み書きする関数（サーバーのストアのキャッシュ。書き込みはバックグラウンド）
+def load_role_settings(guild_id):
+    return economy_for(guild_id).store.load_role_settings()
+
+async def save_role_settings(guild_id, settings):
+    store = economy_for(guild_id).store
+    await store.run(store.save_role_settings, settings)
+
+# --- ロールの定期発行 ---
+# 次に払う時刻の heap（role_schedule）を1つのタスクが見て、その時刻まで眠る（設定が変わったら起こす）
+# 止まっていた間の分は最大この回数までまとめて払う
+ROLE_CATCH_UP_LIMIT = int(os.getenv("VELT_ROLE_CATCH_UP_LIMIT", "30"))
+role_income_task = None
+
+async def run_role_income():
+    while True:
+        role_schedule_changed.clear()
+        try:
+            await asyncio.wait_for(role_schedule_changed.wait(), role_schedule.delay())
+        except asyncio.TimeoutError:
+            pass
+        due = role_schedule.pop_due()
+        if due:
+            try:
+                await pay_role_income(due)
+            except Exception:
+                log.exception("Failed to pay scheduled role income")
+
+# 時刻が来たロールの分をサーバーごとにまとめて1回で発行する（複数のロールを持つメンバーは合算）
+async def pay_role_income(keys):
+    by_guild = {}
+    for guild_id, role_id in keys:
+        by_guild.setdefault(guild_id, []).append(role_id)
+    for guild_id, role_ids in by_guild.items():
+        try:
+            await pay_guild_role_income(guild_id, role_ids)
+        except Exception:
+            log.exception("Failed to pay scheduled role income in guild %s", guild_id)
+
+async def pay_guild_role_income(guild_id, role_ids):
+    guild = bot.get_guild(guild_id)
+    economy = economy_for(guild_id)
+    now = time.time()
+    settings = economy.store.load_role_settings()
+    deltas = {}
+    summaries = []
     try:
-        with open(ROLE_SETTINGS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+        for role_id in role_ids:
+            data = settings.get(role_id)
+            if data is None:
+                continue
+            periods = periods_due(data, now)
+            if not periods:
+                continue
+            paid_until = data["paid_until"] + periods * INTERVALS[data["interval"]]
+            # 先に発行済みにしてから払う（別のプロセスと二重に払わない）
+            if not await economy.store.run(economy.store.claim_role_payout, role_id, data["paid_until"], paid_until):
+                continue
+            role = guild.get_role(int(role_id)) if guild else None
+            if role is None:
+                continue
+            periods = min(periods, ROLE_CATCH_UP_LIMIT)
+            amount = data["amount"] * periods
+            members = 0
+            for member in role.members:
+                if not member.bot:  # BOTは除外
+                    deltas[member.id] = deltas.get(member.id, 0) + amount
+                    members += 1
+            suffix = f"（{periods}回分）" if periods > 1 else ""
+            summaries.append(f"「{role.name}」{members}人に {amount} velt ずつ{suffix}")
+    finally:
+        latest = economy.store.load_role_settings()
+        for role_id in role_ids:
+            reschedule_role(guild_id, role_id, latest.get(role_id))
+    if not deltas:
+        return
+    # 発行済みの記録が確定してから残高に反映する（途中で落ちたらその回は払わない）
+    await economy.store.wait_durable()
+    await economy.engine.credit_many(deltas.items(), history.KIND_ROLE_ISSUE)
+    await economy.store.wait_durable()
+    log.info("Scheduled role income in guild %s: %d members, %d velt", guild_id, len(deltas), sum(deltas.values()))
+    log_channel = log_channel_for(guild_id)
+    if log_channel:
+        outbound.log(log_channel, f"【定期発行】{' / '.join(summaries)}")
 
-def save_role_settings(settings):
-    with open(ROLE_SETTINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(settings, f, ensure_ascii=False)
+ROLE_INTERVAL_CHOICES = [
+    app_commands.Choice(name="手動のみ", value="manual"),
+    app_commands.Choice(name="毎日", value="daily"),
+    app_commands.Choice(name="毎週", value="weekly"),
+]
 
 # ロール設定コマンド（管理者のみ）
-@tree.command(name="ロール設定", description="ロールごとの発行金額を設定（管理者のみ）", guild=discord.Object(id=GUILD_ID))
-@app_commands.describe(role="対象ロール", amount="発行金額")
-async def ロール設定(interaction: discord.Interaction, role: discord.Role, amount: int):
-    if not is_admin(interaction.user):
+@tree.command(name="ロール設定", description="ロールごとの発行金額を設定（管理者のみ）")
+@app_commands.describe(role="対象ロール", amount="発行金額", interval="自動で発行する間隔")
+@app_commands.choices(interval=ROLE_INTERVAL_CHOICES)
+async def ロール設定(interaction: discord.Interaction, role: discord.Role, amount: int, interval: app_commands.Choice[str] = None):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
     
-    settings = load_role_settings()
-    settings[str(role.id)] = {"name": role.name, "amount": amount}
-    save_role_settings(settings)
+    previous = load_role_settings(interaction.guild_id).get(str(role.id), {})
+    # 間隔を指定しなければ今の設定のまま。変えたら今から数え始める
+    interval_value = previous.get("interval") if interval is None else interval.value
+    if interval_value not in INTERVALS:
+        interval_value = None
+    # このロールの行だけを書き換える（paid_until はストア側で引き継ぐので、定期発行と同時でも巻き戻らない）
+    store = economy_for(interaction.guild_id).store
+    data = await store.run(store.set_role_setting, str(role.id), role.name, amount, interval_value, time.time())
+    await store.wait_durable()
+    reschedule_role(interaction.guild_id, str(role.id), data)
     
-    await interaction.response.send_message(f"ロール「{role.name}」の発行金額を {amount} velt に設定しました。", ephemeral=True)
+    label = INTERVAL_LABELS.get(data["interval"])
+    suffix = f"（{label}自動で発行）" if label else ""
+    await interaction.response.send_message(f"ロール「{role.name}」の発行金額を {amount} velt に設定しました。{suffix}", ephemeral=True)
     
     # ログ
-    log_channel = bot.get_channel(VELT_LOG_CHANNEL_ID)
+    log_channel = log_channel_for(interaction.guild_id)
     if log_channel:
-        await log_channel.send(f"【ロール設定】{interaction.user.mention} が「{role.name}」の発行金額を {amount} velt に設定")
+        outbound.log(log_channel, f"【ロール設定】{interaction.user.mention} が「{role.name}」の発行金額を {amount} velt に設定{suffix}")
+
+# ロール発行でこの人数ごとに進捗を表示する
+ROLE_ISSUE_PROGRESS_STEP = 5000
 
 # ロール発行コマンド（管理者のみ）
-@tree.command(name="ロール発行", description="設定されたロールのメンバー全員にveltを発行（管理者のみ）", guild=discord.Object(id=GUILD_ID))
-@app_commands.describe(role="対象ロール")
-async def ロール発行(interaction: discord.Interaction, role: discord.Role):
-    if not is_admin(interaction.user):
+@tree.command(name="ロール発行", description="設定されたロールのメンバー全員にveltを発行（管理者のみ）")
+@app_commands.describe(role="対象ロール", role2="対象ロール2", role3="対象ロール3", role4="対象ロール4", role5="対象ロール5")
+async def ロール発行(
+    interaction: discord.Interaction,
+    role: discord.Role,
+    role2: discord.Role = None,
+    role3: discord.Role = None,
+    role4: discord.Role = None,
+    role5: discord.Role = None,
+):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
     
-    settings = load_role_settings()
-    if str(role.id) not in settings:
-        await interaction.response.send_message(f"ロール「{role.name}」の発行金額が設定されていません。", ephemeral=True)
+    roles = []
+    for r in (role, role2, role3, role4, role5):
+        if r is not None and r not in roles:
+            roles.append(r)
+    role_names = "」「".join(r.name for r in roles)
+    
+    settings = load_role_settings(interaction.guild_id)
+    missing = [r.name for r in roles if str(r.id) not in settings]
+    if missing:
+        await interaction.response.send_message(f"ロール「{'」「'.join(missing)}」の発行金額が設定されていません。", ephemeral=True)
         return
     
-    amount = settings[str(role.id)]["amount"]
-    members = role.members
+    # 大きなロールでも3秒以内に応答できるよう、先に応答してから処理する
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    
+    # 複数のロールを持つメンバーは1人にまとめ、金額を合算する
+    deltas = {}
+    total_members = sum(len(r.members) for r in roles)
+    processed = 0
+    for r in roles:
+        amount = settings[str(r.id)]["amount"]
+        for member in r.members:
+            processed += 1
+            if not member.bot:  # BOTは除外
+                deltas[member.id] = deltas.get(member.id, 0) + amount
+            if processed % ROLE_ISSUE_PROGRESS_STEP == 0:
+                await interaction.edit_original_response(content=f"集計中… {processed}/{total_members} 人")
     
-    if not members:
-        await interaction.response.send_message(f"ロール「{role.name}」にメンバーがいません。", ephemeral=True)
+    if not deltas:
+        await interaction.edit_original_response(content=f"ロール「{role_names}」にメンバーがいません。")
         return
     
-    # 発行処理
-    issued_count = 0
-    for member in members:
-        if not member.bot:  # BOTは除外
-            add_balance(member.id, amount)
-            issued_count += 1
+    # 発行処理（全員分を1回でまとめて反映）
+    issued_count = len(deltas)
+    issued_total = sum(deltas.values())
+    economy = economy_for(interaction.guild_id)
+    await economy.engine.credit_many(deltas.items(), history.KIND_ROLE_ISSUE)
+    await economy.store.wait_durable()
     
-    await interaction.response.send_message(
-        f"ロール「{role.name}」のメンバー {issued_count} 人に {amount} velt ずつ発行しました。", 
-        ephemeral=True
-    )
+    if len(roles) == 1:
+        amount = settings[str(role.id)]["amount"]
+        summary = f"ロール「{role.name}」のメンバー {issued_count} 人に {amount} velt ずつ発行"
+    else:
+        summary = f"ロール「{role_names}」のメンバー {issued_count} 人に合計 {issued_total} velt 発行"
+    
+    await interaction.edit_original_response(content=f"{summary}しました。")
     
     # チャンネルにも通知
-    await interaction.channel.send(
-        f"【ロール発行】{interaction.user.mention} がロール「{role.name}」のメンバー {issued_count} 人に {amount} velt ずつ発行しました。"
+    await outbound.send(
+        interaction.channel,
+        f"【ロール発行】{interaction.user.mention} が{summary}しました。"
     )
     
     # ログ
-    log_channel = bot.get_channel(VELT_LOG_CHANNEL_ID)
+    log_channel = log_channel_for(interaction.guild_id)
     if log_channel:
-        await log_channel.send(
-            f"【ロール発行】{interaction.user.mention} がロール「{role.name}」のメンバー {issued_count} 人に {amount} velt ずつ発行"
-        )
+        outbound.log(log_channel, f"【ロール発行】{interaction.user.mention} が{summary}")
 
 # ロール設定確認コマンド（管理者のみ）
-@tree.command(name="ロール設定確認", description="設定されているロールと発行金額を確認（管理者のみ）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="ロール設定確認", description="設定されているロールと発行金額を確認（管理者のみ）")
 async def ロール設定確認(interaction: discord.Interaction):
-    if not is_admin(interaction.user):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
     
-    settings = load_role_settings()
+    settings = load_role_settings(interaction.guild_id)
     if not settings:
         await interaction.response.send_message("設定されているロールがありません。", ephemeral=True)
         return
@@ -596,35 +1611,37 @@ async def ロール設定確認(interaction: discord.Interaction):
     msg = "**設定されているロール発行金額:**\n"
     for role_id, data in settings.items():
         role = interaction.guild.get_role(int(role_id))
+        due = next_due(data)
+        schedule = f"（{INTERVAL_LABELS[data['interval']]}・次回 <t:{int(due)}:R>）" if due is not None else ""
         if role:
-            msg += f"• {role.name}: {data['amount']} velt\n"
+            msg += f"• {role.name}: {data['amount']} velt{schedule}\n"
         else:
-            msg += f"• {data['name']} (削除済み): {data['amount']} velt\n"
+            msg += f"• {data['name']} (削除済み): {data['amount']} velt{schedule}\n"
     
     await interaction.response.send_message(msg, ephemeral=True)
 
 # ロール設定削除コマンド（管理者のみ）
-@tree.command(name="ロール設定削除", description="ロールの発行金額設定を削除（管理者のみ）", guild=discord.Object(id=GUILD_ID))
+@tree.command(name="ロール設定削除", description="ロールの発行金額設定を削除（管理者のみ）")
 @app_commands.describe(role="対象ロール")
 async def ロール設定削除(interaction: discord.Interaction, role: discord.Role):
-    if not is_admin(interaction.user):
+    if not is_admin(interaction.user, interaction.guild_id):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
     
-    settings = load_role_settings()
-    if str(role.id) not in settings:
+    store = economy_for(interaction.guild_id).store
+    if not await store.run(store.delete_role_setting, str(role.id)):
         await interaction.response.send_message(f"ロール「{role.name}」の設定がありません。", ephemeral=True)
         return
-    
-    del settings[str(role.id)]
-    save_role_settings(settings)
+    await store.wait_durable()
+    reschedule_role(interaction.guild_id, str(role.id), None)
     
     await interaction.response.send_message(f"ロール「{role.name}」の発行金額設定を削除しました。", ephemeral=True)
     
     # ログ
-    log_channel = bot.get_channel(VELT_LOG_CHANNEL_ID)
+    log_channel = log_channel_for(interaction.guild_id)
     if log_channel:
-        await log_channel.send(f"【ロール設定削除】{interaction.user.mention} が「{role.name}」の発行金額設定を削除")
+        outbound.log(log_channel, f"【ロール設定削除】{interaction.user.mention} が「{role.name}」の発行金額設定を削除")
 
-# Botを起動
-bot.run(TOKEN)
\ No newline at end of file
+# Botを起動（bench.py などから import したときは起動しない）
+if __name__ == "__main__":
+    bot.run(TOKEN, log_level=LOG_LEVEL)
\ No newline at end of file
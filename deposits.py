@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from persistence import FlushWorker
+
+# VirtualCrypto 送金通知の処理済みメッセージID
+#
+# 同じ通知を二重に入金しないよう、入金前に claim() で確認して押さえ、
+# 入金がディスクに書き込まれてから confirm() で処理済みとして保存する（先に保存して落ちると入金が消える）。
+# 押さえただけのIDは保存しないので、その前で落ちても再起動後の取り込みでやり直せる。
+# Discord のメッセージIDは作成時刻を含む（snowflake）ので、その時刻で古いものから捨てる。
+# ファイルへの書き込みは FlushWorker のスレッドで行う。
+
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def snowflake_time(message_id):
+    return ((int(message_id) >> 22) + DISCORD_EPOCH_MS) / 1000
+
+
+class ProcessedMessages:
+    def __init__(self, path, retention=30 * 86400, max_size=200000):
+        self.path = path
+        self.retention = retention
+        self.max_size = max_size
+        self.last_id = None
+        self._ids = OrderedDict()
+        self._pending = set()  # claim したがまだ confirm していないID
+        self._max_confirmed = None
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, name="velt-processed")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        for mid in data.get("ids", []):
+            self._ids[int(mid)] = None
+        self.last_id = self._max_confirmed = data.get("last_id")
+        self._evict()
+        self._worker.start()
+
+    def seen(self, message_id):
+        mid = int(message_id)
+        return mid in self._ids or mid in self._pending
+
+    # 未処理なら押さえて True、処理済み・処理中なら False（await を挟まず確認して押さえる）
+    def claim(self, message_id):
+        mid = int(message_id)
+        with self._lock:
+            if mid in self._ids or mid in self._pending:
+                return False
+            self._pending.add(mid)
+        return True
+
+    # 入金できなかったときは押さえたIDを戻す
+    def release(self, message_id):
+        with self._lock:
+            self._pending.discard(int(message_id))
+
+    # 入金がディスクに書き込まれたIDを処理済みとして保存する
+    def confirm(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                mid = int(message_id)
+                self._pending.discard(mid)
+                self._ids[mid] = None
+                if self._max_confirmed is None or mid > self._max_confirmed:
+                    self._max_confirmed = mid
+            # 停止中の取り込みは last_id より後から読むので、入金中の通知より前までしか進めない
+            self.last_id = self._max_confirmed
+            if self._pending and self.last_id is not None:
+                self.last_id = min(self.last_id, min(self._pending) - 1)
+            self._evict()
+        self._worker.mark_dirty()
+
+    def _evict(self):
+        cutoff = time.time() - self.retention
+        while self._ids:
+            oldest = next(iter(self._ids))
+            if len(self._ids) <= self.max_size and snowflake_time(oldest) >= cutoff:
+                break
+            self._ids.popitem(last=False)
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    def _flush(self):
+        with self._lock:
+            data = json.dumps({"last_id": self.last_id, "ids": list(self._ids)})
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self._worker.close()
@@ -0,0 +1,196 @@
+import json
+import math
+import os
+import threading
+import time
+
+from persistence import FlushWorker
+
+# 経済全体の集計（/経済統計）
+#
+# ストアの observer として残高の変更を受け取り、総供給量・種類ごとの流入/流出・
+# 残高の分布を差分で更新する。表示のたびに全アカウントを走査しない。
+# 分布は相対誤差付きの対数ビンのスケッチ（DDSketch と同じ考え方）で持つので、
+# アカウント数が増えてもビンの数（数千）を超えず、分位点・ジニ係数はビンから求める。
+# スケッチは加算できるので、別々に集計したもの（プロセスごとなど）を merge() でまとめられる。
+# 分布の対象は残高が0でない人（保有者）だけ。流入/流出の累計はファイルに保存する。
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}  # ビン番号 -> 件数
+        self.negative = {}  # 負の値は絶対値でビンに入れる
+        self.zero = 0
+        self.count = 0
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    # ビンの代表値（ビンの中のどの値とも相対誤差 relative_accuracy 以内）
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    # n < 0 で取り除く（残高が変わったら古い値を取り除いて新しい値を入れる）
+    def add(self, value, n=1):
+        self.count += n
+        if value == 0:
+            self.zero += n
+            return
+        bins = self.positive if value > 0 else self.negative
+        index = self._index(abs(value))
+        count = bins.get(index, 0) + n
+        if count:
+            bins[index] = count
+        else:
+            del bins[index]
+
+    def remove(self, value):
+        self.add(value, -1)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("sketches with different accuracy cannot be merged")
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in theirs.items():
+                mine[index] = mine.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    # 小さい順の (代表値, 件数)
+    def _groups(self):
+        for index in sorted(self.negative, reverse=True):
+            yield -self._value(index), self.negative[index]
+        if self.zero:
+            yield 0, self.zero
+        for index in sorted(self.positive):
+            yield self._value(index), self.positive[index]
+
+    def quantile(self, q):
+        if self.count <= 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self._groups():
+            seen += count
+            if seen > rank:
+                return value
+        return None
+
+    # ジニ係数。同じビンの中の差は0とみなす
+    def gini(self):
+        groups = list(self._groups())
+        total = sum(value * count for value, count in groups)
+        if self.count <= 0 or total <= 0:
+            return None
+        below = 0
+        pairwise = 0
+        for value, count in groups:
+            above = self.count - below - count
+            pairwise += value * count * (below - above)
+            below += count
+        return pairwise / (self.count * total)
+
+
+class EconomyStats:
+    def __init__(self, path, relative_accuracy=0.01, flush_interval=1.0):
+        self.path = path
+        self.relative_accuracy = relative_accuracy
+        self.supply = 0
+        self.sketch = QuantileSketch(relative_accuracy)
+        # 種類（history.KIND_*）ごとの残高の増加 / 減少の累計
+        self.inflow = {}
+        self.outflow = {}
+        self.since = time.time()
+        self._source = None
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, interval=flush_interval, name="velt-economy")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.inflow = {int(kind): amount for kind, amount in data["in"].items()}
+            self.outflow = {int(kind): amount for kind, amount in data["out"].items()}
+            self.since = data["since"]
+        except FileNotFoundError:
+            pass
+        self._worker.start()
+
+    # 総供給量と分布は最初に使われたときに全件から作る（起動時に全アカウントを読まない）
+    def set_source(self, source):
+        self._source = source
+
+    def _ensure(self):
+        if self._source is not None:
+            source, self._source = self._source, None
+            self.rebuild(source())
+
+    def rebuild(self, items):
+        self._source = None
+        supply = 0
+        sketch = QuantileSketch(self.relative_accuracy)
+        for _, balance in items:
+            if balance:
+                supply += balance
+                sketch.add(balance)
+        self.supply = supply
+        self.sketch = sketch
+
+    def on_change(self, changes, kind, counterparty=None):
+        with self._lock:
+            for _, delta, balance in changes:
+                if delta > 0:
+                    self.inflow[kind] = self.inflow.get(kind, 0) + delta
+                elif delta < 0:
+                    self.outflow[kind] = self.outflow.get(kind, 0) - delta
+                if self._source is not None or not delta:
+                    continue
+                self.supply += delta
+                old = balance - delta
+                if old:
+                    self.sketch.remove(old)
+                if balance:
+                    self.sketch.add(balance)
+        self._worker.mark_dirty()
+
+    def on_reset(self):
+        if self._source is not None:
+            return
+        self.supply = 0
+        self.sketch = QuantileSketch(self.relative_accuracy)
+
+    def summary(self):
+        self._ensure()
+        sketch = self.sketch
+        return {
+            "supply": self.supply,
+            "holders": sketch.count,
+            "mean": self.supply / sketch.count if sketch.count else None,
+            "quantiles": {q: sketch.quantile(q) for q in (0.1, 0.5, 0.9, 0.99)},
+            "gini": sketch.gini(),
+        }
+
+    # 種類ごとの (流入, 流出, 差し引き)
+    def flow(self, kind):
+        inflow = self.inflow.get(kind, 0)
+        outflow = self.outflow.get(kind, 0)
+        return inflow, outflow, inflow - outflow
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    def _flush(self):
+        with self._lock:
+            data = json.dumps({"since": self.since, "in": self.inflow, "out": self.outflow})
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self._worker.close()
@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import weakref
+
+# 残高エンジン：残高チェックと増減をユーザー単位のロックの中でまとめて行う
+#
+# ロックはユーザーごとに分けているので、無関係なユーザー同士は待ち合わせない。
+# 使われなくなったロックは WeakValueDictionary から自動で消える。
+# 残高チェックと引き落としそのものはストアの try_debit / transfer / debit_up_to で行うので、
+# 共有ストア（SharedSqliteBalanceStore）なら別のプロセスとの競合も DB のトランザクションで防がれる。
+# ストアへの書き込みは store.run() を通す（共有ストアは DB のロック待ちでイベントループを止めないようスレッドで行う）。
+
+
+class BalanceEngine:
+    def __init__(self, store):
+        self.store = store
+        self._locks = weakref.WeakValueDictionary()
+
+    def lock_for(self, user_id):
+        uid = str(user_id)
+        lock = self._locks.get(uid)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[uid] = lock
+        return lock
+
+    def get(self, user_id):
+        return self.store.get(user_id)
+
+    # kind は変更の種類（history.KIND_*）。履歴などの observer に渡る
+    async def credit(self, user_id, amount, kind=0, counterparty=None):
+        async with self.lock_for(user_id):
+            return await self.store.run(self.store.add, user_id, amount, kind, counterparty)
+
+    # まとめて加算する（ロール発行など）。加算は1回の書き込みで反映されるので、
+    # 残高チェックと引き落としの間（ストアの1回の操作の中）に混ざることはない
+    async def credit_many(self, deltas, kind=0):
+        await self.store.run(self.store.add_many, list(deltas), kind)
+
+    async def reset_all(self):
+        await self.store.run(self.store.reset_all)
+
+    # 残高が足りれば引き落として True、足りなければ何もせず False
+    async def try_debit(self, user_id, amount, kind=0, counterparty=None):
+        async with self.lock_for(user_id):
+            return await self.store.run(self.store.try_debit, user_id, amount, kind, counterparty)
+
+    # 送金。デッドロックを避けるため2人分のロックは常にID順で取る
+    async def transfer(self, from_id, to_id, amount, kind=0):
+        first, second = sorted((str(from_id), str(to_id)))
+        async with self.lock_for(first), self.lock_for(second):
+            return await self.store.run(self.store.transfer, from_id, to_id, amount, kind)
+
+    # 複数の預かりをまとめて精算する（テーブルゲーム用）。[(escrow, net), ...] を受け取り、
+    # 実際に反映した損益のリストを返す。払い戻しは add_many の1回の書き込みでまとめて反映する
+    async def settle_many(self, settlements, kind=0):
+        results = []
+        credits = []
+        async with contextlib.AsyncExitStack() as stack:
+            for uid in sorted({str(escrow.user_id) for escrow, _ in settlements}):
+                await stack.enter_async_context(self.lock_for(uid))
+            for escrow, net in settlements:
+                if escrow.settled:
+                    results.append(0)
+                    continue
+                escrow.settled = True
+                back = escrow.stake + net
+                if back >= 0:
+                    if back:
+                        credits.append((escrow.user_id, back))
+                    results.append(net)
+                else:
+                    # 掛け金を超える負けは残高の範囲でだけ引き落とす
+                    extra = await self.store.run(self.store.debit_up_to, escrow.user_id, -back, kind)
+                    results.append(-(escrow.stake + extra))
+            if credits:
+                await self.store.run(self.store.add_many, credits, kind)
+        return results
+
+    # 掛け金を先に預かる。残高が足りなければ None
+    async def reserve(self, user_id, stake, kind=0):
+        if not await self.try_debit(user_id, stake, kind):
+            return None
+        return Escrow(self, user_id, stake, kind)
+
+
+# 預かり中の掛け金。結果が出たら settle / refund で1回だけ精算する
+class Escrow:
+    def __init__(self, engine, user_id, stake, kind=0):
+        self.engine = engine
+        self.user_id = user_id
+        self.stake = stake
+        self.kind = kind
+        self.settled = False
+
+    # net は掛け金に対する損益（勝ちなら正、負けなら負）。実際に反映した損益を返す
+    # 掛け金を超える負けは残高の範囲でだけ引き落とす（残高がマイナスにならない）
+    async def settle(self, net):
+        if self.settled:
+            return 0
+        self.settled = True
+        engine = self.engine
+        async with engine.lock_for(self.user_id):
+            back = self.stake + net
+            if back >= 0:
+                if back:
+                    await engine.store.run(engine.store.add, self.user_id, back, self.kind)
+                return net
+            extra = await engine.store.run(engine.store.debit_up_to, self.user_id, -back, self.kind)
+            return -(self.stake + extra)
+
+    async def refund(self):
+        return await self.settle(0)
@@ -0,0 +1,224 @@
+import random
+from collections import namedtuple
+from fractions import Fraction
+
+# ゲームのルール（Discord に依存しない純粋な関数）
+#
+# bot.py のゲームとシミュレーター（simulate.py）の両方がここを使う。
+# 配当はすべて「掛け金に対する損益の倍率」で返す。勝ちなら正、負けなら負。
+# rng は random モジュールと同じ choice / randint を持つもの（Bot では outcomes.OutcomeStream）。
+
+BET_SIZES = [1000, 5000, 10000]
+
+# --- スロット ---
+# 絵柄を7種類に変更
+SLOT_SYMBOLS = ["🍒", "🍋", "🔔", "⭐", "7️⃣", "🍉", "🍇"]
+
+
+def slot_spin(rng=random):
+    return [rng.choice(SLOT_SYMBOLS) for _ in range(3)]
+
+
+# 1回の勝負: 3回回し、i 回目の i 番目の絵柄を結果にする。(3回分の出目, 結果) を返す
+def slot_round(rng=random):
+    spins = [slot_spin(rng) for _ in range(3)]
+    return spins, [spin[i] for i, spin in enumerate(spins)]
+
+
+# 3つ揃いで10倍、2つ揃いで2倍、はずれは掛け金を失う
+def slot_multiplier(reels):
+    if reels[0] == reels[1] == reels[2]:
+        return 10  # ★ 5倍→10倍に修正
+    if reels[0] == reels[1] or reels[1] == reels[2] or reels[0] == reels[2]:
+        return 2
+    return -1
+
+
+# --- ちんちろ ---
+# 役の判定（出目の表を作るときにだけ使う。ゲーム中は chinchiro_hand で表を引く）
+def chinchiro_judge(dice):
+    dice = sorted(dice)
+    # ピンゾロ
+    if dice == [1, 1, 1]:
+        return ("ピンゾロ", 100)
+    # ゾロ目（2ゾロ～6ゾロ）
+    if dice[0] == dice[1] == dice[2]:
+        return (f"{dice[0]}ゾロ", 100 - dice[0])  # 数字が小さいほど強い
+    # シゴロ
+    if dice == [4, 5, 6]:
+        return ("シゴロ", 90)
+    # ヒフミ
+    if dice == [1, 2, 3]:
+        return ("ヒフミ", -10)
+    # 通常の目
+    if dice[0] == dice[1]:
+        return (f"{dice[2]}の目", dice[2])
+    if dice[1] == dice[2]:
+        return (f"{dice[0]}の目", dice[0])
+    # 役なし
+    return ("役なし", 0)
+
+
+# 役の強さ比較
+def yaku_rank(score):
+    if score >= 90: return score  # ピンゾロ・ゾロ目・シゴロ
+    if score > 0: return 10 + score  # 通常の目
+    if score == 0: return 0  # 役なし
+    if score == -10: return -10  # ヒフミ
+    return -100
+
+
+# 1つの出目（順序あり）の判定結果
+# win_multiplier: この目でユーザーが勝ったときの倍率
+# loss_multiplier / loss_result: この目のBOTに負けたときに払う倍率と結果
+ChinchiroHand = namedtuple(
+    "ChinchiroHand", ["dice", "yaku", "score", "rank", "win_multiplier", "loss_multiplier", "loss_result"]
+)
+
+
+def _win_multiplier(score):
+    if score >= 90:  # ピンゾロ・ゾロ目・シゴロ
+        return zoro_multiplier(score)
+    if score > 0:
+        return score
+    return 2
+
+
+def _loss(score):
+    if score == -10:  # ヒフミ
+        return 2, "hifumi"
+    if score >= 90:
+        return zoro_multiplier(score), "zoro"
+    if score > 0:
+        return score, "lose"
+    return 1, "lose"
+
+
+# ゾロ目・シゴロの倍率
+def zoro_multiplier(score):
+    if score == 100:
+        return 5
+    if score == 99:
+        return 3
+    return 2
+
+
+def _dice_code(dice):
+    return (dice[0] - 1) * 36 + (dice[1] - 1) * 6 + (dice[2] - 1)
+
+
+# 出目216通りすべての判定を起動時に1回だけ作っておく
+def _build_chinchiro_table():
+    table = []
+    for a in range(1, 7):
+        for b in range(1, 7):
+            for c in range(1, 7):
+                yaku, score = chinchiro_judge((a, b, c))
+                loss_multiplier, loss_result = _loss(score)
+                table.append(ChinchiroHand(
+                    (a, b, c), yaku, score, yaku_rank(score),
+                    _win_multiplier(score), loss_multiplier, loss_result,
+                ))
+    return tuple(table)
+
+
+CHINCHIRO_TABLE = _build_chinchiro_table()
+
+
+def chinchiro_hand(dice):
+    return CHINCHIRO_TABLE[_dice_code(dice)]
+
+
+def chinchiro_dice(rng=random):
+    return [rng.randint(1, 6) for _ in range(3)]
+
+
+# 役が出るまで最大3回振る。(dice, hand, 回数) を返す
+def chinchiro_roll(rng=random):
+    rolls = chinchiro_rolls(rng)
+    dice, hand = rolls[-1]
+    return dice, hand, len(rolls)
+
+
+# 役が出るまで最大3回振り、途中の出目も含めて [(dice, hand), ...] を返す（演出用）
+def chinchiro_rolls(rng=random):
+    rolls = []
+    for _ in range(3):
+        dice = chinchiro_dice(rng)
+        hand = chinchiro_hand(dice)
+        rolls.append((dice, hand))
+        if hand.score != 0:
+            break
+    return rolls
+
+
+# 1回の勝負: ユーザー、BOTの順に振る。(ユーザーの出目, BOTの出目) を返す
+def chinchiro_round(rng=random):
+    return chinchiro_rolls(rng), chinchiro_rolls(rng)
+
+
+# ユーザーとBOTの目から (損益の倍率, 結果) を返す
+# 結果は "win" / "hifumi" / "zoro" / "lose" / "draw"
+def chinchiro_settle(user_hand, bot_hand):
+    if user_hand.rank > bot_hand.rank:
+        return user_hand.win_multiplier, "win"
+    if user_hand.rank < bot_hand.rank:
+        return -bot_hand.loss_multiplier, bot_hand.loss_result
+    return 0, "draw"
+
+
+# 役の点数から (損益の倍率, 結果) を返す
+def chinchiro_outcome(user_score, bot_score):
+    return chinchiro_settle(_HAND_BY_SCORE[user_score], _HAND_BY_SCORE[bot_score])
+
+
+_HAND_BY_SCORE = {hand.score: hand for hand in CHINCHIRO_TABLE}
+
+
+# 表から求めた厳密な確率。{損益の倍率: 確率(Fraction)} を返す
+def chinchiro_exact_odds():
+    # 最大3回振ったあとの最終的な点数の分布
+    one_roll = {}
+    for hand in CHINCHIRO_TABLE:
+        one_roll[hand.score] = one_roll.get(hand.score, 0) + Fraction(1, len(CHINCHIRO_TABLE))
+    p_none = one_roll.get(0, Fraction(0))
+    final = {}
+    for score, p in one_roll.items():
+        if score == 0:
+            final[score] = p_none ** 3
+        else:
+            final[score] = p * (1 + p_none + p_none ** 2)
+    odds = {}
+    for user_score, pu in final.items():
+        for bot_score, pb in final.items():
+            multiplier, _ = chinchiro_outcome(user_score, bot_score)
+            odds[multiplier] = odds.get(multiplier, 0) + pu * pb
+    return odds
+
+
+# --- ブラックジャック ---
+def blackjack_draw(rng=random):
+    return rng.randint(1, 10)
+
+
+def blackjack_deal(rng=random):
+    return [blackjack_draw(rng), blackjack_draw(rng)]
+
+
+# BOTは17以上になるまで引く
+BLACKJACK_BOT_STAND = 17
+
+
+def blackjack_bot_should_draw(cards):
+    return sum(cards) < BLACKJACK_BOT_STAND
+
+
+# 合計から (損益の倍率, 結果) を返す。結果は "bust" / "win" / "lose" / "draw"
+def blackjack_outcome(player_total, bot_total):
+    if player_total > 21:
+        return -1, "bust"
+    if bot_total > 21 or player_total > bot_total:
+        return 1, "win"
+    if player_total < bot_total:
+        return -1, "lose"
+    return 0, "draw"
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+
+from persistence import FlushWorker
+
+# サーバー（guild）ごとの設定と経済
+#
+# 1つのプロセスで複数のサーバーを受け持つため、管理者・ログチャンネル・VirtualCrypto の
+# チャンネルと入金先などはサーバーごとの GuildConfig に持つ。設定は1つの JSON ファイルに
+# 保存し、メモリのキャッシュから引く（書き込みは FlushWorker のスレッド）。
+# 残高はサーバーごとに別のストア（別のファイル）に分け、GuildEconomy にまとめる。
+# ロールの発行ルールもそのストアのロール設定に入るので、サーバーごとに分かれる。
+
+
+class GuildConfig:
+    __slots__ = (
+        "guild_id", "admin_ids", "log_channel_id", "crypto_channel_id", "target_user_id", "target_username",
+        "sync_hash",
+    )
+
+    def __init__(self, guild_id, admin_ids=(), log_channel_id=0, crypto_channel_id=0, target_user_id=0,
+                 target_username="", sync_hash=None):
+        self.guild_id = guild_id
+        self.admin_ids = list(admin_ids)
+        self.log_channel_id = log_channel_id
+        self.crypto_channel_id = crypto_channel_id
+        self.target_user_id = target_user_id
+        self.target_username = target_username
+        # 最後に同期したコマンドのハッシュ（変わっていなければ同期しない）
+        self.sync_hash = sync_hash
+
+    def to_record(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != "guild_id"}
+
+    @classmethod
+    def from_record(cls, guild_id, data):
+        return cls(guild_id, **{name: value for name, value in data.items() if name in cls.__slots__})
+
+
+class GuildConfigStore:
+    def __init__(self, path, defaults=()):
+        self.path = path
+        # ファイルにまだないサーバーの初期設定（環境変数で指定していた既定のサーバーなど）
+        self.defaults = {config.guild_id: config for config in defaults}
+        self._configs = {}
+        self._by_crypto_channel = {}
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, name="velt-guilds")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self._configs = dict(self.defaults)
+        for guild_id, record in data.items():
+            self._configs[int(guild_id)] = GuildConfig.from_record(int(guild_id), record)
+        self._reindex()
+        self._worker.start()
+
+    def _reindex(self):
+        self._by_crypto_channel = {
+            config.crypto_channel_id: config for config in self._configs.values() if config.crypto_channel_id
+        }
+
+    def get(self, guild_id):
+        config = self._configs.get(guild_id)
+        return config if config is not None else GuildConfig(guild_id)
+
+    def all(self):
+        return list(self._configs.values())
+
+    # VirtualCrypto の通知を監視しているチャンネルならそのサーバーの設定、違えば None
+    def for_crypto_channel(self, channel_id):
+        return self._by_crypto_channel.get(channel_id)
+
+    def update(self, guild_id, **changes):
+        with self._lock:
+            config = self._configs.get(guild_id) or GuildConfig(guild_id)
+            for name, value in changes.items():
+                setattr(config, name, value)
+            self._configs[guild_id] = config
+            self._reindex()
+        self._worker.mark_dirty()
+        return config
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    def _flush(self):
+        with self._lock:
+            data = json.dumps(
+                {str(guild_id): config.to_record() for guild_id, config in self._configs.items()},
+                ensure_ascii=False,
+            )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self._worker.close()
+
+
+# 1つのサーバーの残高ストアと、その observer（ランキング・履歴・集計）
+class GuildEconomy:
+    def __init__(self, guild_id, store, engine, leaderboard, history, stats):
+        self.guild_id = guild_id
+        self.store = store
+        self.engine = engine
+        self.leaderboard = leaderboard
+        self.history = history
+        self.stats = stats
+
+    def load(self):
+        self.store.load()
+        # ランキングと集計は最初に使われたときに全件から作る（起動時に全アカウントを読まない）
+        self.leaderboard.set_source(self.store.items)
+        self.store.add_observer(self.leaderboard)
+        self.history.load()
+        self.store.add_observer(self.history)
+        self.stats.load()
+        self.stats.set_source(self.store.items)
+        self.store.add_observer(self.stats)
+
+    # 共有ストアで他のプロセスの変更を取り込む
+    def refresh(self):
+        items = list(self.store.items())
+        self.leaderboard.rebuild(items)
+        self.stats.rebuild(items)
+
+    def close(self):
+        self.store.close()
+        self.history.close()
+        self.stats.close()
+
+
+# サーバーに登録するコマンドの内容のハッシュ（同期が必要かどうかの判定用）
+def command_hash(payloads):
+    data = json.dumps(payloads, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
@@ -0,0 +1,209 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from persistence import FlushWorker
+
+# ユーザーごとの取引履歴
+#
+# 残高の変更1件を固定長のバイナリレコードとして追記専用ファイルに書く。
+# 各レコードは「同じユーザーの1つ前のレコード番号」を持っているので、
+# ユーザーごとの最新レコード番号（head）さえ分かれば、seek だけで新しい順にたどれる。
+# head の一覧は一定件数ごとに索引ファイルへ保存し、起動時はそれ以降の分だけを読む。
+# 読み込みは mmap、書き込みは FlushWorker のスレッドで行う。
+
+# 変更の種類
+KIND_OTHER = 0
+KIND_ISSUE = 1        # 発行
+KIND_REVOKE = 2       # 減少
+KIND_TRANSFER = 3     # 送金
+KIND_ROLE_ISSUE = 4   # ロール発行
+KIND_DEPOSIT = 5      # バーチャルクリプト送金検知
+KIND_SLOT = 6
+KIND_CHINCHIRO = 7
+KIND_BLACKJACK = 8
+
+KIND_LABELS = {
+    KIND_OTHER: "その他",
+    KIND_ISSUE: "発行",
+    KIND_REVOKE: "減少",
+    KIND_TRANSFER: "送金",
+    KIND_ROLE_ISSUE: "ロール発行",
+    KIND_DEPOSIT: "VC入金",
+    KIND_SLOT: "スロット",
+    KIND_CHINCHIRO: "ちんちろ",
+    KIND_BLACKJACK: "ブラックジャック",
+}
+
+# 時刻, ユーザー, 相手, 増減, 変更後の残高, 同じユーザーの前のレコード番号, 種類
+RECORD = struct.Struct("<qqqqqqH6x")
+
+
+class HistoryEntry:
+    __slots__ = ("timestamp", "user_id", "counterparty", "delta", "balance", "kind")
+
+    def __init__(self, timestamp, user_id, counterparty, delta, balance, kind):
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.counterparty = counterparty
+        self.delta = delta
+        self.balance = balance
+        self.kind = kind
+
+    @property
+    def label(self):
+        return KIND_LABELS.get(self.kind, KIND_LABELS[KIND_OTHER])
+
+
+class TransactionHistory:
+    def __init__(self, path, index_path=None, index_every=10000):
+        self.path = path
+        self.index_path = index_path or path + ".idx"
+        self.index_every = index_every
+        self.count = 0
+        self._heads = {}            # user_id -> 最新のレコード番号（未書き込み分を含む）
+        self._flushed_count = 0
+        self._flushed_heads = {}    # ファイルに書き込み済みの分だけの head
+        self._indexed_count = 0
+        self._pending = {}          # レコード番号 -> 未書き込みのバイト列
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, name="velt-history")
+
+    def load(self):
+        self._file = open(self.path, "ab+")
+        size = os.path.getsize(self.path)
+        count = size // RECORD.size
+        # 書き込み途中でクラッシュした末尾は切り捨てる
+        if size != count * RECORD.size:
+            self._file.truncate(count * RECORD.size)
+
+        indexed = 0
+        heads = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data["count"] <= count:
+                indexed = data["count"]
+                heads = {int(uid): idx for uid, idx in data["heads"].items()}
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        # 索引より後のレコードだけを読んで head を追いつかせる
+        self._remap(count)
+        for idx in range(indexed, count):
+            _, user_id, *_ = RECORD.unpack_from(self._map, idx * RECORD.size)
+            heads[user_id] = idx
+
+        self.count = count
+        self._flushed_count = count
+        self._indexed_count = indexed
+        self._heads = heads
+        self._flushed_heads = dict(heads)
+        self._worker.start()
+
+    def _remap(self, count):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if count:
+            self._map = mmap.mmap(self._file.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+
+    def record(self, user_id, delta, balance, kind=KIND_OTHER, counterparty=None, timestamp=None):
+        uid = int(user_id)
+        with self._lock:
+            idx = self.count
+            prev = self._heads.get(uid, -1)
+            self._pending[idx] = RECORD.pack(
+                int(timestamp if timestamp is not None else time.time()),
+                uid, int(counterparty or 0), delta, balance, prev, kind,
+            )
+            self._heads[uid] = idx
+            self.count += 1
+        self._worker.mark_dirty()
+
+    # --- ストアの observer ---
+    def on_change(self, changes, kind, counterparty=None):
+        now = int(time.time())
+        for user_id, delta, balance in changes:
+            self.record(user_id, delta, balance, kind, counterparty, now)
+
+    def on_reset(self):
+        # リセットは全員分の記録を残さない（ログチャンネルに記録される）
+        pass
+
+    def _read(self, idx):
+        with self._lock:
+            data = self._pending.get(idx)
+        if data is None:
+            if self._map is None or (idx + 1) * RECORD.size > len(self._map):
+                self._remap(self._flushed_count)
+            data = self._map[idx * RECORD.size:(idx + 1) * RECORD.size]
+        return RECORD.unpack(data)
+
+    # ユーザーの履歴を新しい順に offset 件飛ばして limit 件返す
+    def recent(self, user_id, offset=0, limit=10):
+        entries = []
+        idx = self._heads.get(int(user_id), -1)
+        skipped = 0
+        while idx >= 0 and len(entries) < limit:
+            timestamp, uid, counterparty, delta, balance, prev, kind = self._read(idx)
+            if skipped < offset:
+                skipped += 1
+            else:
+                entries.append(HistoryEntry(timestamp, uid, counterparty or None, delta, balance, kind))
+            idx = prev
+        return entries
+
+    def pending(self):
+        return len(self._pending)
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    # ワーカースレッドで実行される
+    def _flush(self):
+        with self._lock:
+            start = self._flushed_count
+            end = self.count
+            chunks = [self._pending[idx] for idx in range(start, end)]
+        if not chunks:
+            return
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for idx, data in enumerate(chunks, start):
+            _, user_id, *_ = RECORD.unpack(data)
+            self._flushed_heads[user_id] = idx
+        with self._lock:
+            for idx in range(start, end):
+                del self._pending[idx]
+            self._flushed_count = end
+        if end - self._indexed_count >= self.index_every:
+            self._write_index(end)
+
+    def _write_index(self, count):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"count": count, "heads": self._flushed_heads}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self._indexed_count = count
+
+    def close(self):
+        if self._file is None:
+            return
+        self._worker.close()
+        if self._flushed_count != self._indexed_count:
+            self._write_index(self._flushed_count)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._file = None
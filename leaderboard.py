@@ -0,0 +1,183 @@
+import random
+
+# 残高ランキングの索引
+#
+# (残高の降順, ユーザーID) の順に並べた treap（部分木のサイズ付き）で、
+# 更新・順位・k番目の取得がどれも O(log n)。ストアの observer として登録し、
+# 残高が変わるたびに差分だけ更新する。リセット時は全件を1回で作り直す。
+# set_source() で全件の読み出し方を渡しておくと、最初に使われたときに作る（起動を速くするため）。
+
+
+class _Node:
+    __slots__ = ("key", "priority", "left", "right", "size")
+
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.size = 1
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _fix(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+# key 未満の木と key 以上の木に分ける
+def _split(node, key):
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        _fix(node)
+        return node, right
+    left, right = _split(node.left, key)
+    node.left = right
+    _fix(node)
+    return left, node
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _fix(a)
+        return a
+    b.left = _merge(a, b.left)
+    _fix(b)
+    return b
+
+
+class Leaderboard:
+    def __init__(self):
+        self._root = None
+        self._keys = {}  # user_id(int) -> 木のキー
+        self._random = random.Random()
+        self._source = None  # 未構築なら全件を返す関数
+
+    def __len__(self):
+        self._ensure()
+        return len(self._keys)
+
+    # 最初に使われたときに source() の全件から作る。それまでの変更は source に含まれるので捨ててよい
+    def set_source(self, source):
+        self._source = source
+        self._root = None
+        self._keys = {}
+
+    def _ensure(self):
+        if self._source is not None:
+            source, self._source = self._source, None
+            self.rebuild(source())
+
+    @staticmethod
+    def _key(user_id, balance):
+        return (-balance, user_id)
+
+    # ソート済みの全件から1回で木を作る（スタックでデカルト木を組み立てる）
+    def rebuild(self, items):
+        self._source = None
+        keys = {int(uid): self._key(int(uid), balance) for uid, balance in items}
+        stack = []
+        for key in sorted(keys.values()):
+            node = _Node(key, self._random.random())
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+                _fix(last)
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        while len(stack) > 1:
+            _fix(stack.pop())
+        if stack:
+            _fix(stack[0])
+        self._root = stack[0] if stack else None
+        self._keys = keys
+
+    def update(self, user_id, balance):
+        if self._source is not None:
+            return
+        uid = int(user_id)
+        key = self._key(uid, balance)
+        old = self._keys.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            self._remove(old)
+        left, right = _split(self._root, key)
+        self._root = _merge(_merge(left, _Node(key, self._random.random())), right)
+        self._keys[uid] = key
+
+    def _remove(self, key):
+        left, rest = _split(self._root, key)
+        _, right = _split(rest, (key[0], key[1] + 1))
+        self._root = _merge(left, right)
+
+    # 1始まりの順位（未登録なら None）
+    def rank(self, user_id):
+        self._ensure()
+        key = self._keys.get(int(user_id))
+        if key is None:
+            return None
+        count = 0
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                count += _size(node.left) + 1
+                node = node.right
+            elif key < node.key:
+                node = node.left
+            else:
+                return count + _size(node.left) + 1
+        return None
+
+    # offset 番目（0始まり）から limit 件を (user_id, balance) で返す
+    def page(self, offset, limit):
+        self._ensure()
+        result = []
+        stack = []
+        node = self._root
+        skip = offset
+        # offset 番目までは部分木のサイズを使って読み飛ばす
+        while node is not None:
+            left = _size(node.left)
+            if skip < left:
+                stack.append(node)
+                node = node.left
+            elif skip == left:
+                stack.append(node)
+                node = None
+            else:
+                skip -= left + 1
+                node = node.right
+        while stack and len(result) < limit:
+            node = stack.pop()
+            result.append((node.key[1], -node.key[0]))
+            child = node.right
+            while child is not None:
+                stack.append(child)
+                child = child.left
+        return result
+
+    def top(self, limit):
+        return self.page(0, limit)
+
+    # --- ストアの observer ---
+    def on_change(self, changes, kind, counterparty=None):
+        for user_id, _, balance in changes:
+            self.update(user_id, balance)
+
+    def on_reset(self):
+        if self._source is not None:
+            return
+        self.rebuild((uid, 0) for uid in list(self._keys))
@@ -0,0 +1,375 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import snapshot as snapshot_format
+from persistence import FlushWorker
+from snapshot import BalanceSnapshot
+
+# 残高の追記専用ログ（WAL）と定期スナップショット
+#
+# 1件の変更につき1行の短いレコードを追記するだけなので、書き込みコストは
+# アカウント数に依存しない。ファイルへの書き込み・fsync・スナップショットの
+# シリアライズはすべて FlushWorker のスレッドで行い、イベントループはメモリ上の
+# バッファに積むだけにする。
+# レコードには変更後の残高をそのまま記録するため、同じレコードを
+# 何度リプレイしても結果は変わらない（スナップショット直後のクラッシュでも二重計上しない）。
+#
+# スナップショットはバイナリ形式（snapshot.py）を mmap して引くだけで、メモリ上の overlay には
+# 起動後に変更されたアカウントだけを持つ。スナップショットを書き直したら、その内容と同じ値の
+# overlay は捨てる。旧形式の JSON スナップショットしかなければ、起動時に読み込んで変換する。
+#
+# archive_dir を指定すると、スナップショットで不要になったログを捨てずに連番のセグメントとして
+# 残し、archive_every 回に1回はそのときのスナップショットもハードリンクで残す（audit.py 用）。
+# segment-<n>.log は n-1 番と n 番のスナップショットの間のレコードで、
+# snapshot-<n>-<時刻>.snap はセグメント n まで反映した残高。全員リセットはログに {"r": 1} で残す。
+
+ARCHIVE_SEGMENT = "segment-{seq:08d}.log"
+ARCHIVE_SNAPSHOT = "snapshot-{seq:08d}-{taken_at}.snap"
+_ARCHIVE_PATTERN = re.compile(r"^(segment|snapshot)-(\d+)(?:-(\d+))?\.(?:log|snap)$")
+
+
+# アーカイブの中身を ([(n, path)], [(n, 時刻, path)]) の番号順で返す
+def list_archive(archive_dir):
+    segments = []
+    snapshots = []
+    try:
+        names = os.listdir(archive_dir)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        m = _ARCHIVE_PATTERN.match(name)
+        if m is None:
+            continue
+        path = os.path.join(archive_dir, name)
+        if m.group(1) == "segment":
+            segments.append((int(m.group(2)), path))
+        else:
+            snapshots.append((int(m.group(2)), int(m.group(3) or 0), path))
+    segments.sort()
+    snapshots.sort()
+    return segments, snapshots
+
+
+# ログのレコードを1件ずつ返す（書き込み途中の末尾の行は読まない）
+def iter_log(path):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+class BalanceLedger:
+    def __init__(self, snapshot_path, log_path=None, fsync_interval=0.2, snapshot_every=5000, legacy_path=None,
+                 archive_dir=None, archive_every=10):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path or snapshot_path + ".log"
+        # スナップショット書き込み中に退避しておくログ
+        self.rotated_path = self.log_path + ".1"
+        # 旧形式（JSON）のスナップショット
+        self.legacy_path = legacy_path
+        self.snapshot_every = snapshot_every
+        self.archive_dir = archive_dir
+        self.archive_every = archive_every
+        self._archive_seq = 0
+        # 変更されたアカウントの残高 {user_id(str): balance}。それ以外は snapshot を引く
+        self.balances = None
+        self.snapshot = BalanceSnapshot()
+        # 全員リセット後、次のスナップショットまでは snapshot 側の残高を0とみなす
+        self._zero_base = False
+        self._resets = 0
+        self._file = None
+        # まだ書き込んでいないレコード（スナップショット前 / 後）
+        self._buffer = []
+        self._pre_snapshot = []
+        self._pending_snapshot = None
+        self._since_snapshot = 0
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, interval=fsync_interval, name="velt-ledger")
+
+    # スナップショットを開き、その上にログをリプレイする
+    # スナップショットが壊れていたら SnapshotError（空の残高で起動しない）
+    def load_into(self, balances):
+        self.balances = balances
+        self.snapshot = BalanceSnapshot.open(self.snapshot_path)
+        migrated = False
+        if self.legacy_path and not os.path.exists(self.snapshot_path):
+            try:
+                with open(self.legacy_path, "r", encoding="utf-8") as f:
+                    balances.update(json.load(f))
+                migrated = True
+            except FileNotFoundError:
+                pass
+
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            segments, snapshots = list_archive(self.archive_dir)
+            self._archive_seq = max([seq for seq, _ in segments] + [seq for seq, _, _ in snapshots], default=0)
+            # アーカイブを始める前からあった残高は、最初のスナップショットとして残す
+            if not snapshots and not segments and len(self.snapshot):
+                self._archive_snapshot(int(time.time()), force=True)
+
+        replayed = 0
+        for path in (self.rotated_path, self.log_path):
+            replayed += self._replay(path, balances)
+
+        # リカバリ直後にコンパクションしてログと overlay を空にしておく
+        if replayed or migrated or os.path.exists(self.rotated_path):
+            self._write_snapshot((dict(balances), self._zero_base, self._resets))
+            if migrated:
+                # 旧形式から変換した残高には履歴がないので、ここをアーカイブの起点にする
+                self._archive_snapshot(int(time.time()), force=True)
+            else:
+                self._archive_logs((self.rotated_path, self.log_path), int(time.time()))
+            open(self.log_path, "w", encoding="utf-8").close()
+            self._remove_rotated()
+
+        self._file = open(self.log_path, "a", encoding="utf-8")
+        self._worker.start()
+        return balances
+
+    def _replay(self, path, balances):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        count = 0
+        good_offset = 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break
+            if rec.get("r"):
+                # 全員リセット（スナップショット側も0とみなす）
+                balances.clear()
+                self._zero_base = True
+            else:
+                balances[rec["u"]] = rec["b"]
+            good_offset += len(line)
+            count += 1
+        # 書き込み途中でクラッシュした末尾の行は切り捨てる
+        if good_offset != len(data):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+        return count
+
+    # 1件の変更をバッファに積む（書き込みはワーカーがまとめて行う）
+    # kind / counterparty は監査用にレコードへ残すだけで、リプレイには使わない
+    def record(self, user_id, delta, balance, kind=None, counterparty=None):
+        self.record_many([(user_id, delta, balance)], kind, counterparty)
+
+    def get(self, user_id):
+        uid = str(user_id)
+        with self._lock:
+            balance = self.balances.get(uid)
+            if balance is not None:
+                return balance
+            if self._zero_base:
+                return 0
+            return self.snapshot.get(int(uid), 0)
+
+    # 変更されたアカウントとスナップショットを合わせた全件を (user_id(str), balance) で返す
+    def items(self):
+        with self._lock:
+            overlay = dict(self.balances)
+            zero_base = self._zero_base
+            snapshot = self.snapshot
+        for user_id, balance in snapshot:
+            uid = str(user_id)
+            if uid in overlay:
+                yield uid, overlay.pop(uid)
+            else:
+                yield uid, 0 if zero_base else balance
+        yield from overlay.items()
+
+    # (user_id, delta, balance) の列をまとめて積む（overlay もここで更新する）
+    def record_many(self, records, kind=None, counterparty=None):
+        now = int(time.time())
+        extra = {}
+        if kind:
+            extra["k"] = kind
+        if counterparty is not None:
+            extra["c"] = str(counterparty)
+        lines = [
+            json.dumps(
+                {"t": now, "u": str(user_id), "d": delta, "b": balance, **extra},
+                ensure_ascii=False, separators=(",", ":"),
+            )
+            for user_id, delta, balance in records
+        ]
+        if not lines:
+            return
+        with self._lock:
+            for user_id, _, balance in records:
+                self.balances[str(user_id)] = balance
+            self._buffer.extend(lines)
+            self._since_snapshot += len(lines)
+            if self._since_snapshot >= self.snapshot_every and self._pending_snapshot is None:
+                self._request_snapshot()
+        self._worker.mark_dirty()
+
+    # 全員の残高を0にする（次のスナップショットで確定する）
+    def reset(self):
+        line = json.dumps({"t": int(time.time()), "r": 1}, separators=(",", ":"))
+        with self._lock:
+            self._buffer.append(line)
+            self.balances.clear()
+            self._zero_base = True
+            self._resets += 1
+            self._request_snapshot()
+        self._worker.mark_dirty()
+
+    # 全残高をスナップショットにしてログを空にする（リセットなど一括変更用）
+    # 完了を待つ場合は durable() / wait_durable() を使う
+    def compact(self):
+        with self._lock:
+            self._request_snapshot()
+        self._worker.mark_dirty()
+
+    # この時点の overlay のコピーと、それ以前のレコードを切り分けておく
+    def _request_snapshot(self):
+        self._pending_snapshot = (dict(self.balances), self._zero_base, self._resets, int(time.time()))
+        self._pre_snapshot.extend(self._buffer)
+        self._buffer = []
+        self._since_snapshot = 0
+
+    # 書き込み待ちのレコード数
+    def pending(self):
+        return len(self._buffer) + len(self._pre_snapshot)
+
+    def durable(self):
+        return self._worker.durable()
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    # 以下はワーカースレッドで実行される
+    def _flush(self):
+        with self._lock:
+            snapshot, self._pending_snapshot = self._pending_snapshot, None
+            pre, self._pre_snapshot = self._pre_snapshot, []
+            lines, self._buffer = self._buffer, []
+        try:
+            if snapshot is None:
+                self._append(lines)
+                return
+            self._append(pre)
+            self._rotate()
+            self._append(lines)
+            self._write_snapshot(snapshot)
+            self._archive_logs((self.rotated_path,), snapshot[3])
+            self._remove_rotated()
+        except Exception:
+            # 失敗したレコードは戻して次回やり直す（重複して書かれても結果は同じ）
+            with self._lock:
+                self._buffer = lines + self._buffer
+                if snapshot is not None:
+                    self._pre_snapshot = pre + self._pre_snapshot
+                    if self._pending_snapshot is None:
+                        self._pending_snapshot = snapshot
+            raise
+
+    def _append(self, lines):
+        if not lines:
+            return
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    # 現在のログを退避して空のログに切り替える
+    def _rotate(self):
+        self._file.close()
+        if os.path.exists(self.rotated_path):
+            # 前回のスナップショットが失敗していたら退避済みのログに継ぎ足す
+            with open(self.log_path, "rb") as src, open(self.rotated_path, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            self._file = open(self.log_path, "w", encoding="utf-8")
+        else:
+            os.replace(self.log_path, self.rotated_path)
+            self._file = open(self.log_path, "a", encoding="utf-8")
+
+    # 今のスナップショットに overlay を重ねて書き直し、新しいファイルに切り替える
+    def _write_snapshot(self, pending):
+        overlay, zero_base, resets = pending[:3]
+        ids, balances = snapshot_format.merge(
+            self.snapshot, {int(uid): balance for uid, balance in overlay.items()}, zero_base
+        )
+        snapshot_format.write(self.snapshot_path, ids, balances)
+        new_snapshot = BalanceSnapshot.open(self.snapshot_path)
+        with self._lock:
+            # 古い mmap は読み取り中のものがなくなったら GC で閉じられる
+            self.snapshot = new_snapshot
+            # 書き込み中にまたリセットされていたら overlay はそのまま残す
+            if resets == self._resets:
+                self._zero_base = False
+                for uid, balance in overlay.items():
+                    if self.balances.get(uid) == balance:
+                        del self.balances[uid]
+
+    # スナップショットに反映したログを次の番号のセグメントとして残す
+    def _archive_logs(self, paths, taken_at):
+        if not self.archive_dir:
+            return
+        seq = self._archive_seq + 1
+        segment = os.path.join(self.archive_dir, ARCHIVE_SEGMENT.format(seq=seq))
+        if len(paths) == 1:
+            os.replace(paths[0], segment)
+        else:
+            tmp_path = segment + ".tmp"
+            with open(tmp_path, "wb") as dst:
+                for path in paths:
+                    try:
+                        with open(path, "rb") as src:
+                            shutil.copyfileobj(src, dst)
+                    except FileNotFoundError:
+                        pass
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, segment)
+        self._archive_seq = seq
+        self._archive_snapshot(taken_at)
+
+    # スナップショットのファイルは書き直すたびに新しく作られるので、ハードリンクで残せる
+    def _archive_snapshot(self, taken_at, force=False):
+        seq = self._archive_seq
+        if not self.archive_dir or (not force and seq % self.archive_every):
+            return
+        path = os.path.join(self.archive_dir, ARCHIVE_SNAPSHOT.format(seq=seq, taken_at=taken_at))
+        try:
+            os.link(self.snapshot_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(self.snapshot_path, path)
+
+    def _remove_rotated(self):
+        try:
+            os.remove(self.rotated_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._file is None:
+            return
+        self.compact()
+        self._worker.close()
+        self._file.close()
+        self._file = None
+        self.snapshot.close()
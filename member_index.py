@@ -0,0 +1,65 @@
+# ユーザー名・ニックネーム・表示名 → メンバーID の索引（サーバーごと）
+#
+# on_message でメンバー一覧を毎回線形探索しないよう、起動時に一度作り、
+# on_member_join / on_member_update / on_member_remove で差分だけ更新する。
+# 同じ名前のメンバーが複数いることがあるので、名前ごとにIDの集合を持つ。
+
+
+class MemberIndex:
+    def __init__(self):
+        self._by_name = {}  # guild_id -> {name: {member_id, ...}}
+        self._keys = {}     # guild_id -> {member_id: (name, ...)}
+
+    @staticmethod
+    def _names(member):
+        names = {member.name, member.display_name}
+        if member.nick:
+            names.add(member.nick)
+        global_name = getattr(member, "global_name", None)
+        if global_name:
+            names.add(global_name)
+        return tuple(names)
+
+    def build(self, guild):
+        self._by_name[guild.id] = {}
+        self._keys[guild.id] = {}
+        for member in guild.members:
+            self.add(member)
+
+    def add(self, member):
+        gid = member.guild.id
+        by_name = self._by_name.setdefault(gid, {})
+        keys = self._keys.setdefault(gid, {})
+        self._discard(gid, member.id)
+        names = self._names(member)
+        keys[member.id] = names
+        for name in names:
+            by_name.setdefault(name, set()).add(member.id)
+
+    # 名前が変わった場合も add で古い名前を外してから登録し直す
+    def update(self, member):
+        self.add(member)
+
+    def remove(self, member):
+        self._discard(member.guild.id, member.id)
+
+    def _discard(self, gid, member_id):
+        names = self._keys.get(gid, {}).pop(member_id, ())
+        by_name = self._by_name.get(gid, {})
+        for name in names:
+            ids = by_name.get(name)
+            if ids is None:
+                continue
+            ids.discard(member_id)
+            if not ids:
+                del by_name[name]
+
+    # 名前に一致するメンバーIDを1つ返す（見つからなければ None）
+    def find(self, guild_id, name):
+        ids = self._by_name.get(guild_id, {}).get(name)
+        if not ids:
+            return None
+        return min(ids)
+
+    def find_all(self, guild_id, name):
+        return self._by_name.get(guild_id, {}).get(name, set())
@@ -0,0 +1,280 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# 計測（Prometheus のテキスト形式で出す）
+#
+# カウンター・ゲージ・ヒストグラムだけの小さな実装。値の更新はワーカースレッドからも
+# 来るので、メトリクスごとにロックを持つ。出力は render()、HTTP は start_http_server() で
+# ローカルに /metrics を公開する。管理者向けの /統計 は quantile() でヒストグラムから概算する。
+
+log = logging.getLogger("velt.metrics")
+
+REGISTRY = []
+
+# 秒単位の既定のバケット（1ms ～ 30s）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # ラベル値のタプル -> 値
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+# fn を渡すと出力のたびに呼んで値を取る（{ラベル値のタプル: 値} または数値を返す）
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            values = self.fn()
+        except Exception:
+            log.exception("Failed to read gauge %s", self.name)
+            return []
+        if isinstance(values, dict):
+            return list(values.items())
+        return [((), values)]
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = _HistogramValue(len(self.buckets) + 1)
+                self._values[key] = h
+            h.counts[i] += 1
+            h.sum += value
+            h.count += 1
+            if value > h.max:
+                h.max = value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # バケットの中を線形補間して q 分位点を概算する
+    def quantile(self, q, **labels):
+        with self._lock:
+            h = self._values.get(self._key(labels))
+            if h is None or h.count == 0:
+                return None
+            counts = list(h.counts)
+            count = h.count
+            top = h.max
+        rank = q * count
+        seen = 0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else top
+                return min(lower + (upper - lower) * (rank - seen) / c, top)
+            seen += c
+        return top
+
+    def summary(self, **labels):
+        with self._lock:
+            h = self._values.get(self._key(labels))
+            if h is None:
+                return None
+            return h.count, h.sum, h.max
+
+    def keys(self):
+        with self._lock:
+            return list(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            values = [(key, list(h.counts), h.sum, h.count) for key, h in self._values.items()]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- 共通のメトリクス ---
+COMMAND_SECONDS = Histogram("velt_command_seconds", "スラッシュコマンドの処理時間", ["command", "status"])
+GAME_SECONDS = Histogram("velt_game_seconds", "ゲーム1回（ボタンを押してから精算まで）の時間", ["game"])
+ANIMATIONS = Counter("velt_animations_total", "演出のモードごとの回数（負荷で落としたものを含む）", ["mode"])
+FLUSH_SECONDS = Histogram("velt_flush_seconds", "永続化ワーカーの1回の書き込み時間", ["worker"])
+FLUSH_ERRORS = Counter("velt_flush_errors_total", "永続化ワーカーの書き込み失敗", ["worker"])
+DISCORD_API_CALLS = Counter("velt_discord_api_calls_total", "Discord API の呼び出し回数", ["method", "route", "status"])
+DISCORD_API_SECONDS = Histogram("velt_discord_api_seconds", "Discord API の呼び出し時間", ["method"])
+DISCORD_RATELIMITS = Counter("velt_discord_ratelimits_total", "Discord から 429 を受けた回数", ["scope"])
+DISCORD_RATELIMIT_WAIT = Counter("velt_discord_ratelimit_wait_seconds_total", "429 による待ち時間の合計")
+THROTTLED = Counter("velt_throttled_total", "流量制限で断ったコマンドの数", ["category", "scope"])
+OUTBOUND_WAIT = Counter("velt_outbound_wait_seconds_total", "送信キューのトークン待ち時間の合計")
+LOOP_LAG = Histogram("velt_event_loop_lag_seconds", "イベントループの遅れ")
+
+
+# bot.http.request を包んで API の呼び出し回数と時間を数える
+def instrument_http(http):
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, "status", "error"))
+            raise
+        finally:
+            DISCORD_API_SECONDS.observe(time.perf_counter() - start, method=route.method)
+            DISCORD_API_CALLS.inc(method=route.method, route=route.path, status=status)
+
+    http.request = timed_request
+
+
+# discord.py が 429 のときに出す警告ログから回数と待ち時間を拾う
+class RateLimitLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def emit(self, record):
+        msg = record.msg if isinstance(record.msg, str) else ""
+        if msg.startswith("We are being rate limited.") and "Retrying in" in msg:
+            DISCORD_RATELIMITS.inc(scope="route")
+            DISCORD_RATELIMIT_WAIT.inc(float(record.args[-1]))
+        elif msg.startswith("Global rate limit has been hit."):
+            DISCORD_RATELIMITS.inc(scope="global")
+
+
+def instrument_discord_logging():
+    logging.getLogger("discord.http").addHandler(RateLimitLogHandler())
+
+
+# 一定間隔で眠り、予定より遅れて起きた分をイベントループの遅れとして記録する
+async def monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - start - interval, 0.0))
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = render().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except Exception:
+        log.exception("Failed to serve metrics")
+    finally:
+        writer.close()
+
+
+async def start_http_server(port, host="127.0.0.1"):
+    return await asyncio.start_server(_handle_http, host, port)
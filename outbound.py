@@ -0,0 +1,184 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import metrics
+
+# チャンネルごとの送信キュー
+#
+# Discord のチャンネル単位のレート制限に引っかからないよう、送信・編集は
+# チャンネルごとのキューに積んでトークンバケットの速度で1件ずつ処理する。
+# - 同じメッセージへの編集が溜まっている場合は最後のフレームだけを送る
+# - 結果メッセージ（PRIORITY_RESULT）は演出のフレームより先に処理する
+# - ログチャンネルへの行は log() で溜めて、一定間隔でまとめて1回で投稿する
+
+PRIORITY_RESULT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_FRAME = 2
+
+# Discord のメッセージ本文の上限
+MESSAGE_LIMIT = 2000
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "kind", "target", "kwargs", "future")
+
+    def __init__(self, priority, seq, kind, target, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.kind = kind
+        self.target = target
+        self.kwargs = kwargs
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _consume_exception(future):
+    # 投げっぱなしの編集が失敗しても "never retrieved" 警告を出さない
+    if not future.cancelled():
+        future.exception()
+
+
+class _Lane:
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+        self.heap = []
+        self.edits = {}  # message_id -> 未処理の編集ジョブ
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.tokens = scheduler.burst
+        self.updated = time.monotonic()
+
+    def push(self, job):
+        heapq.heappush(self.heap, job)
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def _acquire(self):
+        scheduler = self.scheduler
+        while True:
+            now = time.monotonic()
+            self.tokens = min(scheduler.burst, self.tokens + (now - self.updated) * scheduler.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            delay = (1 - self.tokens) / scheduler.rate
+            metrics.OUTBOUND_WAIT.inc(delay)
+            await asyncio.sleep(delay)
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.scheduler.idle_timeout)
+                except asyncio.TimeoutError:
+                    if not self.heap:
+                        self.scheduler._lanes.pop(self.key, None)
+                        return
+                continue
+            await self._acquire()
+            job = heapq.heappop(self.heap)
+            if job.kind == "edit" and self.edits.get(job.target.id) is job:
+                del self.edits[job.target.id]
+            try:
+                if job.kind == "send":
+                    result = await job.target.send(**job.kwargs)
+                else:
+                    result = await job.target.edit(**job.kwargs)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+
+
+class OutboundScheduler:
+    def __init__(self, rate=1.0, burst=5, log_interval=2.0, idle_timeout=30.0):
+        # 1チャンネルあたり rate 件/秒、最大 burst 件まで連続で送る
+        self.rate = rate
+        self.burst = burst
+        self.log_interval = log_interval
+        self.idle_timeout = idle_timeout
+        self._lanes = {}
+        self._seq = itertools.count()
+        self._logs = {}  # channel_id -> (channel, [行, ...])
+        self._log_task = None
+
+    def _lane(self, channel_id):
+        lane = self._lanes.get(channel_id)
+        if lane is None:
+            lane = _Lane(self, channel_id)
+            self._lanes[channel_id] = lane
+        return lane
+
+    def queue_depth(self):
+        return sum(len(lane.heap) for lane in self._lanes.values())
+
+    # メッセージを送信する。await すると送信された Message を返す
+    def send(self, channel, content=None, *, priority=PRIORITY_NORMAL, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        if content is not None:
+            kwargs["content"] = content
+        self._lane(channel.id).push(_Job(priority, next(self._seq), "send", channel, kwargs, future))
+        return future
+
+    # メッセージを編集する。同じメッセージへの未処理の編集があれば内容を差し替える
+    def edit(self, message, content=None, *, priority=PRIORITY_FRAME, **kwargs):
+        if content is not None:
+            kwargs["content"] = content
+        lane = self._lane(message.channel.id)
+        pending = lane.edits.get(message.id)
+        if pending is not None:
+            pending.kwargs = kwargs
+            if priority < pending.priority:
+                pending.priority = priority
+                heapq.heapify(lane.heap)
+            return pending.future
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        job = _Job(priority, next(self._seq), "edit", message, kwargs, future)
+        lane.edits[message.id] = job
+        lane.push(job)
+        return future
+
+    # ログチャンネルへの1行。一定間隔でまとめて投稿する
+    def log(self, channel, line):
+        if channel is None:
+            return
+        entry = self._logs.get(channel.id)
+        if entry is None:
+            entry = (channel, [])
+            self._logs[channel.id] = entry
+        entry[1].append(line)
+        if self._log_task is None or self._log_task.done():
+            self._log_task = asyncio.get_running_loop().create_task(self._flush_logs())
+
+    async def _flush_logs(self):
+        while self._logs:
+            await asyncio.sleep(self.log_interval)
+            logs, self._logs = self._logs, {}
+            for channel, lines in logs.values():
+                for chunk in join_lines(lines):
+                    self.send(channel, chunk)
+
+
+# 行を本文の上限に収まるようにまとめる
+def join_lines(lines):
+    chunk = ""
+    for line in lines:
+        line = line[:MESSAGE_LIMIT]
+        if chunk and len(chunk) + 1 + len(line) > MESSAGE_LIMIT:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        yield chunk
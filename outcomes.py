@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+
+import games
+from persistence import FlushWorker
+
+# ゲームの乱数（コミット・リビール付き）
+#
+# 期間（エポック）ごとに32バイトの秘密のシードを作り、その SHA-256（コミットメント）を先に公開しておく。
+# 乱数は SHAKE-256(シード || ブロック番号(8バイト, big endian)) で BLOCK_SIZE バイトずつまとめて作り、
+# ゲームはそのバッファから1バイトずつ取り出して使う（1回のゲームで使うのは十数バイト）。
+# 期間が終わったらシードを公開するので、プレイヤーは
+#   1. SHA-256(シード) がコミットメントと一致すること
+#   2. 結果に付いている「期間:位置」からその勝負の出目を作り直せること
+# を確かめられる（python outcomes.py verify）。
+# 0..n-1 の値は、n で割り切れる範囲を超えたバイトを捨てて偏りなく作る。
+# games.py の関数には random モジュールの代わりに渡せる（choice / randint / randbelow）。
+#
+# ブラックジャックのようにプレイヤーの操作をはさんでカードを引く勝負は、その間にほかの勝負が同じ乱数を
+# 使うので、勝負の最初に席（プレイヤーごと + BOT）のシードを SEAT_SEED_SIZE バイトずつ取り出しておき、
+# 各席のカードはその席のシードの OutcomeStream（ブロックは SEAT_BLOCK_SIZE バイト）から順に引く。「期間:位置」と各席の枚数だけで手札を作り直せる。
+
+BLOCK_SIZE = 64 * 1024
+SEAT_SEED_SIZE = 32
+# 1つの席で引くのは数枚なので、ブロックは小さくして作り直しを安くする
+SEAT_BLOCK_SIZE = 64
+# 公開済みのシードを残しておく数
+REVEALED_KEEP = 100
+
+
+def commitment_of(seed):
+    return hashlib.sha256(seed).hexdigest()
+
+
+class OutcomeStream:
+    def __init__(self, seed, offset=0, block_size=BLOCK_SIZE):
+        self.seed = seed
+        self.block_size = block_size
+        self._block = offset // block_size
+        self._buffer = self._generate(self._block)
+        self._pos = offset % block_size
+
+    def _generate(self, block):
+        return hashlib.shake_256(self.seed + block.to_bytes(8, "big")).digest(self.block_size)
+
+    # この期間で使ったバイト数（次の勝負の位置）
+    @property
+    def offset(self):
+        return self._block * self.block_size + self._pos
+
+    def _byte(self):
+        if self._pos >= self.block_size:
+            self._block += 1
+            self._buffer = self._generate(self._block)
+            self._pos = 0
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    def randbelow(self, n):
+        if n <= 0:
+            raise ValueError("n must be positive")
+        if n <= 256:
+            limit = 256 - 256 % n
+            while True:
+                value = self._byte()
+                if value < limit:
+                    return value % n
+        # 256 を超える範囲は必要なバイト数をまとめて読み、ビットマスクで切って捨てる
+        bits = (n - 1).bit_length()
+        size = (bits + 7) // 8
+        mask = (1 << bits) - 1
+        while True:
+            value = int.from_bytes(bytes(self._byte() for _ in range(size)), "big") & mask
+            if value < n:
+                return value
+
+    def randint(self, a, b):
+        return a + self.randbelow(b - a + 1)
+
+    def choice(self, seq):
+        return seq[self.randbelow(len(seq))]
+
+
+# 勝負の最初に取り出す席ごとのシード（random モジュールを渡しても動く）
+def seat_seeds(rng, count):
+    return [bytes(rng.randint(0, 255) for _ in range(SEAT_SEED_SIZE)) for _ in range(count)]
+
+
+# 席のシードから引いた start 枚目から count 枚のカード
+def seat_cards(seed, start, count):
+    rng = OutcomeStream(seed, block_size=SEAT_BLOCK_SIZE)
+    cards = [games.blackjack_draw(rng) for _ in range(start + count)]
+    return cards[start:]
+
+
+# BOTの席のシードから、17以上になるまで引いた手札
+def dealer_cards(seed):
+    rng = OutcomeStream(seed, block_size=SEAT_BLOCK_SIZE)
+    cards = games.blackjack_deal(rng)
+    while games.blackjack_bot_should_draw(cards):
+        cards.append(games.blackjack_draw(rng))
+    return cards
+
+
+class Epoch:
+    __slots__ = ("epoch_id", "seed", "commitment", "started", "ended")
+
+    def __init__(self, epoch_id, seed, started, ended=None):
+        self.epoch_id = epoch_id
+        self.seed = seed
+        self.commitment = commitment_of(seed)
+        self.started = started
+        self.ended = ended
+
+    def to_record(self):
+        return {"id": self.epoch_id, "seed": self.seed.hex(), "started": self.started, "ended": self.ended}
+
+    @classmethod
+    def from_record(cls, data):
+        return cls(data["id"], bytes.fromhex(data["seed"]), data["started"], data.get("ended"))
+
+
+class OutcomeService:
+    def __init__(self, path, epoch_seconds=3600):
+        self.path = path
+        self.epoch_seconds = epoch_seconds
+        self.epoch = None
+        self.stream = None
+        # 公開済みの期間（新しい順）
+        self.revealed = []
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, name="velt-outcomes")
+
+    # 前回の期間は途中の位置が分からないので、起動時に終わらせて公開する
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self.revealed = [Epoch.from_record(record) for record in data.get("revealed", [])]
+        current = data.get("current")
+        next_id = 1
+        if current is not None:
+            previous = Epoch.from_record(current)
+            previous.ended = time.time()
+            self.revealed.insert(0, previous)
+            next_id = previous.epoch_id + 1
+        elif self.revealed:
+            next_id = self.revealed[0].epoch_id + 1
+        self._start(next_id)
+        self._worker.start()
+
+    def _start(self, epoch_id):
+        with self._lock:
+            self.epoch = Epoch(epoch_id, secrets.token_bytes(32), time.time())
+            self.stream = OutcomeStream(self.epoch.seed)
+            del self.revealed[REVEALED_KEEP:]
+        self._worker.mark_dirty()
+
+    # 今の期間を終えてシードを公開し、新しいシードで次の期間を始める
+    def rotate(self):
+        previous = self.epoch
+        previous.ended = time.time()
+        with self._lock:
+            self.revealed.insert(0, previous)
+        self._start(previous.epoch_id + 1)
+        return previous
+
+    # 期間が過ぎていたら次の期間に切り替える。切り替えたら True
+    def rotate_if_due(self):
+        if time.time() < self.reveal_at():
+            return False
+        self.rotate()
+        return True
+
+    # 今の期間の乱数（期間が過ぎていたら次の期間に切り替える）
+    def rng(self):
+        self.rotate_if_due()
+        return self.stream
+
+    # 次の勝負の乱数と、その位置（"期間:位置"、結果に添えて検証に使う）
+    def draw(self):
+        stream = self.rng()
+        return stream, f"{self.epoch.epoch_id}:{stream.offset}"
+
+    def find(self, epoch_id):
+        for epoch in self.revealed:
+            if epoch.epoch_id == epoch_id:
+                return epoch
+        return None
+
+    # 今の期間が終わる（シードを公開する）時刻
+    def reveal_at(self):
+        return self.epoch.started + self.epoch_seconds
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    def _flush(self):
+        with self._lock:
+            data = json.dumps({
+                "current": self.epoch.to_record() if self.epoch else None,
+                "revealed": [epoch.to_record() for epoch in self.revealed],
+            })
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self._worker.close()
+
+
+# 公開されたシードと「期間:位置」から勝負の出目を作り直す
+# cards はブラックジャックのプレイヤーごとの手札の枚数（参加した順。省略したら2枚）
+def replay(game, seed, ref, players=1, cards=None):
+    _, offset = ref.split(":")
+    rng = OutcomeStream(seed, int(offset))
+    if game == "slot":
+        spins, result = games.slot_round(rng)
+        return {"spins": spins, "result": result, "multiplier": games.slot_multiplier(result)}
+    if game == "chinchiro":
+        user_rolls, bot_rolls = games.chinchiro_round(rng)
+        multiplier, result = games.chinchiro_settle(user_rolls[-1][1], bot_rolls[-1][1])
+        return {
+            "user": [dice for dice, _ in user_rolls], "bot": [dice for dice, _ in bot_rolls],
+            "multiplier": multiplier, "result": result,
+        }
+    if game == "chinchiro_table":
+        # BOT、参加した順のプレイヤーの順に振る
+        bot_rolls = games.chinchiro_rolls(rng)
+        players = [games.chinchiro_roll(rng) for _ in range(players)]
+        return {
+            "bot": [dice for dice, _ in bot_rolls],
+            "players": [{"dice": dice, "multiplier": games.chinchiro_settle(hand, bot_rolls[-1][1])[0]}
+                        for dice, hand, _ in players],
+        }
+    if game in ("blackjack", "blackjack_table"):
+        # 席はプレイヤー（参加した順）、最後にBOT
+        if game == "blackjack":
+            players = 1
+        cards = list(cards or [])
+        cards += [2] * (players - len(cards))
+        seeds = seat_seeds(rng, players + 1)
+        dealer = dealer_cards(seeds[-1])
+        hands = []
+        for seat_seed, count in zip(seeds, cards):
+            hand = seat_cards(seat_seed, 0, count)
+            multiplier, result = games.blackjack_outcome(sum(hand), sum(dealer))
+            hands.append({"cards": hand, "multiplier": multiplier, "result": result})
+        if game == "blackjack":
+            return {"user": hands[0]["cards"], "bot": dealer,
+                    "multiplier": hands[0]["multiplier"], "result": hands[0]["result"]}
+        return {"bot": dealer, "players": hands}
+    raise ValueError(f"unknown game: {game}")
+
+
+def parse_cards(text):
+    try:
+        return [int(count) for count in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid card counts: {text}") from None
+
+
+def main():
+    # 使い方: python outcomes.py verify --game slot --seed <公開されたシード> --ref 12:3456 [--commitment <ハッシュ>]
+    #         ブラックジャックは --players <人数> --cards <手札の枚数,...> も付ける
+    parser = argparse.ArgumentParser(description="velt のゲーム結果の検証")
+    commands = parser.add_subparsers(dest="command", required=True)
+    verify = commands.add_parser("verify", help="公開されたシードから勝負の結果を作り直す")
+    verify.add_argument("--game", choices=["slot", "chinchiro", "chinchiro_table", "blackjack", "blackjack_table"],
+                        required=True)
+    verify.add_argument("--seed", required=True, help="公開されたシード（16進）")
+    verify.add_argument("--ref", required=True, help="結果に付いている 期間:位置")
+    verify.add_argument("--commitment", default=None, help="期間の始めに公開されたハッシュ")
+    verify.add_argument("--players", type=int, default=1, help="chinchiro_table / blackjack_table の参加人数")
+    verify.add_argument("--cards", type=parse_cards, default=None,
+                        help="ブラックジャックの各プレイヤーの手札の枚数（参加した順にカンマ区切り、例: 3,2,4）")
+    args = parser.parse_args()
+
+    seed = bytes.fromhex(args.seed)
+    if args.commitment is not None:
+        ok = commitment_of(seed) == args.commitment.lower()
+        print(f"commitment: {'OK' if ok else 'MISMATCH'}")
+        if not ok:
+            return 1
+    print(json.dumps(replay(args.game, seed, args.ref, args.players, args.cards), ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
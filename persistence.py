@@ -0,0 +1,88 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+import metrics
+
+# ディスク書き込み専用のワーカースレッド
+#
+# イベントループ側は mark_dirty() で「書き込みが必要」と知らせるだけで、
+# シリアライズと書き込み・fsync はすべてこのスレッドで行う。
+# interval 秒の間に重なった変更は1回の flush にまとめる。
+# durable() / wait_durable() はその時点までの変更がディスクに載るまで待つためのバリア。
+
+log = logging.getLogger("velt.persistence")
+
+
+class FlushWorker:
+    def __init__(self, flush, interval=0.2, name="velt-flush"):
+        self._flush = flush
+        self.name = name
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._waiters = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def mark_dirty(self):
+        with self._cond:
+            if not self._dirty:
+                self._dirty = True
+                self._cond.notify()
+
+    # 呼び出し時点までの変更が書き込まれたら完了する Future を返す
+    def durable(self):
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._waiters.append(future)
+            self._cond.notify()
+        return future
+
+    async def wait_durable(self):
+        await asyncio.wrap_future(self.durable())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._dirty or self._waiters or self._closed):
+                    self._cond.wait()
+                # バリア待ちがいなければ少し待って、続けて来る変更をまとめる
+                if not self._waiters and not self._closed:
+                    self._cond.wait(self.interval)
+                waiters, self._waiters = self._waiters, []
+                self._dirty = False
+                closed = self._closed
+
+            error = None
+            start = time.perf_counter()
+            try:
+                self._flush()
+            except Exception as e:
+                error = e
+                log.exception("Failed to persist (%s)", self.name)
+                metrics.FLUSH_ERRORS.inc(worker=self.name)
+                with self._cond:
+                    self._dirty = True
+            metrics.FLUSH_SECONDS.observe(time.perf_counter() - start, worker=self.name)
+
+            for future in waiters:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+            if closed:
+                return
+
+    # 残っている変更を書き出してからスレッドを止める
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
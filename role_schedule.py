@@ -0,0 +1,92 @@
+import heapq
+import time
+
+# ロールの定期発行のスケジュール
+#
+# ロール設定に interval（daily / weekly）があるものを、次に払う時刻の min-heap に積んでおく。
+# bot.py のタスクは先頭の時刻まで眠るだけで、ポーリングはしない。
+# 設定が変わったら update() / remove() で積み直す（古い要素は取り出したときに捨てる）。
+# 払った時刻はロール設定の paid_until に持つので、止まっていた間の分は起動後にまとめて払う。
+
+INTERVALS = {
+    "daily": 86400,
+    "weekly": 7 * 86400,
+}
+INTERVAL_LABELS = {
+    "daily": "毎日",
+    "weekly": "毎週",
+}
+
+
+# paid_until から now までに払うべき回数（多すぎるときは limit 回まで）
+def periods_due(data, now, limit=None):
+    interval = INTERVALS.get(data.get("interval"))
+    paid_until = data.get("paid_until")
+    if interval is None or paid_until is None or now < paid_until + interval:
+        return 0
+    count = int((now - paid_until) // interval)
+    return min(count, limit) if limit else count
+
+
+def next_due(data):
+    interval = INTERVALS.get(data.get("interval"))
+    paid_until = data.get("paid_until")
+    if interval is None or paid_until is None:
+        return None
+    return paid_until + interval
+
+
+class RoleSchedule:
+    def __init__(self):
+        self._heap = []  # (次に払う時刻, role_id)
+        self._due = {}   # role_id -> 次に払う時刻（heap の古い要素の判定用）
+
+    def __len__(self):
+        return len(self._due)
+
+    def rebuild(self, settings):
+        self._due = {}
+        for role_id, data in settings.items():
+            due = next_due(data)
+            if due is not None:
+                self._due[role_id] = due
+        self._heap = [(due, role_id) for role_id, due in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def update(self, role_id, data):
+        due = next_due(data)
+        if due is None:
+            self.remove(role_id)
+            return
+        self._due[role_id] = due
+        heapq.heappush(self._heap, (due, role_id))
+
+    def remove(self, role_id):
+        self._due.pop(role_id, None)
+
+    # 次に払う時刻。なければ None
+    def peek(self):
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    # 次に払うまでの秒数。なければ None
+    def delay(self, now=None):
+        due = self.peek()
+        if due is None:
+            return None
+        now = time.time() if now is None else now
+        return max(due - now, 0)
+
+    # now までに払う時刻が来たロールを取り出す（払ったら update() で積み直す）
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due_roles = []
+        while True:
+            due = self.peek()
+            if due is None or due > now:
+                return due_roles
+            _, role_id = heapq.heappop(self._heap)
+            del self._due[role_id]
+            due_roles.append(role_id)
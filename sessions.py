@@ -0,0 +1,325 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+
+import games
+from outcomes import seat_cards, seat_seeds
+from persistence import FlushWorker
+
+# 進行中のゲーム（セッション）の保存先
+#
+# 進行中のゲームは View ではなく、シリアライズできる小さな状態（BlackjackSession など）として持つ。
+# 状態はメモリの辞書に置き、変更があったものだけ FlushWorker のスレッドで SQLite にまとめて書く。
+# 再起動時は load() で読み戻し、固定の custom_id を持つ永続 View（bot.add_view）から
+# メッセージIDで引く。タイムアウトは View ごとではなく、bot.py の1つのタスクが expired() で一括処理する。
+# ブラックジャックのカードは配るときに取り出した席ごとのシード（outcomes.seat_seeds）から引き、
+# 取り出した「期間:位置」（ref）と一緒に保存する。シードを持たない古いレコードは random で引く。
+
+# 最後の操作からこの秒数が過ぎたら時間切れ
+SESSION_TIMEOUT = 60
+
+STATE_BETTING = "betting"  # テーブルの参加受付中
+STATE_PLAYER = "player"  # プレイヤーの操作待ち
+STATE_DEALER = "dealer"  # BOTが引いて精算中
+STATE_SETTLING = "settling"  # 損益を保存して残高に反映中（再起動後はその損益で精算し直す）
+
+
+def seeds_record(seeds):
+    return None if seeds is None else [seed.hex() for seed in seeds]
+
+
+def seeds_from_record(data):
+    return None if data is None else [bytes.fromhex(seed) for seed in data]
+
+
+class BlackjackSession:
+    GAME = "blackjack"
+    # 操作待ちのまま時間切れになったら掛け金を返して片付ける
+    SWEEP = True
+    __slots__ = ("message_id", "channel_id", "guild_id", "user_id", "bet", "player_cards", "bot_cards", "state", "expires_at",
+                 "ref", "seeds", "net")
+
+    def __init__(self, message_id, channel_id, guild_id, user_id, bet, player_cards, bot_cards,
+                 state=STATE_PLAYER, expires_at=None, ref=None, seeds=None, net=None):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.bet = bet
+        self.player_cards = player_cards
+        self.bot_cards = bot_cards
+        self.state = state
+        self.expires_at = expires_at if expires_at is not None else time.time() + SESSION_TIMEOUT
+        self.ref = ref
+        self.seeds = seeds  # [プレイヤー, BOT] の席のシード
+        self.net = net  # 精算する損益（STATE_SETTLING のとき）
+
+    # 席はプレイヤー、BOTの順
+    @classmethod
+    def deal(cls, channel_id, guild_id, user_id, bet, rng=random, ref=None):
+        player_seed, bot_seed = seat_seeds(rng, 2)
+        return cls(None, channel_id, guild_id, user_id, bet, seat_cards(player_seed, 0, 2), seat_cards(bot_seed, 0, 2),
+                   ref=ref, seeds=[player_seed, bot_seed])
+
+    def _next_card(self, seat, cards):
+        if self.seeds is None:
+            return games.blackjack_draw()
+        return seat_cards(self.seeds[seat], len(cards), 1)[0]
+
+    def player_card(self):
+        return self._next_card(0, self.player_cards)
+
+    def bot_card(self):
+        return self._next_card(1, self.bot_cards)
+
+    def touch(self):
+        self.expires_at = time.time() + SESSION_TIMEOUT
+
+    # 1枚引く。バーストしたら BOT の番に進めて True を返す
+    def hit(self, card):
+        self.player_cards.append(card)
+        self.touch()
+        if sum(self.player_cards) > 21:
+            self.state = STATE_DEALER
+            return True
+        return False
+
+    def stand(self):
+        self.state = STATE_DEALER
+
+    def bot_should_draw(self):
+        return games.blackjack_bot_should_draw(self.bot_cards)
+
+    def bot_draw(self, card):
+        self.bot_cards.append(card)
+
+    # (損益の倍率, 結果)
+    def outcome(self):
+        return games.blackjack_outcome(sum(self.player_cards), sum(self.bot_cards))
+
+    def to_record(self):
+        return {
+            "g": self.guild_id, "u": self.user_id, "b": self.bet, "p": self.player_cards, "d": self.bot_cards,
+            "s": self.state, "r": self.ref, "k": seeds_record(self.seeds), "n": self.net,
+        }
+
+    # サーバーを持たない古いレコードは guild_id が None（bot.py 側で既定のサーバーとして扱う）
+    @classmethod
+    def from_record(cls, message_id, channel_id, expires_at, data):
+        return cls(
+            message_id, channel_id, data.get("g"), data["u"], data["b"], data["p"], data["d"], data["s"], expires_at,
+            data.get("r"), seeds_from_record(data.get("k")), data.get("n"),
+        )
+
+
+# 複数人で1つの勝負をするテーブル（ちんちろ・ブラックジャック）
+# 締め切りや進行は bot.py のテーブルのタスクが管理するので、スイープの対象にはしない
+class TableSession:
+    GAME = "table"
+    SWEEP = False
+    __slots__ = ("message_id", "channel_id", "guild_id", "game", "bets", "hands", "dealer", "done", "state", "expires_at",
+                 "ref", "seeds", "results")
+
+    def __init__(self, message_id, channel_id, guild_id, game, bets=None, hands=None, dealer=None, done=None,
+                 state=STATE_BETTING, expires_at=None, ref=None, seeds=None, results=None):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.game = game
+        self.bets = bets or {}      # user_id -> 掛け金
+        self.hands = hands or {}    # user_id -> 手札（ブラックジャック）
+        self.dealer = dealer or []  # BOTの手札
+        self.done = done or set()   # スタンド・バーストしたプレイヤー
+        self.state = state
+        self.expires_at = expires_at if expires_at is not None else time.time()
+        self.ref = ref
+        self.seeds = seeds  # 参加した順のプレイヤー、最後にBOTの席のシード
+        self.results = results or {}  # user_id -> 精算する損益（STATE_SETTLING のとき）
+
+    # 参加する。すでに参加していれば False
+    def join(self, user_id, bet):
+        if user_id in self.bets:
+            return False
+        self.bets[user_id] = bet
+        return True
+
+    def deal(self, rng=random, ref=None):
+        self.seeds = seat_seeds(rng, len(self.bets) + 1)
+        self.ref = ref
+        self.hands = {user_id: seat_cards(seed, 0, 2) for user_id, seed in zip(self.bets, self.seeds)}
+        self.dealer = seat_cards(self.seeds[-1], 0, 2)
+        self.done = set()
+        self.state = STATE_PLAYER
+
+    def _next_card(self, seat, cards):
+        if self.seeds is None:
+            return games.blackjack_draw()
+        return seat_cards(self.seeds[seat], len(cards), 1)[0]
+
+    def player_card(self, user_id):
+        return self._next_card(list(self.bets).index(user_id), self.hands[user_id])
+
+    def dealer_card(self):
+        return self._next_card(-1, self.dealer)
+
+    # 1枚引く。バーストしたらそのプレイヤーは終わり。手札を返す
+    def hit(self, user_id, card):
+        cards = self.hands[user_id]
+        cards.append(card)
+        if sum(cards) > 21:
+            self.done.add(user_id)
+        return cards
+
+    def stand(self, user_id):
+        self.done.add(user_id)
+
+    def all_done(self):
+        return len(self.done) >= len(self.hands)
+
+    def to_record(self):
+        return {
+            "gid": self.guild_id,
+            "g": self.game,
+            "b": [[user_id, bet] for user_id, bet in self.bets.items()],
+            "h": [[user_id, cards] for user_id, cards in self.hands.items()],
+            "d": self.dealer,
+            "x": sorted(self.done),
+            "s": self.state,
+            "r": self.ref,
+            "k": seeds_record(self.seeds),
+            "n": [[user_id, net] for user_id, net in self.results.items()],
+        }
+
+    @classmethod
+    def from_record(cls, message_id, channel_id, expires_at, data):
+        return cls(
+            message_id, channel_id, data.get("gid"), data["g"],
+            {user_id: bet for user_id, bet in data["b"]},
+            {user_id: cards for user_id, cards in data["h"]},
+            data["d"], set(data["x"]), data["s"], expires_at, data.get("r"), seeds_from_record(data.get("k")),
+            {user_id: net for user_id, net in data.get("n", [])},
+        )
+
+
+SESSION_TYPES = {BlackjackSession.GAME: BlackjackSession, TableSession.GAME: TableSession}
+
+
+class SessionStore:
+    def __init__(self, path, flush_interval=0.2):
+        self.path = path
+        self.conn = None
+        self._sessions = {}  # message_id -> セッション
+        self._dirty = set()  # 書き込み（または削除）が必要な message_id
+        self._lock = threading.Lock()
+        self._worker = FlushWorker(self._flush, interval=flush_interval, name="velt-sessions")
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def load(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                message_id INTEGER PRIMARY KEY,
+                game TEXT NOT NULL,
+                channel_id INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        for message_id, game, channel_id, expires_at, data in self.conn.execute(
+            "SELECT message_id, game, channel_id, expires_at, data FROM sessions"
+        ):
+            cls = SESSION_TYPES.get(game)
+            if cls is not None:
+                self._sessions[message_id] = cls.from_record(message_id, channel_id, expires_at, json.loads(data))
+        self._worker.start()
+
+    def get(self, message_id):
+        return self._sessions.get(message_id)
+
+    # 作成・更新のどちらもこれで保存する
+    def put(self, session):
+        with self._lock:
+            self._sessions[session.message_id] = session
+            self._dirty.add(session.message_id)
+        self._worker.mark_dirty()
+
+    def delete(self, message_id):
+        with self._lock:
+            if self._sessions.pop(message_id, None) is None:
+                return
+            self._dirty.add(message_id)
+        self._worker.mark_dirty()
+
+    # 状態を新しいメッセージに付け替える（ボタン付きのメッセージを送り直したとき）
+    def move(self, session, message_id):
+        with self._lock:
+            if self._sessions.get(session.message_id) is session:
+                del self._sessions[session.message_id]
+                self._dirty.add(session.message_id)
+            session.message_id = message_id
+            self._sessions[message_id] = session
+            self._dirty.add(message_id)
+        self._worker.mark_dirty()
+
+    # 操作待ちのまま時間切れになったセッション
+    def expired(self, now=None):
+        now = time.time() if now is None else now
+        return [s for s in self._sessions.values() if s.SWEEP and s.state == STATE_PLAYER and s.expires_at <= now]
+
+    def in_state(self, state, cls=BlackjackSession):
+        return [s for s in self._sessions.values() if type(s) is cls and s.state == state]
+
+    def of_type(self, cls):
+        return [s for s in self._sessions.values() if type(s) is cls]
+
+    def pending(self):
+        return len(self._dirty)
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    # ワーカースレッドで実行される
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            deleted = []
+            for message_id in dirty:
+                session = self._sessions.get(message_id)
+                if session is None:
+                    deleted.append((message_id,))
+                else:
+                    rows.append((
+                        message_id, session.GAME, session.channel_id, session.expires_at,
+                        json.dumps(session.to_record()),
+                    ))
+        if not dirty:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("DELETE FROM sessions WHERE message_id = ?", deleted)
+                self.conn.executemany(
+                    "INSERT INTO sessions (message_id, game, channel_id, expires_at, data) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(message_id) DO UPDATE SET expires_at = excluded.expires_at, data = excluded.data",
+                    rows,
+                )
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+
+    def close(self):
+        if self.conn is None:
+            return
+        self._worker.close()
+        self.conn.close()
+        self.conn = None
@@ -0,0 +1,195 @@
+import argparse
+import time
+
+import numpy as np
+
+import games
+
+# ゲームの期待値シミュレーター
+#
+# games.py のルール関数から倍率表を作り、乱数の生成と判定を NumPy でまとめて行う。
+# 使い方: python simulate.py [--game slot|chinchiro|blackjack|all] [--rounds N]
+# 配当を変えたら、デプロイ前にこれで RTP（還元率）と負けの分布を確認する。
+
+CHUNK = 1_000_000
+GAMES = ["slot", "chinchiro", "blackjack"]
+
+
+# --- スロット ---
+def _slot_table():
+    # 絵柄はインデックスで扱う（判定は一致するかどうかだけなので同じ結果になる）
+    k = len(games.SLOT_SYMBOLS)
+    return np.array(
+        [games.slot_multiplier((a, b, c)) for a in range(k) for b in range(k) for c in range(k)],
+        dtype=np.int64,
+    )
+
+
+def slot_multipliers(rng, n, table):
+    k = len(games.SLOT_SYMBOLS)
+    reels = rng.integers(0, k, size=(n, 3))
+    return table[(reels[:, 0] * k + reels[:, 1]) * k + reels[:, 2]]
+
+
+# --- ちんちろ ---
+def _chinchiro_tables():
+    scores = np.array([hand.score for hand in games.CHINCHIRO_TABLE], dtype=np.int64)
+    distinct = sorted(set(scores.tolist()))
+    score_index = np.array([distinct.index(s) for s in scores.tolist()], dtype=np.int64)
+    outcome = np.array(
+        [[games.chinchiro_outcome(u, b)[0] for b in distinct] for u in distinct],
+        dtype=np.int64,
+    )
+    return scores, score_index, outcome
+
+
+def chinchiro_multipliers(rng, n, tables):
+    scores, score_index, outcome = tables
+    # (ゲーム, ユーザー/BOT, 何回目, サイコロ)
+    dice = rng.integers(0, 6, size=(n, 2, 3, 3))
+    code = dice[..., 0] * 36 + dice[..., 1] * 6 + dice[..., 2]
+    # 役が出た最初の回（3回とも役なしなら3回目）の役を使う
+    has_yaku = scores[code] != 0
+    first = np.where(has_yaku.any(axis=-1), has_yaku.argmax(axis=-1), 2)
+    final = np.take_along_axis(score_index[code], first[..., None], axis=-1)[..., 0]
+    return outcome[final[:, 0], final[:, 1]]
+
+
+# --- ブラックジャック ---
+# 1枚目が最低1なので、21枚あれば必ず止まる
+BLACKJACK_MAX_CARDS = 21
+
+
+def _blackjack_table():
+    size = 32
+    return np.array(
+        [[games.blackjack_outcome(p, b)[0] for b in range(size)] for p in range(size)],
+        dtype=np.int64,
+    )
+
+
+def _blackjack_totals(rng, n, stand):
+    cards = rng.integers(1, 11, size=(n, BLACKJACK_MAX_CARDS))
+    totals = cards.cumsum(axis=1)
+    # 2枚配った後、合計が stand 以上になるまで引く
+    stop = (totals[:, 1:] >= stand).argmax(axis=1) + 1
+    return totals[np.arange(n), stop]
+
+
+def blackjack_multipliers(rng, n, table, stand):
+    player = _blackjack_totals(rng, n, stand)
+    dealer = _blackjack_totals(rng, n, games.BLACKJACK_BOT_STAND)
+    return table[player, dealer]
+
+
+def make_sampler(game, stand):
+    if game == "slot":
+        table = _slot_table()
+        return lambda rng, n: slot_multipliers(rng, n, table)
+    if game == "chinchiro":
+        tables = _chinchiro_tables()
+        return lambda rng, n: chinchiro_multipliers(rng, n, tables)
+    if game == "blackjack":
+        # 21 を超える合計は BLACKJACK_MAX_CARDS 枚引いても届かないことがあり、止める位置が決まらない
+        if stand > 21:
+            raise ValueError(f"stand must be 21 or less: {stand}")
+        table = _blackjack_table()
+        return lambda rng, n: blackjack_multipliers(rng, n, table, stand)
+    raise ValueError(game)
+
+
+# rounds 回分の倍率を集計する
+def simulate(game, rounds, rng, stand=17, session=100):
+    sampler = make_sampler(game, stand)
+    chunk = max(session, CHUNK // session * session)
+    total = 0
+    total_sq = 0
+    counts = {}
+    sessions = []
+    done = 0
+    start = time.perf_counter()
+    while done < rounds:
+        n = min(chunk, rounds - done)
+        m = sampler(rng, n)
+        total += int(m.sum())
+        total_sq += int((m * m).sum())
+        values, freq = np.unique(m, return_counts=True)
+        for v, c in zip(values.tolist(), freq.tolist()):
+            counts[v] = counts.get(v, 0) + c
+        usable = n // session * session
+        if usable:
+            sessions.append(m[:usable].reshape(-1, session).sum(axis=1))
+        done += n
+    elapsed = time.perf_counter() - start
+    mean = total / rounds
+    return {
+        "game": game,
+        "rounds": rounds,
+        "elapsed": elapsed,
+        "mean": mean,
+        "var": total_sq / rounds - mean * mean,
+        "counts": counts,
+        "sessions": np.concatenate(sessions) if sessions else np.zeros(0, dtype=np.int64),
+        "session": session,
+    }
+
+
+# 厳密な確率が分かるゲームは {倍率: 確率} を返す
+def exact_odds(game):
+    if game == "chinchiro":
+        return games.chinchiro_exact_odds()
+    return None
+
+
+def print_report(stats, bets):
+    rounds = stats["rounds"]
+    exact = exact_odds(stats["game"])
+    print(f"== {stats['game']} ==")
+    print(f"rounds: {rounds:,}  ({rounds / stats['elapsed']:,.0f} rounds/sec)")
+    print(f"RTP: {(1 + stats['mean']) * 100:.3f}%   house edge: {-stats['mean'] * 100:.3f}%")
+    if exact:
+        exact_mean = float(sum(v * p for v, p in exact.items()))
+        print(f"exact RTP: {(1 + exact_mean) * 100:.3f}%")
+    print("outcome distribution (x bet):" + ("  simulated / exact" if exact else ""))
+    for v in sorted(set(stats["counts"]) | set(exact or {})):
+        line = f"  {v:+4d}x  {stats['counts'].get(v, 0) / rounds * 100:8.4f}%"
+        if exact:
+            line += f"  {float(exact.get(v, 0)) * 100:8.4f}%"
+        print(line)
+    sessions = stats["sessions"]
+    for bet in bets:
+        std = stats["var"] ** 0.5 * bet
+        print(f"-- bet {bet} velt --")
+        print(f"  expected net/round: {stats['mean'] * bet:+,.1f} velt   stddev: {std:,.1f} velt")
+        for k in (1, 2, 3, 5):
+            p = sum(c for v, c in stats["counts"].items() if v <= -k) / rounds
+            print(f"  P(loss >= {k}x bet): {p * 100:.4f}%")
+        if len(sessions):
+            p1, p5, p50 = np.percentile(sessions * bet, [1, 5, 50])
+            print(
+                f"  {stats['session']}-round session net: "
+                f"1%={p1:+,.0f}  5%={p5:+,.0f}  median={p50:+,.0f} velt"
+            )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="velt ゲームの期待値シミュレーター")
+    parser.add_argument("--game", choices=GAMES + ["all"], default="all")
+    parser.add_argument("--rounds", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stand", type=int, default=17, help="ブラックジャックでプレイヤーが止める合計")
+    parser.add_argument("--session", type=int, default=100, help="損失分布を見る連続プレイ回数")
+    parser.add_argument("--bets", type=int, nargs="+", default=games.BET_SIZES)
+    args = parser.parse_args()
+    if args.stand > 21:
+        parser.error("--stand は21以下にしてください")
+
+    rng = np.random.default_rng(args.seed)
+    for game in GAMES if args.game == "all" else [args.game]:
+        stats = simulate(game, args.rounds, rng, stand=args.stand, session=args.session)
+        print_report(stats, args.bets)
+
+
+if __name__ == "__main__":
+    main()
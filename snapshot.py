@@ -0,0 +1,131 @@
+import bisect
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+# 残高スナップショットのバイナリ形式
+#
+#   ヘッダー: マジック(8) + 件数(uint64) + CRC32(uint32) + 予約(4)
+#   本体:     ユーザーID(int64, 昇順) × 件数、続けて 残高(int64) × 件数
+#
+# 起動時は mmap して memoryview を int64 の配列として扱い、二分探索で引くだけなので、
+# アカウント数が増えても読み込み時間・メモリはほとんど増えない（触ったページだけが載る）。
+# CRC が合わなければ SnapshotError にして、空の残高で黙って起動しないようにする。
+
+MAGIC = b"VELTSNP1"
+HEADER = struct.Struct("<8sQI4x")
+ITEM_SIZE = 8
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class BalanceSnapshot:
+    def __init__(self):
+        self.path = None
+        self._file = None
+        self._map = None
+        self.ids = ()
+        self.balances = ()
+
+    @classmethod
+    def open(cls, path):
+        snapshot = cls()
+        snapshot.path = path
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return snapshot
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            f.close()
+            raise SnapshotError(f"{path}: truncated header")
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        magic, count, crc = HEADER.unpack_from(m, 0)
+        if magic != MAGIC or size != HEADER.size + count * ITEM_SIZE * 2:
+            m.close()
+            f.close()
+            raise SnapshotError(f"{path}: bad header or size")
+        if zlib.crc32(memoryview(m)[HEADER.size:]) != crc:
+            m.close()
+            f.close()
+            raise SnapshotError(f"{path}: checksum mismatch")
+        view = memoryview(m)
+        ids_end = HEADER.size + count * ITEM_SIZE
+        snapshot._file = f
+        snapshot._map = m
+        snapshot.ids = view[HEADER.size:ids_end].cast("q")
+        snapshot.balances = view[ids_end:].cast("q")
+        return snapshot
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, user_id, default=None):
+        ids = self.ids
+        i = bisect.bisect_left(ids, user_id)
+        if i < len(ids) and ids[i] == user_id:
+            return self.balances[i]
+        return default
+
+    def __iter__(self):
+        return zip(self.ids, self.balances)
+
+    def close(self):
+        if self._map is None:
+            return
+        self.ids.release()
+        self.balances.release()
+        self.ids = ()
+        self.balances = ()
+        self._map.close()
+        self._file.close()
+        self._map = None
+        self._file = None
+
+
+# base のスナップショットに overlay（{user_id(int): balance}）を重ねた新しい配列を作る
+# overlay のキーごとに二分探索し、その間の区間はまとめてコピーする
+# zero_base なら base 側の残高はすべて0として扱う（全員リセット）
+def merge(base, overlay, zero_base=False):
+    ids = array("q")
+    balances = array("q")
+    base_ids = base.ids
+    base_balances = base.balances
+
+    def copy(start, end):
+        if start >= end:
+            return
+        ids.frombytes(base_ids[start:end].tobytes())
+        if zero_base:
+            balances.frombytes(bytes((end - start) * ITEM_SIZE))
+        else:
+            balances.frombytes(base_balances[start:end].tobytes())
+
+    pos = 0
+    for user_id in sorted(overlay):
+        i = bisect.bisect_left(base_ids, user_id, pos)
+        copy(pos, i)
+        pos = i + 1 if i < len(base_ids) and base_ids[i] == user_id else i
+        ids.append(user_id)
+        balances.append(overlay[user_id])
+    copy(pos, len(base_ids))
+    return ids, balances
+
+
+def write(path, ids, balances):
+    ids_bytes = ids.tobytes()
+    balance_bytes = balances.tobytes()
+    crc = zlib.crc32(balance_bytes, zlib.crc32(ids_bytes))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ids), crc))
+        f.write(ids_bytes)
+        f.write(balance_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    # 置き換えはアトミックなので、途中でクラッシュしても古いスナップショットが残る
+    os.replace(tmp_path, path)
@@ -0,0 +1,703 @@
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from ledger import BalanceLedger
+from persistence import FlushWorker
+
+# 残高・ロール設定の保存先（ストレージバックエンド）
+#
+# bot.py からは get / add / set / reset_all と role_settings 系だけを使う。
+# 既定は従来どおりの JSON ファイル（+ 追記ログ）、VELT_STORAGE=sqlite で SQLite を使う。
+# どちらもイベントループ上ではメモリだけを更新し、ディスクへの書き込みは
+# FlushWorker のスレッドでまとめて行う。確定を待つときは wait_durable() を await する。
+# 複数プロセスで1つの DB を共有するときは VELT_STORAGE=shared（SharedSqliteBalanceStore）を使う。
+# イベントループから書き込むときは run() を通す（共有ストアは DB のロック待ちがあるのでスレッドで実行する）。
+
+
+class BalanceStore:
+    def __init__(self):
+        # 残高の変更を受け取るもの（ランキング・履歴など）
+        # on_change([(user_id(str), delta, balance), ...], kind, counterparty) と on_reset() を持つ
+        # kind は変更の種類（history.KIND_*）、counterparty は相手のユーザーID
+        self.observers = []
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def _notify(self, changes, kind, counterparty=None):
+        for observer in self.observers:
+            observer.on_change(changes, kind, counterparty)
+
+    def _notify_reset(self):
+        for observer in self.observers:
+            observer.on_reset()
+
+    def load(self):
+        pass
+
+    # イベントループから書き込み操作を呼ぶ。メモリだけを更新するストアはそのまま呼ぶ
+    async def run(self, method, *args):
+        return method(*args)
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    # 加算して変更後の残高を返す
+    def add(self, user_id, amount, kind=0, counterparty=None):
+        raise NotImplementedError
+
+    def set(self, user_id, amount, kind=0):
+        raise NotImplementedError
+
+    # 残高が足りれば引き落として True、足りなければ何もせず False
+    # 1プロセスの中ではエンジンのユーザー単位のロックの中で呼ばれる
+    def try_debit(self, user_id, amount, kind=0, counterparty=None):
+        if self.get(user_id) < amount:
+            return False
+        self.add(user_id, -amount, kind, counterparty)
+        return True
+
+    def transfer(self, from_id, to_id, amount, kind=0):
+        if self.get(from_id) < amount:
+            return False
+        self.add(from_id, -amount, kind, to_id)
+        self.add(to_id, amount, kind, from_id)
+        return True
+
+    # 残高の範囲で最大 amount まで引き落とし、実際に引いた額を返す
+    def debit_up_to(self, user_id, amount, kind=0):
+        taken = min(amount, max(self.get(user_id), 0))
+        if taken:
+            self.add(user_id, -taken, kind)
+        return taken
+
+    # (user_id, amount) の列をまとめて加算する（1回の書き込みで反映）
+    def add_many(self, deltas, kind=0):
+        for user_id, amount in deltas:
+            self.add(user_id, amount, kind)
+
+    # 全員の残高を0にする
+    def reset_all(self):
+        raise NotImplementedError
+
+    # {user_id(str): balance} を順に返す（移行・集計用）
+    def items(self):
+        raise NotImplementedError
+
+    def load_role_settings(self):
+        raise NotImplementedError
+
+    def save_role_settings(self, settings):
+        raise NotImplementedError
+
+    # 1つのロールの設定だけを書き換え、保存した設定を返す（ほかのロールの paid_until には触らない）
+    # interval が今と同じなら保存されている paid_until を引き継ぎ、変わったら now から数え始める
+    def set_role_setting(self, role_id, name, amount, interval, now):
+        settings = self.load_role_settings()
+        previous = settings.get(str(role_id), {})
+        paid_until = None
+        if interval is not None:
+            same = previous.get("interval") == interval and previous.get("paid_until") is not None
+            paid_until = previous["paid_until"] if same else now
+        data = {"name": name, "amount": amount, "interval": interval, "paid_until": paid_until}
+        settings[str(role_id)] = data
+        self.save_role_settings(settings)
+        return data
+
+    # 1つのロールの設定を消す。なければ False
+    def delete_role_setting(self, role_id):
+        settings = self.load_role_settings()
+        if settings.pop(str(role_id), None) is None:
+            return False
+        self.save_role_settings(settings)
+        return True
+
+    # 定期発行の1回分を払う権利を取る。paid_until が変わっていなければ進めて True
+    def claim_role_payout(self, role_id, paid_until, new_paid_until):
+        settings = self.load_role_settings()
+        data = settings.get(str(role_id))
+        if data is None or data.get("paid_until") != paid_until:
+            return False
+        data["paid_until"] = new_paid_until
+        self.save_role_settings(settings)
+        return True
+
+    # まだディスクに書き込まれていない変更の件数（計測用）
+    def pending(self):
+        return 0
+
+    # ここまでの変更がディスクに書き込まれるまで待つ
+    async def wait_durable(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def copy_role_settings(settings):
+    return {role_id: dict(data) for role_id, data in settings.items()}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (
+    user_id INTEGER PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS role_settings (
+    role_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    interval TEXT,
+    paid_until REAL
+);
+"""
+
+ROLE_SETTINGS_SELECT = "SELECT role_id, name, amount, interval, paid_until FROM role_settings"
+ROLE_SETTINGS_INSERT = "INSERT INTO role_settings (role_id, name, amount, interval, paid_until) VALUES (?, ?, ?, ?, ?)"
+# 1行だけの upsert。SET の右辺は更新前の行の値なので、interval が同じなら保存済みの paid_until を残す
+ROLE_SETTING_UPSERT = (
+    ROLE_SETTINGS_INSERT + " ON CONFLICT(role_id) DO UPDATE SET name = excluded.name, amount = excluded.amount, "
+    "interval = excluded.interval, paid_until = CASE WHEN role_settings.interval IS excluded.interval "
+    "THEN COALESCE(role_settings.paid_until, excluded.paid_until) ELSE excluded.paid_until END"
+)
+
+
+# 以前の DB には定期発行の列（interval / paid_until）がないので足す
+def create_sqlite_schema(conn):
+    conn.executescript(SQLITE_SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(role_settings)")}
+    for name, decl in (("interval", "TEXT"), ("paid_until", "REAL")):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE role_settings ADD COLUMN {name} {decl}")
+
+
+def role_settings_from_rows(rows):
+    return {
+        str(role_id): {"name": name, "amount": amount, "interval": interval, "paid_until": paid_until}
+        for role_id, name, amount, interval, paid_until in rows
+    }
+
+
+def role_settings_rows(settings):
+    return [
+        (int(role_id), data["name"], data["amount"], data.get("interval"), data.get("paid_until"))
+        for role_id, data in settings.items()
+    ]
+
+
+# バイナリスナップショット（mmap）+ 追記ログ。メモリには変更されたアカウントだけを持つ
+# balance_file は旧形式の JSON スナップショットで、バイナリがなければ起動時に変換する
+class JsonBalanceStore(BalanceStore):
+    def __init__(self, balance_file, log_file, role_settings_file, snapshot_file=None, archive_dir=None):
+        super().__init__()
+        self.balances = {}
+        snapshot_file = snapshot_file or os.path.splitext(balance_file)[0] + ".snap"
+        self.ledger = BalanceLedger(snapshot_file, log_file, legacy_path=balance_file, archive_dir=archive_dir)
+        self.role_settings_file = role_settings_file
+        # ロール設定はメモリにキャッシュし、変更時だけファイルに書く
+        self._role_settings = {}
+        self._role_worker = FlushWorker(self._flush_role_settings, name="velt-role-settings")
+        self._role_lock = threading.Lock()
+
+    def load(self):
+        self.ledger.load_into(self.balances)
+        try:
+            with open(self.role_settings_file, "r", encoding="utf-8") as f:
+                self._role_settings = json.load(f)
+        except FileNotFoundError:
+            self._role_settings = {}
+        self._role_worker.start()
+
+    def get(self, user_id):
+        return self.ledger.get(user_id)
+
+    def add(self, user_id, amount, kind=0, counterparty=None):
+        uid = str(user_id)
+        balance = self.ledger.get(uid) + amount
+        self.ledger.record(uid, amount, balance, kind, counterparty)
+        self._notify([(uid, amount, balance)], kind, counterparty)
+        return balance
+
+    def set(self, user_id, amount, kind=0):
+        uid = str(user_id)
+        delta = amount - self.ledger.get(uid)
+        self.ledger.record(uid, delta, amount, kind)
+        self._notify([(uid, delta, amount)], kind)
+
+    def add_many(self, deltas, kind=0):
+        records = []
+        current = {}
+        for user_id, amount in deltas:
+            uid = str(user_id)
+            balance = current[uid] if uid in current else self.ledger.get(uid)
+            balance += amount
+            current[uid] = balance
+            records.append((uid, amount, balance))
+        self.ledger.record_many(records, kind)
+        self._notify(records, kind)
+
+    def reset_all(self):
+        self.ledger.reset()
+        self._notify_reset()
+
+    def items(self):
+        return self.ledger.items()
+
+    def load_role_settings(self):
+        return copy_role_settings(self._role_settings)
+
+    def save_role_settings(self, settings):
+        with self._role_lock:
+            self._role_settings = copy_role_settings(settings)
+        self._role_worker.mark_dirty()
+
+    def _flush_role_settings(self):
+        with self._role_lock:
+            data = json.dumps(self._role_settings, ensure_ascii=False)
+        tmp_path = self.role_settings_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.role_settings_file)
+
+    def pending(self):
+        return self.ledger.pending()
+
+    async def wait_durable(self):
+        await self.ledger.wait_durable()
+        await self._role_worker.wait_durable()
+
+    def close(self):
+        self.ledger.close()
+        self._role_worker.close()
+
+
+# SQLite（WAL モード）。残高は主キーでの点読み、書き込みは1行ずつの upsert
+# 未書き込みの残高はメモリ上の overlay に持ち、ワーカーが1トランザクションでまとめて反映する
+class SqliteBalanceStore(BalanceStore):
+    def __init__(self, db_file, flush_interval=0.2):
+        super().__init__()
+        self.db_file = db_file
+        self.conn = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._overlay = {}
+        self._flushing = {}
+        self._reset_pending = False
+        self._reset_flushing = False
+        self._role_settings = {}
+        self._role_dirty = False
+        self._worker = FlushWorker(self._flush, interval=flush_interval, name="velt-sqlite")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load(self):
+        # 読み込み用（イベントループ）と書き込み用（ワーカー）で接続を分ける
+        self.conn = self._connect()
+        self._writer = self._connect()
+        create_sqlite_schema(self.conn)
+        self._role_settings = role_settings_from_rows(self.conn.execute(ROLE_SETTINGS_SELECT))
+        self._worker.start()
+
+    def get(self, user_id):
+        uid = int(user_id)
+        with self._lock:
+            if uid in self._overlay:
+                return self._overlay[uid]
+            if uid in self._flushing:
+                return self._flushing[uid]
+            if self._reset_pending or self._reset_flushing:
+                return 0
+        row = self.conn.execute(
+            "SELECT balance FROM balances WHERE user_id = ?", (uid,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add(self, user_id, amount, kind=0, counterparty=None):
+        balance = self.get(user_id) + amount
+        with self._lock:
+            self._overlay[int(user_id)] = balance
+        self._worker.mark_dirty()
+        self._notify([(str(user_id), amount, balance)], kind, counterparty)
+        return balance
+
+    def set(self, user_id, amount, kind=0):
+        delta = amount - self.get(user_id)
+        with self._lock:
+            self._overlay[int(user_id)] = amount
+        self._worker.mark_dirty()
+        self._notify([(str(user_id), delta, amount)], kind)
+
+    def add_many(self, deltas, kind=0):
+        totals = {}
+        for user_id, amount in deltas:
+            uid = int(user_id)
+            totals[uid] = totals.get(uid, 0) + amount
+        current = self._get_many(list(totals))
+        changes = []
+        with self._lock:
+            for uid, amount in totals.items():
+                balance = current[uid] + amount
+                self._overlay[uid] = balance
+                changes.append((str(uid), amount, balance))
+        self._worker.mark_dirty()
+        self._notify(changes, kind)
+
+    # 複数ユーザーの残高を IN 句でまとめて読む
+    def _get_many(self, uids):
+        result = {}
+        missing = []
+        with self._lock:
+            reset = self._reset_pending or self._reset_flushing
+            for uid in uids:
+                if uid in self._overlay:
+                    result[uid] = self._overlay[uid]
+                elif uid in self._flushing:
+                    result[uid] = self._flushing[uid]
+                elif reset:
+                    result[uid] = 0
+                else:
+                    missing.append(uid)
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            for uid in chunk:
+                result[uid] = 0
+            rows = self.conn.execute(
+                f"SELECT user_id, balance FROM balances WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for uid, balance in rows:
+                result[uid] = balance
+        return result
+
+    def reset_all(self):
+        with self._lock:
+            self._overlay.clear()
+            self._reset_pending = True
+        self._worker.mark_dirty()
+        self._notify_reset()
+
+    # イベントループから呼ばれる（ランキングの作り直しなど）ので、ワーカーの書き込みは待たず、
+    # 書き込み待ちの残高を DB の値に重ねて返す（get と同じ見え方）
+    def items(self):
+        with self._lock:
+            pending = dict(self._flushing)
+            pending.update(self._overlay)
+            reset = self._reset_pending or self._reset_flushing
+        for user_id, balance in self.conn.execute("SELECT user_id, balance FROM balances"):
+            if user_id not in pending:
+                yield str(user_id), 0 if reset else balance
+        for user_id, balance in pending.items():
+            yield str(user_id), balance
+
+    def load_role_settings(self):
+        with self._lock:
+            return copy_role_settings(self._role_settings)
+
+    def save_role_settings(self, settings):
+        with self._lock:
+            self._role_settings = copy_role_settings(settings)
+            self._role_dirty = True
+        self._worker.mark_dirty()
+
+    def pending(self):
+        return len(self._overlay) + len(self._flushing)
+
+    async def wait_durable(self):
+        await self._worker.wait_durable()
+
+    # ワーカースレッドで実行される
+    def _flush(self):
+        with self._lock:
+            self._flushing, self._overlay = self._overlay, {}
+            self._reset_flushing, self._reset_pending = self._reset_pending, False
+            rows = list(self._flushing.items())
+            reset = self._reset_flushing
+            roles = copy_role_settings(self._role_settings) if self._role_dirty else None
+            self._role_dirty = False
+        try:
+            with self._writer:
+                self._writer.execute("BEGIN")
+                if reset:
+                    self._writer.execute("UPDATE balances SET balance = 0")
+                self._writer.executemany(
+                    "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance",
+                    rows,
+                )
+                if roles is not None:
+                    self._writer.execute("DELETE FROM role_settings")
+                    self._writer.executemany(ROLE_SETTINGS_INSERT, role_settings_rows(roles))
+        except Exception:
+            # 反映できなかった分は overlay に戻して次回やり直す
+            with self._lock:
+                self._flushing.update(self._overlay)
+                self._overlay = self._flushing
+                self._reset_pending = self._reset_pending or reset
+                self._role_dirty = self._role_dirty or roles is not None
+                self._flushing = {}
+                self._reset_flushing = False
+            raise
+        with self._lock:
+            self._flushing = {}
+            self._reset_flushing = False
+
+    def close(self):
+        if self.conn is None:
+            return
+        self._worker.close()
+        self.conn.close()
+        self._writer.close()
+        self.conn = None
+        self._writer = None
+
+
+# 複数プロセス（シャードごとのプロセスなど）で同じ DB を共有する SQLite
+# メモリにキャッシュを持たず、変更は1件ずつ BEGIN IMMEDIATE のトランザクションで書く。
+# 書き込みロックはプロセス間で SQLite が取るので、残高チェックと引き落としを
+# 1トランザクションにまとめれば、別のプロセスと同時に使われても二重に引き落とされない。
+# 別のプロセスが書き込み中だと BEGIN IMMEDIATE が busy_timeout まで待つので、run() から呼ばれた書き込みは
+# 1本のスレッドで実行し、observer への通知だけをイベントループに戻して行う。
+# 読み取りは WAL なら書き込みを待たないので、別の接続でイベントループから直接行う。
+class SharedSqliteBalanceStore(BalanceStore):
+    def __init__(self, db_file, busy_timeout=5000):
+        super().__init__()
+        self.db_file = db_file
+        # 他のプロセスが書き込み中のときに待つ最大時間（ミリ秒）
+        self.busy_timeout = busy_timeout
+        self.conn = None  # 書き込み用（書き込みのスレッドかロックの中で使う）
+        self.read_conn = None
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load(self):
+        self.conn = self._connect()
+        create_sqlite_schema(self.conn)
+        self.read_conn = self._connect()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="velt-shared-store")
+
+    async def run(self, method, *args):
+        def call():
+            self._local.pending = []
+            try:
+                return method(*args), self._local.pending
+            finally:
+                self._local.pending = None
+
+        result, pending = await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        for notify in pending:
+            notify()
+        return result
+
+    # run() のスレッドの中では通知を溜めておき、イベントループに戻ってから送る
+    def _notify(self, changes, kind, counterparty=None):
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            super()._notify(changes, kind, counterparty)
+        else:
+            pending.append(functools.partial(BalanceStore._notify, self, changes, kind, counterparty))
+
+    def _notify_reset(self):
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            super()._notify_reset()
+        else:
+            pending.append(functools.partial(BalanceStore._notify_reset, self))
+
+    @contextmanager
+    def _transaction(self):
+        with self._write_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _balance(self, uid, conn=None):
+        row = (conn or self.conn).execute("SELECT balance FROM balances WHERE user_id = ?", (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def _credit(self, uid, amount):
+        self.conn.execute(
+            "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance",
+            (uid, amount),
+        )
+        return self._balance(uid)
+
+    def get(self, user_id):
+        return self._balance(int(user_id), self.read_conn)
+
+    def add(self, user_id, amount, kind=0, counterparty=None):
+        with self._transaction():
+            balance = self._credit(int(user_id), amount)
+        self._notify([(str(user_id), amount, balance)], kind, counterparty)
+        return balance
+
+    def set(self, user_id, amount, kind=0):
+        uid = int(user_id)
+        with self._transaction() as conn:
+            delta = amount - self._balance(uid)
+            conn.execute(
+                "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance",
+                (uid, amount),
+            )
+        self._notify([(str(user_id), delta, amount)], kind)
+
+    def add_many(self, deltas, kind=0):
+        totals = {}
+        for user_id, amount in deltas:
+            uid = int(user_id)
+            totals[uid] = totals.get(uid, 0) + amount
+        changes = []
+        with self._transaction():
+            for uid, amount in totals.items():
+                changes.append((str(uid), amount, self._credit(uid, amount)))
+        self._notify(changes, kind)
+
+    # 残高チェックと引き落としを条件付き UPDATE の1文で行う
+    def _debit(self, uid, amount):
+        self.conn.execute("INSERT OR IGNORE INTO balances (user_id) VALUES (?)", (uid,))
+        cursor = self.conn.execute(
+            "UPDATE balances SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+            (amount, uid, amount),
+        )
+        if cursor.rowcount == 0:
+            return None
+        return self._balance(uid)
+
+    def try_debit(self, user_id, amount, kind=0, counterparty=None):
+        with self._transaction():
+            balance = self._debit(int(user_id), amount)
+        if balance is None:
+            return False
+        self._notify([(str(user_id), -amount, balance)], kind, counterparty)
+        return True
+
+    def transfer(self, from_id, to_id, amount, kind=0):
+        with self._transaction():
+            from_balance = self._debit(int(from_id), amount)
+            if from_balance is None:
+                return False
+            to_balance = self._credit(int(to_id), amount)
+        self._notify([(str(from_id), -amount, from_balance)], kind, to_id)
+        self._notify([(str(to_id), amount, to_balance)], kind, from_id)
+        return True
+
+    def debit_up_to(self, user_id, amount, kind=0):
+        uid = int(user_id)
+        with self._transaction():
+            taken = min(amount, max(self._balance(uid), 0))
+            if taken:
+                balance = self._credit(uid, -taken)
+        if taken:
+            self._notify([(str(user_id), -taken, balance)], kind)
+        return taken
+
+    def reset_all(self):
+        with self._transaction() as conn:
+            conn.execute("UPDATE balances SET balance = 0")
+        self._notify_reset()
+
+    def items(self):
+        for user_id, balance in self.read_conn.execute("SELECT user_id, balance FROM balances").fetchall():
+            yield str(user_id), balance
+
+    # ロール設定は他のプロセスの変更が見えるように毎回 DB から読む
+    def load_role_settings(self):
+        return role_settings_from_rows(self.read_conn.execute(ROLE_SETTINGS_SELECT))
+
+    def save_role_settings(self, settings):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM role_settings")
+            conn.executemany(ROLE_SETTINGS_INSERT, role_settings_rows(settings))
+
+    # 変更するロールの行だけを書く（全体を書き直すと、その間に進んだ paid_until を古い値に戻してしまう）
+    def set_role_setting(self, role_id, name, amount, interval, now):
+        with self._transaction() as conn:
+            conn.execute(ROLE_SETTING_UPSERT, (int(role_id), name, amount, interval, None if interval is None else now))
+            row = conn.execute(ROLE_SETTINGS_SELECT + " WHERE role_id = ?", (int(role_id),)).fetchone()
+        return role_settings_from_rows([row])[str(role_id)]
+
+    def delete_role_setting(self, role_id):
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM role_settings WHERE role_id = ?", (int(role_id),)).rowcount == 1
+
+    # 発行済みの時刻を条件付き UPDATE で進める（同じ回を払うのは1プロセスだけ）
+    def claim_role_payout(self, role_id, paid_until, new_paid_until):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE role_settings SET paid_until = ? WHERE role_id = ? AND paid_until = ?",
+                (new_paid_until, int(role_id), paid_until),
+            )
+            return cursor.rowcount == 1
+
+    def close(self):
+        if self.conn is None:
+            return
+        self._executor.shutdown()
+        self.read_conn.close()
+        self.conn.close()
+        self.conn = None
+
+
+# archive_dir は json のときだけ使う（スナップショット済みのログを監査用に残す）
+def open_store(backend, balance_file, log_file, role_settings_file, db_file, archive_dir=None):
+    if backend == "json":
+        return JsonBalanceStore(balance_file, log_file, role_settings_file, archive_dir=archive_dir)
+    if backend == "sqlite":
+        return SqliteBalanceStore(db_file)
+    if backend == "shared":
+        return SharedSqliteBalanceStore(db_file)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# JSON ファイル（残高・ロール設定）から SQLite へ一括移行する
+def migrate_json_to_sqlite(balance_file, log_file, role_settings_file, db_file):
+    src = JsonBalanceStore(balance_file, log_file, role_settings_file)
+    src.load()
+    dst = SqliteBalanceStore(db_file)
+    dst.load()
+    try:
+        count = 0
+        for uid, balance in src.items():
+            dst.set(uid, balance)
+            count += 1
+        dst.save_role_settings(src.load_role_settings())
+        return count
+    finally:
+        src.close()
+        dst.close()
+
+
+if __name__ == "__main__":
+    # 使い方: python storage.py migrate [velt.db]
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python storage.py migrate [DB_FILE]")
+        sys.exit(1)
+    db_file = sys.argv[2] if len(sys.argv) > 2 else os.getenv("VELT_DB_FILE", "velt.db")
+    count = migrate_json_to_sqlite("velt_balances.json", "velt_balances.log", "role_settings.json", db_file)
+    print(f"Migrated {count} balances to {db_file}")
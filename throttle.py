@@ -0,0 +1,86 @@
+import time
+
+# コマンドの流量制限（トークンバケット）
+#
+# バケットは (残りトークン, 最後に更新した時刻) のタプルを辞書に入れるだけで、
+# 補充は使うときに経過時間から計算する（タイマーは持たない）。
+# しばらく使われず満タンに戻ったバケットは、ときどきの掃除でまとめて捨てる。
+# 種類（ゲーム・送金・管理者の一括操作など）ごとに、ユーザー単位とサーバー単位の2つの上限を持つ。
+
+
+# "rate/burst"（1秒あたりの補充数 / 最大数）を読む
+def parse_budget(text):
+    rate, burst = text.split("/")
+    return float(rate), float(burst)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, idle_timeout=600.0):
+        self.rate = rate
+        self.burst = burst
+        self.idle_timeout = idle_timeout
+        self._buckets = {}  # key -> (残りトークン, 最後に更新した時刻)
+        self._next_sweep = 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # 使えれば消費して0、足りなければ使えるようになるまでの秒数を返す
+    def acquire(self, key, cost=1.0, now=None):
+        now = time.monotonic() if now is None else now
+        if now >= self._next_sweep:
+            self.sweep(now)
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate if self.rate > 0 else float("inf")
+        self._buckets[key] = (tokens - cost, now)
+        return 0.0
+
+    # acquire() で消費した分を戻す（もう一方の上限で断ったとき）
+    def refund(self, key, cost=1.0):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (min(self.burst, bucket[0] + cost), bucket[1])
+
+    # idle_timeout 以上使われず、満タンに戻っているバケットを捨てる
+    def sweep(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._next_sweep = now + self.idle_timeout
+        idle = [
+            key for key, (tokens, last) in self._buckets.items()
+            if now - last >= self.idle_timeout and tokens + (now - last) * self.rate >= self.burst
+        ]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
+
+
+class CommandThrottle:
+    def __init__(self, budgets, idle_timeout=600.0):
+        # {種類: ((ユーザーの rate, burst), (サーバーの rate, burst))}。None なら制限しない
+        self._limiters = {}
+        for category, (user_budget, guild_budget) in budgets.items():
+            self._limiters[category] = (
+                RateLimiter(*user_budget, idle_timeout) if user_budget else None,
+                RateLimiter(*guild_budget, idle_timeout) if guild_budget else None,
+            )
+
+    def __len__(self):
+        return sum(len(limiter) for pair in self._limiters.values() for limiter in pair if limiter is not None)
+
+    # 通してよければ (0, None)、断るなら (待つ秒数, "user" / "guild")
+    def check(self, category, user_id, guild_id, now=None):
+        user_limiter, guild_limiter = self._limiters.get(category, (None, None))
+        if user_limiter is not None:
+            retry_after = user_limiter.acquire(user_id, now=now)
+            if retry_after:
+                return retry_after, "user"
+        if guild_limiter is not None and guild_id is not None:
+            retry_after = guild_limiter.acquire(guild_id, now=now)
+            if retry_after:
+                if user_limiter is not None:
+                    user_limiter.refund(user_id)
+                return retry_after, "guild"
+        return 0.0, None